@@ -11,26 +11,67 @@ from sic_framework.devices.common_desktop.desktop_camera import DesktopCameraCon
 # Import the message type we're using
 from sic_framework.core.message_python2 import CompressedImageMessage
 
-# Queue for storing images
+# Queue exceptions raised on timeout
 import queue
 
+# Single-slot exchange between the camera callbacks and the main loop
+from sir_code.frame_exchange import LatestValue
+# Frames handed to a display process through shared memory, only their slot numbers go through the pipe
+from sir_code.shm_frames import SharedFrameRing, SharedFrameReceiver, SharedFrameSender
+
+import multiprocessing
+import threading
+
 # Computer vision library for displaying images
 import cv2
 
 
+def show_frames(conn, shape):
+    """
+    Display process: shows the frames whose slots arrive through `conn`, skipping to the newest one when it falls
+    behind, until None arrives.
+    """
+    receiver = SharedFrameReceiver(shape)
+    shown = 0
+    while True:
+        message = conn.recv()
+        while message is not None and conn.poll():
+            message = conn.recv()
+        if message is None:
+            break
+        img = receiver.receive(message)
+        if img is not None:
+            cv2.imshow("Camera Feed", img)
+            cv2.waitKey(1)
+            shown += 1
+    receiver.close()
+    cv2.destroyAllWindows()
+    conn.send(shown)
+
+
 class CameraDemo(SICApplication):
     """
     Desktop camera demo application.
+    With `display_process` the images are shown by a separate process, which gets them through a shared memory
+    ring instead of pickled.
     """
     
-    def __init__(self):
+    def __init__(self, display_process=False):
         # Call parent constructor (handles singleton initialization)
         super(CameraDemo, self).__init__()
         
         # Demo-specific initialization
-        self.imgs = queue.Queue()
+        # Newest image only, a slow display never blocks the camera
+        self.imgs = LatestValue()
         self.desktop = None
         self.desktop_cam = None
+        # Display process, started on the first image once its size is known
+        self.display_process = display_process
+        self.display = None
+        self.display_conn = None
+        self.ring = None
+        self.sender = None
+        self.display_lock = threading.Lock()
         
         # Configure logging
         self.set_log_level(sic_logging.INFO)
@@ -50,7 +91,36 @@ class CameraDemo(SICApplication):
         Returns:
             None
         """
-        self.imgs.put(image_message.image)
+        if not self.display_process:
+            self.imgs.put(image_message.image)
+            return
+        with self.display_lock:
+            if self.ring is None:
+                self.start_display(image_message.image.shape)
+            if self.display_conn is not None:
+                self.sender.send(image_message.image)
+
+    def start_display(self, shape):
+        """Creates the frame ring and the display process attached to it."""
+        self.ring = SharedFrameRing(shape)
+        # a new interpreter, as a process on another pipeline stage would be
+        ctx = multiprocessing.get_context("spawn")
+        self.display_conn, child = ctx.Pipe()
+        self.display = ctx.Process(target=show_frames, args=(child, shape), daemon=True)
+        self.display.start()
+        self.sender = SharedFrameSender(self.ring, self.display_conn.send)
+
+    def stop_display(self):
+        with self.display_lock:
+            if self.display_conn is None:
+                return
+            self.display_conn.send(None)
+            shown = self.display_conn.recv() if self.display_conn.poll(2.0) else 0
+            self.display.join(timeout=1.0)
+            self.logger.info("Display process: {} frames through shared memory, {} pickled, {} shown".format(
+                self.sender.shared, self.sender.fallbacks, shown))
+            self.display_conn = None
+            self.ring.close()
     
     def setup(self):
         """Initialize and configure the desktop camera."""
@@ -72,6 +142,9 @@ class CameraDemo(SICApplication):
         self.logger.info("Starting main loop")
         
         try:
+            while self.display_process and not self.shutdown_event.is_set():
+                # the display process shows the images
+                self.shutdown_event.wait(0.1)
             while not self.shutdown_event.is_set():
                 try:
                     # Use timeout to make the queue operation non-blocking
@@ -81,10 +154,13 @@ class CameraDemo(SICApplication):
                 except queue.Empty:
                     # No new image, continue loop to check shutdown flag
                     continue
+            if not self.display_process:
+                self.logger.info("Images: {}".format(self.imgs.report()))
             self.logger.info("Cleaning up...")
         except Exception as e:
             self.logger.error("Exception: {}".format(e))
         finally:
+            self.stop_display()
             cv2.destroyAllWindows()
             self.shutdown()
 
@@ -15,15 +15,44 @@ from sic_framework.devices.common_desktop.desktop_camera import DesktopCameraCon
 
 # Import the message type(s) we're using
 from sic_framework.core.message_python2 import (
+    BoundingBox,
     BoundingBoxesMessage,
     CompressedImageMessage,
 )
 
-# Queue for storing images and detection results
+# Queue exceptions raised on timeout
 import queue
+import threading
+
+# Alignment of the detection results with the camera images they were computed on
+from sir_code.frame_exchange import FrameAligner, InFlight, RedisClock, message_stamp
+# JPEG crops of the detected faces cut out of the camera JPEG, e.g. for a face recognition service
+from sir_code.roi_crops import RoiCropper, subscribe_jpeg
+# Face detection in a process on this host, fed through shared memory instead of the face-detection service
+from sir_code.shm_frames import LocalDetector
 
 # Computer vision library for displaying images
 import cv2
+import numpy as np
+
+
+class FaceCascade:
+    """The Haar cascade of the sic face-detection service, as a picklable callable for a `LocalDetector`."""
+
+    def __init__(self, min_size=150):
+        self.min_size = min_size
+        self.cascade = None
+
+    def __getstate__(self):
+        return {"min_size": self.min_size, "cascade": None}
+
+    def __call__(self, image):
+        if self.cascade is None:
+            self.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        faces = self.cascade.detectMultiScale(gray, scaleFactor=1.2, minNeighbors=5,
+                                              minSize=(self.min_size, self.min_size))
+        return [tuple(int(v) for v in face) for face in faces]
 
 
 class FaceDetectionDemo(SICApplication):
@@ -33,16 +62,30 @@ class FaceDetectionDemo(SICApplication):
     IMPORTANT
     face-detection service needs to be running:
     1. run-face-detection
+
+    With `local_detection` the faces are detected by a process on this host instead, which gets the images through
+    a shared memory ring, no service needed.
     """
     
-    def __init__(self):
+    def __init__(self, crop_faces=False, local_detection=False):
         # Call parent constructor (handles singleton initialization)
         super(FaceDetectionDemo, self).__init__()
         
         # Demo-specific initialization
-        # Queue for storing images and detection results
-        self.imgs_buffer = queue.Queue(maxsize=1)
-        self.faces_buffer = queue.Queue(maxsize=1)
+        # Frames and detections are compared on the clock of the redis server, the one sic stamps messages with
+        self.clock = RedisClock(self.get_redis_instance())
+        # Recent images by timestamp, each detection result is drawn on the image it was computed on
+        self.aligner = FrameAligner(clock=self.clock)
+        # Stamps of the images sent to the face detection, its results are not stamped but come back in order
+        self.in_flight = InFlight(limit=2, clock=self.clock)
+        # Crops the faces of every frame out of its JPEG as received, without decoding and encoding them again, and
+        # shows the first one (needs libturbojpeg)
+        self.cropper = RoiCropper() if crop_faces else None
+        self.jpeg_thread = None
+        # Local detection process, started on the first image once its size is known
+        self.local_detection = local_detection
+        self.detector = None
+        self.detector_lock = threading.Lock()
         # Desktop device and camera component
         self.desktop = None
         self.desktop_cam = None
@@ -66,7 +109,57 @@ class FaceDetectionDemo(SICApplication):
         Returns:
             None
         """
-        self.imgs_buffer.put(image_message.image)
+        self.on_frame(image_message.image, None, image_message)
+
+    def on_jpeg(self, jpeg, message):
+        """
+        Callback function for incoming camera images with their JPEG, when cropping faces.
+
+        Args:
+            jpeg: The JPEG of the camera image, as sent by the camera.
+            message: The camera image message, its image not decoded.
+
+        Returns:
+            None
+        """
+        self.on_frame(self.cropper.decode(jpeg), jpeg, message)
+
+    def on_frame(self, image, jpeg, message):
+        """Keeps the camera image (and its JPEG) and sends it to the face detection if it is not busy."""
+        stamp = message_stamp(message, self.clock)
+        self.aligner.add_frame((image, jpeg), stamp)
+        # Send the image to the face detection unless it is still busy with the previous ones
+        if self.in_flight.ready():
+            self.in_flight.sent(stamp)
+            if self.local_detection:
+                self.detect_locally(image, stamp)
+            else:
+                self.face_dec.send_message(CompressedImageMessage(image))
+
+    def detect_locally(self, image, stamp):
+        """Sends the image to the local detection process, started on the first image."""
+        with self.detector_lock:
+            if self.shutdown_event.is_set():
+                return
+            if self.detector is None:
+                self.detector = LocalDetector(FaceCascade(), image.shape, self.on_local_faces)
+            self.detector.send(image, stamp)
+
+    def on_local_faces(self, stamp, faces):
+        """
+        Callback function for the results of the local detection process.
+
+        Args:
+            stamp: The timestamp of the image the faces were detected on, as it was sent.
+            faces: The (x, y, w, h) of the faces, None if the image was overwritten before it was detected.
+
+        Returns:
+            None
+        """
+        # answered in order, this frees the oldest image in flight, which is the one of `stamp`
+        self.in_flight.received()
+        if faces is not None:
+            self.aligner.add_detections([BoundingBox(*face) for face in faces], stamp)
     
     def on_faces(self, message: BoundingBoxesMessage):
         """
@@ -78,7 +171,8 @@ class FaceDetectionDemo(SICApplication):
         Returns:
             None
         """
-        self.faces_buffer.put(message.bboxes)
+        # The result of the oldest image in flight
+        self.aligner.add_detections(message.bboxes, self.in_flight.received())
     
     def setup(self):
         """Initialize and configure the desktop camera and face detection service."""
@@ -94,15 +188,22 @@ class FaceDetectionDemo(SICApplication):
         # initialize the component(s) we want to use
         self.desktop_cam = self.desktop.camera
         
-        self.logger.info("Setting up face detection service")
-        # setup the service(s) we want to use, taking the output of the desktop camera as the input
-        self.face_dec = FaceDetection(input_source=self.desktop_cam)
+        if not self.local_detection:
+            self.logger.info("Setting up face detection service")
+            # setup the service(s) we want to use, fed by the demo instead of the camera output (see on_image)
+            self.face_dec = FaceDetection()
         
         self.logger.info("Subscribing callback functions")
         
         # register the callback functions to act upon arrival of the relevant messages
-        self.desktop_cam.register_callback(callback=self.on_image)
-        self.face_dec.register_callback(callback=self.on_faces)
+        if self.cropper is None:
+            self.desktop_cam.register_callback(callback=self.on_image)
+        else:
+            # the camera images with their JPEG kept, the faces are cut out of it
+            self.jpeg_thread = subscribe_jpeg(self.get_redis_instance(), self.desktop_cam.get_component_channel(),
+                                              self.on_jpeg)
+        if self.face_dec is not None:
+            self.face_dec.register_callback(callback=self.on_faces)
     
     def run(self):
         """Main application loop."""
@@ -111,10 +212,14 @@ class FaceDetectionDemo(SICApplication):
         try:
             while not self.shutdown_event.is_set():
                 try:
-                    # Use timeout to make queue operations non-blocking
-                    img = self.imgs_buffer.get(timeout=0.1)  # 100ms timeout
-                    faces = self.faces_buffer.get(timeout=0.1)
+                    # Use timeout to make the exchange non-blocking
+                    (img, jpeg), faces = self.aligner.pairs.get(timeout=0.1)  # 100ms timeout
                     
+                    if jpeg is not None:
+                        crops = self.cropper.crop(jpeg, faces)
+                        if crops:
+                            cv2.imshow("Face", cv2.imdecode(np.frombuffer(crops[0].jpeg, np.uint8), cv2.IMREAD_COLOR))
+
                     for face in faces:
                         utils_cv2.draw_bbox_on_image(face, img)
                     
@@ -124,10 +229,21 @@ class FaceDetectionDemo(SICApplication):
                     # No new data, continue loop to check shutdown flag
                     continue
             cv2.destroyAllWindows()
+            self.logger.info("Faces: {}".format(self.aligner.report()))
+            self.logger.info("Face detection: {}".format(self.in_flight.report()))
+            if self.detector is not None:
+                self.logger.info("Local face detection: {}".format(self.detector.report()))
+            if self.cropper is not None:
+                self.logger.info("Face crops: {}".format(self.cropper.report()))
             self.logger.info("Cleaning up...")
         except Exception as e:
             self.logger.error("Exception: {}".format(e))
         finally:
+            if self.jpeg_thread is not None:
+                self.jpeg_thread.stop()
+            with self.detector_lock:
+                if self.detector is not None:
+                    self.detector.close()
             cv2.destroyAllWindows()
             self.shutdown()
 
@@ -35,7 +35,6 @@ from sic_framework.services.openai_gpt.gpt import GPT, GPTConf, GPTRequest
 from time import sleep
 import json
 from os import environ
-import queue
 import threading
 from os.path import abspath, join
 from subprocess import call
@@ -43,6 +42,15 @@ from dotenv import load_dotenv
 import cv2
 import numpy as np
 
+# Alignment of the detection results with the camera images they were computed on
+from sir_code.frame_exchange import FrameAligner, InFlight, RedisClock, message_stamp
+# Camera images as JPEG, only the ones passed on to the face detection are decoded
+from sir_code.roi_crops import subscribe_jpeg
+# Presence of a user, gating the listening and pre-warming the speech when somebody walks up
+from sir_code.presence import PresenceMonitor
+# Face detection rate, low while nobody is there
+from sir_code.detection_governor import DetectionGovernor
+
 
 class ConversationApp(SICApplication):
     """
@@ -98,8 +106,23 @@ class ConversationApp(SICApplication):
         self.fx = 1.0
         self.fy = 1.0
         self.flip = 1
-        self.imgs_buffer = queue.Queue(maxsize=1)
-        self.faces_buffer = queue.Queue(maxsize=1)
+        # Frames and detections are compared on the clock of the redis server, the one sic stamps messages with
+        self.clock = RedisClock(self.get_redis_instance())
+        # Recent images by timestamp, each detection result is drawn on the image it was computed on
+        self.aligner = FrameAligner(clock=self.clock)
+        # Nobody is there until faces were seen for half a second, and gone after five seconds without faces
+        self.presence = PresenceMonitor(enter_dwell=0.5, leave_dwell=5.0)
+        self.presence.on_arrive(self._prewarm)
+        self.presence.on_leave(self._on_leave)
+        # Faces are detected twice a second while nobody is there, at the full rate once somebody shows up
+        self.detection = DetectionGovernor(min_rate=2.0, max_rate=15.0)
+        self.detection.set_demand(self.presence.demand)
+        # Stamps of the images sent to the face detection, its results are not stamped but come back in order
+        self.in_flight = InFlight(limit=1, clock=self.clock)
+        self.jpeg_thread = None
+        self.greeting = "Hi there! How may I help you?"
+        self.speech_cache = {}
+        self.greet = True
         self.sees_face = False
         self.desktop = None
         self.face_rec = None
@@ -138,10 +161,12 @@ class ConversationApp(SICApplication):
                 keyfile_json=json.load(open(self.google_keyfile_path))
             )
             self.tts = Text2Speech(conf=tts_conf)
-        self.face_rec = FaceDetection(input_source=self.desktop.camera)
+        # Fed by this program with the frames due for detection (see _on_jpeg), instead of every camera frame
+        self.face_rec = FaceDetection()
 
-        # Send back the outputs to this program
-        self.desktop.camera.register_callback(self._on_image)
+        # Send back the outputs to this program, the camera images undecoded: most are skipped while nobody is there
+        self.jpeg_thread = subscribe_jpeg(self.get_redis_instance(), self.desktop.camera.get_component_channel(),
+                                          self._on_jpeg)
         self.face_rec.register_callback(self._on_faces)
 
         # Setup GPT client
@@ -167,13 +192,56 @@ class ConversationApp(SICApplication):
         # register a callback function to act upon arrival of recognition_result
         self.dialogflow.register_callback(self._on_dialog)
 
-    def _on_image(self, image_message: CompressedImageMessage):
-        self.imgs_buffer.put(image_message.image)
+    def _on_jpeg(self, jpeg, message):
+        # only the frames due for detection are decoded and kept, they are the only ones drawn (see
+        # _kiosk_run_facedetection), the others cost the unpickling of their JPEG
+        stamp = message_stamp(message, self.clock)
+        if not (self.detection.frame(None, stamp) and self.in_flight.ready()):
+            return
+        image = CompressedImageMessage.jpeg2np(jpeg)
+        self.aligner.add_frame(image, stamp)
+        self.in_flight.sent(stamp)
+        self.face_rec.send_message(CompressedImageMessage(image))
 
     def _on_faces(self, message: BoundingBoxesMessage):
-        self.faces_buffer.put(message.bboxes)
-        if message.bboxes:
-            self.sees_face = True
+        # the result of the oldest frame in flight, the face detection does not stamp its results
+        stamp = self.in_flight.received()
+        if stamp is None:
+            stamp = self.clock()
+        self.aligner.add_detections(message.bboxes, stamp)
+        self.presence.observe(bool(message.bboxes), stamp)
+        self.detection.set_demand(self.presence.demand)
+        self.sees_face = self.presence.present
+
+    def _prewarm(self):
+        """
+        Somebody walks up: synthesize the greeting and open the connection of the GPT service to OpenAI meanwhile,
+        so the greeting plays as soon as they are present and the first answer does not pay for the handshake.
+        """
+        if not self.local_tts and self.greeting not in self.speech_cache:
+            threading.Thread(target=self._synthesize, args=(self.greeting,), daemon=True).start()
+        threading.Thread(target=self._warm_gpt, daemon=True).start()
+
+    def _warm_gpt(self):
+        try:
+            # a one token answer, the smallest request that goes all the way to the model
+            self.gpt.request(GPTRequest("Say OK.", max_tokens=1))
+        except Exception as e:
+            self.logger.warning("Warming up GPT failed: {}".format(e))
+
+    def _on_leave(self):
+        """Nobody is there anymore: the dialog waits for the next visitor, who is greeted and listened to again."""
+        self.greet = True
+        self.can_listen = True
+        self.logger.info("Presence: {}".format(self.presence.report()))
+
+    def _synthesize(self, text):
+        reply = self.speech_cache.get(text)
+        if reply is None:
+            reply = self.tts.request(GetSpeechRequest(text=text, voice_name="en-US-Standard-C"))
+            if text == self.greeting:
+                self.speech_cache[text] = reply
+        return reply
 
     def _on_dialog(self, message):
         """
@@ -193,16 +261,13 @@ class ConversationApp(SICApplication):
         if self.local_tts:
             call(["espeak", "-s140 -ven+18 -z", text])
         else:
-            # Request speech synthesis from Google TTS
-            reply = self.tts.request(
-                GetSpeechRequest(text=text, voice_name="en-US-Standard-C")
-            )
+            # Request speech synthesis from Google TTS, the greeting is synthesized once
+            reply = self._synthesize(text)
             self.desktop.speakers.request(AudioRequest(reply.waveform, reply.sample_rate))
 
     def _kiosk_run_facedetection(self):
         while True:
-            img = self.imgs_buffer.get()
-            faces = self.faces_buffer.get()
+            img, faces = self.aligner.pairs.get()
 
             for face in faces:
                 utils_cv2.draw_bbox_on_image(face, img)
@@ -213,13 +278,16 @@ class ConversationApp(SICApplication):
     def _kiosk_run_dialogflow(self):
         attempts = 1
         max_attempts = 3
-        init = True
         while not self.shutdown_event.is_set():
             try:
-                if self.sees_face and self.can_listen:
-                    if init:
-                        self.speak("Hi there! How may I help you?")
-                        init = False
+                # Dialogflow is only streamed to while somebody is there, an empty kiosk waits without polling
+                if not self.presence.wait_present(timeout=0.5):
+                    continue
+                if self.can_listen:
+                    if self.greet:
+                        attempts = 1
+                        self.speak(self.greeting)
+                        self.greet = False
 
                     reply = self.dialogflow.request(GetIntentRequest(self.session_id))
 
@@ -262,6 +330,11 @@ class ConversationApp(SICApplication):
         self.logger.info("Starting Chat App")
         
         try:
+            # Wait for somebody to talk to before asking anything
+            self.logger.info("Waiting for a face...")
+            while not self.presence.wait_present(timeout=0.5):
+                if self.shutdown_event.is_set():
+                    return
             self.speak("What is your favorite hobby?")
             reply = self.dialogflow.request(GetIntentRequest(self.session_id))
             if reply.response.query_result.query_text:
@@ -274,9 +347,12 @@ class ConversationApp(SICApplication):
                 self.speak(gpt_response.response)
             
             self.logger.info("Chat completed")
+            self.logger.info("Face detection: {}, {}".format(self.detection.report(), self.in_flight.report()))
         except Exception as e:
             self.logger.error("Exception: {}".format(e))
         finally:
+            if self.jpeg_thread is not None:
+                self.jpeg_thread.stop()
             self.shutdown()
 
 
@@ -19,9 +19,16 @@ from sic_framework.core.message_python2 import (
     CompressedImageMessage,
 )
 
-# Queue for storing images
+# Queue exceptions raised on timeout
 import queue
 
+# Single-slot exchange between the camera callbacks and the main loop
+from sir_code.frame_exchange import InFlight, LatestValue, RedisClock, message_stamp
+# Tracking of the detected boxes in between the detector runs
+from sir_code.box_tracker import BoxTracker
+# Detection rate following the scene motion, the stability of the boxes and the CPU load
+from sir_code.detection_governor import DetectionGovernor
+
 # Computer vision library for displaying images
 import cv2
 
@@ -42,10 +49,18 @@ class ObjectDetectionDemo(SICApplication):
         super(ObjectDetectionDemo, self).__init__()
         
         # Demo-specific initialization
-        # Queue for storing images
-        self.imgs_buffer = queue.Queue(maxsize=1)
-        # Store the latest detections
-        self.latest_objects = []
+        # Newest image, a slow display never blocks the camera
+        self.imgs_buffer = LatestValue()
+        # Frames and detections are compared on the clock of the redis server, the one sic stamps messages with
+        self.clock = RedisClock(self.get_redis_instance())
+        # Stamps of the frames sent to the detector, its results are not stamped but come back in order; one at a
+        # time, as the detector keeps only the newest frame waiting
+        self.in_flight = InFlight(limit=1, clock=self.clock)
+        # Track the latest detections, the boxes are moved along on the frames between detections
+        self.tracker = BoxTracker()
+        # Detector rate the scene motion, the stability of the tracked boxes and the CPU load call for, only the
+        # frames it is due on are detected
+        self.detection_governor = DetectionGovernor(min_rate=1.0, max_rate=15.0)
         # Desktop device and camera component
         self.desktop = None
         self.desktop_cam = None
@@ -70,12 +85,13 @@ class ObjectDetectionDemo(SICApplication):
         Returns:
             None
         """
-        # Remove old image if buffer is full
-        try:
-            self.imgs_buffer.get_nowait()
-        except queue.Empty:
-            pass
+        # Replaces the previous image if it was not displayed yet
         self.imgs_buffer.put(image_message.image)
+        # Send the frame to the detector if it is due and not busy, the tracker moves the boxes on the other frames
+        stamp = message_stamp(image_message, self.clock)
+        if self.detection_governor.frame(image_message.image, stamp) and self.in_flight.ready():
+            self.in_flight.sent(stamp)
+            self.object_det.send_message(image_message)
     
     def on_objects(self, message: BoundingBoxesMessage):
         """
@@ -87,8 +103,10 @@ class ObjectDetectionDemo(SICApplication):
         Returns:
             None
         """
-        # Update latest detections
-        self.latest_objects = message.bboxes
+        # Correct the tracked boxes with the latest detections, at the time of the frame they were computed on
+        stamp = self.in_flight.received()
+        stability = self.tracker.update(message.bboxes, self.clock() if stamp is None else stamp)
+        self.detection_governor.observe(stability)
     
     def setup(self):
         """Initialize and configure the desktop camera and object detection service."""
@@ -105,10 +123,10 @@ class ObjectDetectionDemo(SICApplication):
         self.desktop_cam = self.desktop.camera
         
         self.logger.info("Setting up object detection service")
-        # Configure object detection with frequency of N Hz (detections every 1/N seconds)
-        obj_det_conf = ObjectDetectionConf(frequency=15.0)  # You can adjust this value
-        # setup the service(s) we want to use, taking the output of the desktop camera as the input
-        self.object_det = ObjectDetection(input_source=self.desktop_cam, conf=obj_det_conf)
+        # No fixed detection frequency, the service detects the frames the demo sends (see on_image)
+        obj_det_conf = ObjectDetectionConf(frequency=0)
+        # setup the service(s) we want to use, fed by the demo instead of the camera output
+        self.object_det = ObjectDetection(conf=obj_det_conf)
         
         self.logger.info("Subscribing callback functions")
         
@@ -126,8 +144,8 @@ class ObjectDetectionDemo(SICApplication):
                     # Get latest image (non-blocking with timeout)
                     img = self.imgs_buffer.get(timeout=0.1)
                     
-                    # Draw the latest detections on every frame
-                    for obj in self.latest_objects:
+                    # Draw the tracked detections on every frame, moved to the time the frame arrived
+                    for obj in self.tracker.predict(self.clock() - self.imgs_buffer.last_age):
                         utils_cv2.draw_bbox_on_image(obj, img)
                     
                     cv2.imshow("Object Detection", img)
@@ -136,6 +154,9 @@ class ObjectDetectionDemo(SICApplication):
                     # No new image, continue loop to check shutdown flag
                     continue
             
+            self.logger.info("Images: {}".format(self.imgs_buffer.report()))
+            self.logger.info("Detection governor: {}".format(self.detection_governor.report()))
+            self.logger.info("Detector: {}".format(self.in_flight.report()))
             self.logger.info("Cleaning up...")
             cv2.destroyAllWindows()
         except Exception as e:
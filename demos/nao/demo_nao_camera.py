@@ -14,6 +14,9 @@ from sic_framework.core.message_python2 import CompressedImageMessage
 import queue
 import cv2
 
+# Single-slot exchange between the camera callbacks and the main loop
+from sir_code.frame_exchange import LatestValue
+
 
 class NaoCameraDemo(SICApplication):
     """
@@ -28,7 +31,8 @@ class NaoCameraDemo(SICApplication):
         # Demo-specific initialization
         self.nao_ip = "XXX"
         self.nao = None
-        self.imgs = queue.Queue()
+        # Newest image only, a slow display never blocks the camera
+        self.imgs = LatestValue()
         
         self.set_log_level(sic_logging.INFO)
 
@@ -77,6 +81,7 @@ class NaoCameraDemo(SICApplication):
                     continue
             
             cv2.destroyAllWindows()
+            self.logger.info("Images: {}".format(self.imgs.report()))
             self.logger.info("Camera demo completed")
         except Exception as e:
             self.logger.error("Error: {}".format(e=e))
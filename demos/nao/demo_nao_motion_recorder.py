@@ -9,7 +9,6 @@ from sic_framework.devices.common_naoqi.naoqi_autonomous import NaoRestRequest,
 # Import message types and requests
 from sic_framework.devices.common_naoqi.naoqi_motion_recorder import (
     NaoqiMotionRecorderConf,
-    NaoqiMotionRecording,
     PlayRecording,
     StartRecording,
     StopRecording,
@@ -18,12 +17,17 @@ from sic_framework.devices.common_naoqi.naoqi_stiffness import Stiffness
 
 # Import libraries necessary for the demo
 import time
+from pathlib import Path
+
+# Trimming, smoothing and indexed storage of the recorded gestures
+from sir_code.gestures import GestureStore, process_recording
 
 
 class NaoMotionRecorderDemo(SICApplication):
     """
     NAO motion recorder demo application.
     Demonstrates how to record and replay a motion on a NAO robot.
+    The recording is trimmed to the movement, smoothed and saved in a gesture store with an index of all gestures.
     """
     
     def __init__(self):
@@ -33,6 +37,7 @@ class NaoMotionRecorderDemo(SICApplication):
         # Demo-specific initialization
         self.nao_ip = "XXX"
         self.motion_name = "motion_recorder_demo"
+        self.gestures = GestureStore(Path("gestures"))
         self.record_time = 10
         self.nao = None
         self.chain = ["LArm", "RArm"]
@@ -69,14 +74,17 @@ class NaoMotionRecorderDemo(SICApplication):
             # Save the recording
             self.logger.info("Saving action")
             recording = self.nao.motion_record.request(StopRecording())
-            recording.save(self.motion_name)
+            gesture = process_recording(self.motion_name, recording)
+            self.gestures.save(gesture)
+            self.logger.info("Saved {}: {}s after trimming, moving {}".format(
+                self.motion_name, gesture.duration, self.gestures.index[self.motion_name]["moving_joints"]))
             
             # Replay the recording
             self.logger.info("Replaying action")
             self.nao.stiffness.request(
                 Stiffness(stiffness=0.7, joints=self.chain)
             )  # Enable stiffness for replay
-            recording = NaoqiMotionRecording.load(self.motion_name)
+            recording = self.gestures.load(self.motion_name).to_recording()
             self.nao.motion_record.request(PlayRecording(recording))
 
             # always end with a rest, whenever you reach the end of your code
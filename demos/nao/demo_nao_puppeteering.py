@@ -12,6 +12,7 @@ from sic_framework.devices.common_naoqi.naoqi_autonomous import (
     NaoRestRequest,
 )
 from sic_framework.devices.common_naoqi.nao_motion_streamer import (
+    NaoJointAngles,
     NaoMotionStreamerConf,
     StartStreaming,
     StopStreaming,
@@ -22,17 +23,34 @@ from sic_framework.devices.common_naoqi.naoqi_text_to_speech import (
 )
 
 # Import libraries necessary for the demo
+import threading
 import time
 
+# Prediction of the master's motion, and driving several puppets from one master
+from sir_code.frame_exchange import RedisClock, message_stamp
+from sir_code.motion_fanout import MotionFanout, mirror_map, sic_payload, sic_publisher
+from sir_code.motion_predictor import JointPredictor
+
 
 class NaoPupeteeringDemo(SICApplication):
     """
     NAO puppeteering demo application.
     Demonstrates how to control one NAO robot by moving another NAO robot's joints.
     Requires two NAO robots.
+
+    With predict=True the joint angles go through this application instead of straight from the puppet master to
+    the puppet, which is commanded with the angles extrapolated by a JointPredictor to where the master will be once
+    the command is executed, compensating the network and actuation delay. The streamed angles carry no sample time,
+    so they are stamped on arrival and the delay from the master to this application is the configured
+    network_delay.
+
+    With extra_puppets, a list of (ip, max samples per second or None, mirrored), the master drives all the puppets:
+    a MotionFanout builds and serializes each sample once per joint mapping and publishes it to every puppet at its
+    own rate, instead of each puppet's send_message stamping and serializing it again. With predict=True as well,
+    the fan-out sends the predicted angles instead of the samples of the master.
     """
     
-    def __init__(self):
+    def __init__(self, predict=False, extra_puppets=None):
         # Call parent constructor (handles singleton initialization)
         super(NaoPupeteeringDemo, self).__init__()
         
@@ -46,6 +64,18 @@ class NaoPupeteeringDemo(SICApplication):
         self.puppet_motion = None
         self.JOINTS = ["Head", "RArm", "LArm"]
         self.FIXED_JOINTS = ["RLeg", "LLeg"]
+        self.samples_per_second = 30
+        self.predict = predict
+        # Delay from a sample of the master to its arrival here, and the time the puppet takes to reach a
+        # commanded angle: the samples are stamped on arrival, so both are added to the prediction horizon
+        self.network_delay = 0.05
+        self.actuation_delay = 0.1
+        self.predictor = JointPredictor(max_horizon=0.15)
+        self.playout_thread = None
+        self.extra_puppets = extra_puppets or []
+        self.puppets = []
+        # stamped on the clock of the redis server, as send_message would
+        self.fanout = MotionFanout(serialize=sic_payload(NaoJointAngles, RedisClock(self.get_redis_instance())))
 
         self.set_log_level(sic_logging.INFO)
         
@@ -59,7 +89,7 @@ class NaoPupeteeringDemo(SICApplication):
         self.logger.info("Starting NAO Puppeteering Demo...")
         
         self.logger.info("Initializing puppet master...")
-        conf = NaoMotionStreamerConf(samples_per_second=30)
+        conf = NaoMotionStreamerConf(samples_per_second=self.samples_per_second)
         self.puppet_master = Nao(self.puppet_master_ip, motion_stream_conf=conf)
         self.puppet_master.autonomous.request(NaoBasicAwarenessRequest(False))
         self.puppet_master.autonomous.request(NaoBackgroundMovingRequest(False))
@@ -67,28 +97,89 @@ class NaoPupeteeringDemo(SICApplication):
         self.puppet_master_motion = self.puppet_master.motion_streaming()
         
         self.logger.info("Initializing puppet...")
-        self.puppet = Nao(self.puppet_ip)
-        self.puppet.autonomous.request(NaoBasicAwarenessRequest(False))
-        self.puppet.autonomous.request(NaoBackgroundMovingRequest(False))
-        self.puppet.stiffness.request(Stiffness(0.5, joints=self.JOINTS))
-        self.puppet_motion = self.puppet.motion_streaming(input_source=self.puppet_master_motion)
+        self.puppet = self.setup_puppet(self.puppet_ip)
+        if self.extra_puppets:
+            # one stream of the master (or of the predicted angles, see play_out), sent to every puppet by the fan-out
+            self.puppet_motion = self.puppet.motion_streaming()
+            self.fanout.add(self.puppet_ip, sic_publisher(self.puppet_motion))
+            for ip, max_rate, mirrored in self.extra_puppets:
+                puppet_motion = self.setup_puppet(ip).motion_streaming()
+                self.fanout.add(ip, sic_publisher(puppet_motion), max_rate, mirror_map() if mirrored else None)
+            if self.predict:
+                self.puppet_master_motion.register_callback(self.on_joint_angles)
+            else:
+                self.puppet_master_motion.register_callback(self.on_joint_angles_fanout)
+        elif self.predict:
+            self.puppet_motion = self.puppet.motion_streaming()
+            self.puppet_master_motion.register_callback(self.on_joint_angles)
+        else:
+            self.puppet_motion = self.puppet.motion_streaming(input_source=self.puppet_master_motion)
         
         self.logger.info("Setting fixed joints to high stiffness...")
         # Set fixed joints to high stiffness such that the robots don't fall
         self.puppet_master.stiffness.request(Stiffness(0.7, joints=self.FIXED_JOINTS))
-        self.puppet.stiffness.request(Stiffness(0.7, joints=self.FIXED_JOINTS))
-    
+        for puppet in self.puppets:
+            puppet.stiffness.request(Stiffness(0.7, joints=self.FIXED_JOINTS))
+
+    def setup_puppet(self, ip):
+        """Initialize a puppet NAO robot."""
+        puppet = Nao(ip)
+        puppet.autonomous.request(NaoBasicAwarenessRequest(False))
+        puppet.autonomous.request(NaoBackgroundMovingRequest(False))
+        puppet.stiffness.request(Stiffness(0.5, joints=self.JOINTS))
+        self.puppets.append(puppet)
+        return puppet
+
+    def on_joint_angles_fanout(self, message):
+        """
+        Callback function for the joint angles of the puppet master with several puppets.
+
+        Args:
+            message: The NaoJointAngles message of the puppet master.
+
+        Returns:
+            None
+        """
+        self.fanout.publish(message.joints, message.angles, message_stamp(message))
+
+    def on_joint_angles(self, message):
+        """
+        Callback function for the joint angles of the puppet master with prediction.
+
+        Args:
+            message: The NaoJointAngles message of the puppet master.
+
+        Returns:
+            None
+        """
+        self.predictor.update(message.joints, message.angles, message_stamp(message))
+
+    def play_out(self):
+        """Sends the predicted joint angles to the puppet, through the fan-out with several, at the streaming rate."""
+        while not self.shutdown_event.is_set():
+            angles = self.predictor.predict(time.time() + self.network_delay + self.actuation_delay)
+            joints = self.predictor.joints
+            if angles is not None and self.extra_puppets:
+                self.fanout.publish(joints, angles)
+            elif angles is not None:
+                self.puppet_motion.send_message(NaoJointAngles(joints, angles))
+            time.sleep(1 / float(self.samples_per_second))
+
     def run(self):
         """Main application logic."""
         try:
-            self.logger.info("Starting both robots in rest pose...")
-            # Start both robots in rest pose
-            self.puppet.autonomous.request(NaoRestRequest())
+            self.logger.info("Starting the robots in rest pose...")
+            # Start the robots in rest pose
+            for puppet in self.puppets:
+                puppet.autonomous.request(NaoRestRequest())
             self.puppet_master.autonomous.request(NaoRestRequest())
             
             self.logger.info("Starting puppeteering...")
             # Start the puppeteering and let Nao say that you can start
             self.puppet_master_motion.request(StartStreaming(self.JOINTS))
+            if self.predict:
+                self.playout_thread = threading.Thread(target=self.play_out, daemon=True)
+                self.playout_thread.start()
             self.puppet_master.tts.request(
                 NaoqiTextToSpeechRequest("Start puppeteering", language="English", animated=True)
             )
@@ -105,9 +196,14 @@ class NaoPupeteeringDemo(SICApplication):
             )
             self.puppet_master.stiffness.request(Stiffness(0.7, joints=self.JOINTS))
             self.puppet_master_motion.request(StopStreaming())
+            if self.predict:
+                self.logger.info("Motion prediction: {}".format(self.predictor.report()))
+            if self.extra_puppets:
+                self.logger.info("Motion fan-out: {}".format(self.fanout.report()))
             
-            # Set both robots in rest pose again
-            self.puppet.autonomous.request(NaoRestRequest())
+            # Set the robots in rest pose again
+            for puppet in self.puppets:
+                puppet.autonomous.request(NaoRestRequest())
             self.puppet_master.autonomous.request(NaoRestRequest())
             
             self.logger.info("Puppeteering demo completed successfully")
@@ -120,4 +216,8 @@ class NaoPupeteeringDemo(SICApplication):
 if __name__ == "__main__":
     # Create and run the demo
     demo = NaoPupeteeringDemo()
+    # or, compensating the lag of the puppet
+    # demo = NaoPupeteeringDemo(predict=True)
+    # or, driving a second puppet mirroring the master at 15 samples per second
+    # demo = NaoPupeteeringDemo(extra_puppets=[("XXX", 15, True)])
     demo.run()
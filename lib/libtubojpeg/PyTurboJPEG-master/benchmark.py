@@ -0,0 +1,211 @@
+# -*- coding: UTF-8 -*-
+"""Benchmarks of the PyTurboJPEG wrapper on camera sized frames.
+
+usage: python benchmark.py [--lib PATH] [--frames N] [--width W] [--height H] [--batch N] [BENCHMARK ...]
+"""
+
+import argparse
+import os
+import time
+import tracemalloc
+
+import numpy as np
+
+from turbojpeg import TurboJPEG, FrameBufferRing, TJSAMP_422
+
+CAMERA_FPS = 30
+
+
+def make_frame(width, height, seed=0):
+    """returns a BGR frame with smooth content and some noise, compressing like a camera image"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    frame = np.stack([
+        (x * 255 // max(width - 1, 1)),
+        (y * 255 // max(height - 1, 1)),
+        ((x + y) * 127 // max(width + height - 2, 1))
+    ], axis=-1).astype(np.int16)
+    frame += rng.integers(-12, 12, frame.shape, dtype=np.int16)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+
+def timeit(function, frames):
+    """returns the mean time per call in seconds"""
+    function()  # warm up
+    start = time.perf_counter()
+    for _ in range(frames):
+        function()
+    return (time.perf_counter() - start) / frames
+
+
+def report(name, seconds, baseline=None):
+    line = '{:<34}{:>10.1f} us/frame {:>6.2f}% of a {} fps frame'.format(
+        name, seconds * 1e6, seconds * CAMERA_FPS * 100, CAMERA_FPS)
+    if baseline is not None:
+        line += '  ({:.2f}x)'.format(baseline / seconds)
+    print(line)
+
+
+def bench_handles(args, jpeg_buf):
+    """per-call init/destroy of the TurboJPEG handles versus per-thread reuse"""
+    fresh = TurboJPEG(args.lib, reuse_handles=False)
+    reused = TurboJPEG(args.lib, reuse_handles=True)
+    for name, call in [
+        ('decode', lambda jpeg: jpeg.decode(jpeg_buf)),
+        ('decode_header', lambda jpeg: jpeg.decode_header(jpeg_buf)),
+        ('decode 1/4', lambda jpeg: jpeg.decode(jpeg_buf, scaling_factor=(1, 4))),
+        ('crop 64x64', lambda jpeg: jpeg.crop(jpeg_buf, 64, 64, 64, 64)),
+    ]:
+        baseline = timeit(lambda: call(fresh), args.frames)
+        report(name + ' (init/destroy)', baseline)
+        report(name + ' (reused handles)', timeit(lambda: call(reused), args.frames), baseline)
+
+
+def allocated_per_call(function, calls=20):
+    """returns the bytes allocated per call, as seen by tracemalloc"""
+    function()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        results = [function() for _ in range(calls)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    del results
+    return sum(stat.size_diff for stat in after.compare_to(before, 'filename')) / calls
+
+
+def bench_out(args, jpeg_buf):
+    """decoding into a fresh array per frame versus a ring of reusable frame buffers"""
+    jpeg = TurboJPEG(args.lib)
+    ring = FrameBufferRing(3)
+    planes = [plane.copy() for plane in jpeg.decode_to_yuv_planes(jpeg_buf)]
+    for name, call in [
+        ('decode', lambda: jpeg.decode(jpeg_buf)),
+        ('decode out=ring', lambda: jpeg.decode(jpeg_buf, out=ring)),
+        ('decode_to_yuv_planes', lambda: jpeg.decode_to_yuv_planes(jpeg_buf)),
+        ('decode_to_yuv_planes out=planes', lambda: jpeg.decode_to_yuv_planes(jpeg_buf, out=planes)),
+    ]:
+        report(name, timeit(call, args.frames))
+        print('{:<34}{:>10.0f} bytes allocated/frame'.format('', allocated_per_call(call)))
+
+
+def bench_encode(args, jpeg_buf):
+    """encoding to bytes versus in place into a reusable destination buffer"""
+    jpeg = TurboJPEG(args.lib)
+    frame = make_frame(args.width, args.height)
+    ring = FrameBufferRing(3)
+    dest = np.empty(jpeg.buffer_size(args.width, args.height), dtype=np.uint8)
+    assert bytes(jpeg.encode(frame, out=dest)) == jpeg.encode(frame)
+    yuv, _ = jpeg.decode_to_yuv(jpeg_buf)
+    yuv_dest = np.empty(jpeg.buffer_size(args.width, args.height, TJSAMP_422), dtype=np.uint8)
+    for name, call in [
+        ('encode', lambda: jpeg.encode(frame)),
+        ('encode out=ring', lambda: jpeg.encode(frame, out=ring)),
+        ('encode out=array', lambda: jpeg.encode(frame, out=dest)),
+        ('encode_from_yuv', lambda: jpeg.encode_from_yuv(
+            yuv, args.height, args.width, jpeg_subsample=TJSAMP_422)),
+        ('encode_from_yuv out=array', lambda: jpeg.encode_from_yuv(
+            yuv, args.height, args.width, jpeg_subsample=TJSAMP_422, out=yuv_dest)),
+    ]:
+        report(name, timeit(call, args.frames))
+        print('{:<34}{:>10.0f} bytes allocated/frame'.format('', allocated_per_call(call)))
+
+
+def bench_batch(args, jpeg_buf):
+    """serial decode of a batch of frames versus decode_batch on a thread pool"""
+    jpeg = TurboJPEG(args.lib)
+    jpeg_bufs = [jpeg.encode(make_frame(args.width, args.height, seed)) for seed in range(args.batch)]
+    batch = jpeg.decode_batch(jpeg_bufs)
+    assert all(np.array_equal(batch[i], jpeg.decode(jpeg_buf)) for i, jpeg_buf in enumerate(jpeg_bufs))
+    print('{} frames per batch, {} CPUs'.format(args.batch, os.cpu_count()))
+    frames = max(args.frames // args.batch, 1)
+    ring = FrameBufferRing(2)
+    baseline = timeit(lambda: [jpeg.decode(jpeg_buf) for jpeg_buf in jpeg_bufs], frames) / args.batch
+    report('decode (serial)', baseline)
+    report('decode_batch', timeit(lambda: jpeg.decode_batch(jpeg_bufs), frames) / args.batch, baseline)
+    report('decode_batch out=ring', timeit(lambda: jpeg.decode_batch(jpeg_bufs, out=ring), frames) / args.batch,
+           baseline)
+
+
+def bench_scaled(args, jpeg_buf):
+    """full size decode and resize versus decode_for_detection at detector resolutions"""
+    jpeg = TurboJPEG(args.lib)
+    baseline = timeit(lambda: jpeg.decode(jpeg_buf), args.frames)
+    report('decode (full size)', baseline)
+    for min_width, min_height in [(args.width // 2, args.height // 2), (160, 120), (80, 60)]:
+        img, scaling_factor = jpeg.decode_for_detection(jpeg_buf, min_width, min_height)
+        name = 'for {}x{}: {}x{} ({}/{})'.format(
+            min_width, min_height, img.shape[1], img.shape[0], *scaling_factor)
+        report(name, timeit(lambda: jpeg.decode_for_detection(jpeg_buf, min_width, min_height), args.frames),
+               baseline)
+
+
+def bench_crops(args, jpeg_buf):
+    """crop_multiple of many regions, extended past the image borders or not"""
+    jpeg = TurboJPEG(args.lib)
+    size = 128
+    inside = [(x, y, size, size) for x in range(0, args.width - size + 1, 64)
+              for y in range(0, args.height - size + 1, 64)]
+    # regions at the origin sticking out of the right or bottom border, filled with background
+    extended = [(0, 0, args.width + 64 * (1 + i % 4), 64 * (1 + i // 4)) for i in range(8)] + \
+        [(0, 0, 64 * (1 + i // 4), args.height + 64 * (1 + i % 4)) for i in range(8)]
+    print('{} regions of {}x{} inside, {} extended regions'.format(len(inside), size, size, len(extended)))
+    baseline = timeit(lambda: jpeg.crop_multiple(jpeg_buf, inside), args.frames)
+    report('crop_multiple inside', baseline)
+    report('crop_multiple extended, gray bg', timeit(
+        lambda: jpeg.crop_multiple(jpeg_buf, extended, background_luminance=0.5), args.frames), baseline)
+    report('crop_multiple extended, white bg', timeit(
+        lambda: jpeg.crop_multiple(jpeg_buf, extended), args.frames), baseline)
+
+
+def bench_header(args, jpeg_buf):
+    """header parsing on every call versus the header cache of a stream"""
+    uncached = TurboJPEG(args.lib, header_cache_size=0)
+    cached = TurboJPEG(args.lib)
+    regions = [(0, 0, args.width + 64, 64), (64, 64, 128, 128)]
+    for name, call in [
+        ('decode_header', lambda jpeg: jpeg.decode_header(jpeg_buf)),
+        ('crop 64x64', lambda jpeg: jpeg.crop(jpeg_buf, 64, 64, 64, 64)),
+        ('crop_multiple, white bg', lambda jpeg: jpeg.crop_multiple(jpeg_buf, regions)),
+    ]:
+        baseline = timeit(lambda: call(uncached), args.frames)
+        report(name + ' (parsed)', baseline)
+        report(name + ' (cached)', timeit(lambda: call(cached), args.frames), baseline)
+    print('header cache: {} hits, {} misses'.format(cached.header_cache.hits, cached.header_cache.misses))
+
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'crops': bench_crops,
+    'header': bench_header,
+    'encode': bench_encode,
+    'handles': bench_handles,
+    'out': bench_out,
+    'scaled': bench_scaled,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='one of {}, all by default'.format(', '.join(sorted(BENCHMARKS))))
+    parser.add_argument('--lib', default=None, help='path of the turbojpeg library')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--batch', type=int, default=8, help='frames per batch')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark {!r}'.format(name))
+
+    jpeg_buf = TurboJPEG(args.lib).encode(make_frame(args.width, args.height))
+    print('{}x{} frame, {} bytes'.format(args.width, args.height, len(jpeg_buf)))
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print('\n== {} =='.format(name))
+        BENCHMARKS[name](args, jpeg_buf)
+
+
+if __name__ == '__main__':
+    main()
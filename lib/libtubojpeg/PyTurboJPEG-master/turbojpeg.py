@@ -32,6 +32,9 @@ import numpy as np
 import math
 import warnings
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from struct import unpack, calcsize
 
 # default libTurboJPEG library path
@@ -139,7 +142,9 @@ tjMCUHeight = [8, 8, 16, 8, 16, 8]
 
 # miscellaneous flags
 # see details in https://github.com/libjpeg-turbo/libjpeg-turbo/blob/master/turbojpeg.h
-# note: TJFLAG_NOREALLOC cannot be supported due to reallocation is needed by PyTurboJPEG.
+# note: TJFLAG_NOREALLOC is only set by encode(..., out=...) and encode_from_yuv(..., out=...),
+# the other calls let libjpeg-turbo allocate the output.
+TJFLAG_NOREALLOC = 1024
 TJFLAG_BOTTOMUP = 2
 TJFLAG_FASTUPSAMPLE = 256
 TJFLAG_FASTDCT = 2048
@@ -226,24 +231,11 @@ def fill_background(coeffs_ptr, arrayRegion, planeRegion, componentID, transform
 
     # Only modify luminance data, so we dont need to worry about subsampling
     if componentID == 0:
-        coeff_array_size = arrayRegion.w * arrayRegion.h
-        # Read the coefficients in the pointer as a np array (no copy)
-        ArrayType = c_short*coeff_array_size
-        array_pointer = cast(coeffs_ptr, POINTER(ArrayType))
-        coeffs = np.frombuffer(array_pointer.contents, dtype=np.int16)
-        coeffs.shape = (
-            arrayRegion.h//MCU_WIDTH,
-            arrayRegion.w//MCU_HEIGHT,
-            MCU_SIZE
-        )
-
-        # Cast the content of the transform pointer into a transform structure
-        transform = cast(transform_ptr, POINTER(TransformStruct)).contents
-        # Cast the content of the callback data pointer in the transform
-        # structure to a background structure
+        # Cast the content of the transform pointer into a transform structure,
+        # its data field points to the background structure
         background_data = cast(
-            transform.data, POINTER(BackgroundStruct)
-        ).contents
+            transform_ptr, POINTER(TransformStruct)
+        ).contents.data.contents
 
         # The coeff array is typically just one MCU heigh, but it is up to the
         # libjpeg implementation how to do it. The part of the coeff array that
@@ -251,22 +243,14 @@ def fill_background(coeffs_ptr, arrayRegion, planeRegion, componentID, transform
         # from the part 'under'. (Most of the time, the coeff array will be
         # either 'left' or 'under', but both could happen). Note that start
         # and end rows defined below can be outside the arrayRegion, but that
-        # the range they then define is of 0 length.
+        # the slices they then define are empty.
 
-        # fill mcus left of image
+        # rows of the mcus left of and under the image
         left_start_row = min(arrayRegion.y, background_data.h) - arrayRegion.y
         left_end_row = (
             min(arrayRegion.y+arrayRegion.h, background_data.h)
             - arrayRegion.y
         )
-        for x in range(background_data.w//MCU_WIDTH, planeRegion.w//MCU_WIDTH):
-            for y in range(
-                left_start_row//MCU_HEIGHT,
-                left_end_row//MCU_HEIGHT
-            ):
-                coeffs[y][x][0] = background_data.lum
-
-        # fill mcus under image
         bottom_start_row = (
             max(arrayRegion.y, background_data.h) - arrayRegion.y
         )
@@ -274,15 +258,156 @@ def fill_background(coeffs_ptr, arrayRegion, planeRegion, componentID, transform
             max(arrayRegion.y+arrayRegion.h, background_data.h)
             - arrayRegion.y
         )
-        for x in range(0, planeRegion.w//MCU_WIDTH):
-            for y in range(
-                bottom_start_row//MCU_HEIGHT,
-                bottom_end_row//MCU_HEIGHT
-            ):
-                coeffs[y][x][0] = background_data.lum
+        fill_left = (left_end_row > left_start_row
+                     and planeRegion.w > background_data.w)
+        fill_under = bottom_end_row > bottom_start_row
+        if not (fill_left or fill_under):
+            return 1
+
+        # View the coefficients in the pointer as a np array (no copy), one
+        # row of MCU blocks of 64 coefficients per MCU row of the region
+        coeffs = np.ctypeslib.as_array(
+            coeffs_ptr,
+            shape=(arrayRegion.h//MCU_HEIGHT, arrayRegion.w//MCU_WIDTH, MCU_SIZE)
+        )
+        # fill the dc coefficient of the mcus left of image
+        if fill_left:
+            coeffs[
+                left_start_row//MCU_HEIGHT:left_end_row//MCU_HEIGHT,
+                background_data.w//MCU_WIDTH:planeRegion.w//MCU_WIDTH,
+                0
+            ] = background_data.lum
+
+        # fill the dc coefficient of the mcus under image
+        if fill_under:
+            coeffs[
+                bottom_start_row//MCU_HEIGHT:bottom_end_row//MCU_HEIGHT,
+                :planeRegion.w//MCU_WIDTH,
+                0
+            ] = background_data.lum
 
     return 1
 
+# one ctypes callback shared by all the transforms, instead of one per region
+FILL_BACKGROUND_FILTER = CUSTOMFILTER(fill_background)
+
+
+class _ThreadHandles(object):
+    """TurboJPEG handles of one thread, created on first use and destroyed
+    together with the thread (or the TurboJPEG instance owning them).
+    """
+    def __init__(self, init_functions, destroy):
+        self.__init_functions = init_functions
+        self.__destroy = destroy
+        self.__handles = {}
+
+    def get(self, kind):
+        handle = self.__handles.get(kind)
+        if handle is None:
+            handle = self.__handles[kind] = self.__init_functions[kind]()
+        return handle
+
+    def __del__(self):
+        for handle in self.__handles.values():
+            self.__destroy(handle)
+        self.__handles.clear()
+
+
+class FrameBufferRing(object):
+    """Ring of reusable output arrays for TurboJPEG.decode(..., out=ring).
+
+    Decoding a stream into a ring allocates nothing per frame once the ring
+    is filled. A buffer is handed out again after `size` more frames, so
+    consumers must be done with a frame (or copy it) by then. Buffers are
+    reallocated when the requested shape changes.
+    """
+    def __init__(self, size=3):
+        if size < 1:
+            raise ValueError('a ring needs at least one buffer')
+        self.size = size
+        self.__buffers = []
+        self.__next = 0
+        self.__lock = threading.Lock()
+
+    def next(self, shape, dtype=np.uint8):
+        """returns the next buffer of the ring with the given shape"""
+        shape = tuple(shape)
+        with self.__lock:
+            i = self.__next
+            self.__next = (i + 1) % self.size
+            if i == len(self.__buffers):
+                self.__buffers.append(np.empty(shape, dtype=dtype))
+            elif self.__buffers[i].shape != shape or self.__buffers[i].dtype != dtype:
+                self.__buffers[i] = np.empty(shape, dtype=dtype)
+            return self.__buffers[i]
+
+
+class HeaderCache(object):
+    """LRU cache of parsed JPEG headers.
+
+    Frames of a camera stream share their header segment (the markers from
+    SOI up to the first SOS: quantization and Huffman tables, dimensions,
+    subsampling), so the segment itself is the key and the header of a
+    repeated frame is looked up instead of being parsed again.
+    """
+    def __init__(self, size=16):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def header_segment(jpeg_array):
+        """returns the bytes from SOI to the end of the first SOS marker
+           segment of a uint8 array, or None if they cannot be walked.
+        """
+        data = memoryview(jpeg_array)
+        size = len(data)
+        if size < 4 or data[0] != 0xFF or data[1] != 0xD8:
+            return None
+        offset = 2
+        while offset + 4 <= size:
+            if data[offset] != 0xFF:
+                return None
+            marker = data[offset + 1]
+            if marker == 0xFF:
+                # fill byte
+                offset += 1
+                continue
+            if 0xD0 <= marker <= 0xD7 or marker == 0x01:
+                # markers without a segment
+                offset += 2
+                continue
+            offset += 2 + (data[offset + 2] << 8 | data[offset + 3])
+            if marker == 0xDA:
+                return data[:offset].tobytes() if offset <= size else None
+        return None
+
+    def get(self, key, name):
+        """returns the cached value of name for a header segment, or None"""
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None or name not in entry:
+                self.misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return entry[name]
+
+    def put(self, key, name, value):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                entry = self.__entries[key] = {}
+                if len(self.__entries) > self.size:
+                    self.__entries.popitem(last=False)
+            entry[name] = value
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
 
 def split_byte_into_nibbles(value):
     """Split byte int into 2 nibbles (4 bits)."""
@@ -293,7 +418,7 @@ def split_byte_into_nibbles(value):
 
 class TurboJPEG(object):
     """A Python wrapper of libjpeg-turbo for decoding and encoding JPEG image."""
-    def __init__(self, lib_path=None):
+    def __init__(self, lib_path=None, reuse_handles=True, header_cache_size=16):
         turbo_jpeg = cdll.LoadLibrary(
             self.__find_turbojpeg() if lib_path is None else lib_path)
         self.__init_decompress = turbo_jpeg.tjInitDecompress
@@ -378,56 +503,155 @@ class TurboJPEG(object):
             for i in range(num_scaling_factors.value)
         )
 
+        # handles are kept per thread and reused across calls instead of
+        # being initialized and destroyed for every image
+        self.__reuse_handles = reuse_handles
+        self.__init_functions = {
+            'decompress': self.__init_decompress,
+            'compress': self.__init_compress,
+            'transform': self.__init_transform
+        }
+        self.__thread_handles = threading.local()
+        self.__pool = None
+        self.__pool_lock = threading.Lock()
+        # parsed headers of recent frames, a stream repeats the same header
+        self.__header_cache = HeaderCache(header_cache_size) if header_cache_size > 0 else None
+
     def decode_header(self, jpeg_buf):
         """decodes JPEG header and returns image properties as a tuple.
            e.g. (width, height, jpeg_subsample, jpeg_colorspace)
         """
-        handle = self.__init_decompress()
+        handle = self.__acquire_handle('decompress')
         try:
-            width = c_int()
-            height = c_int()
-            jpeg_subsample = c_int()
-            jpeg_colorspace = c_int()
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
-            src_addr = self.__getaddr(jpeg_array)
-            status = self.__decompress_header(
-                handle, src_addr, jpeg_array.size, byref(width), byref(height),
-                byref(jpeg_subsample), byref(jpeg_colorspace))
-            if status != 0:
-                self.__report_error(handle)
-            return (width.value, height.value, jpeg_subsample.value, jpeg_colorspace.value)
+            return self.__read_header(handle, jpeg_array)
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
 
-    def decode(self, jpeg_buf, pixel_format=TJPF_BGR, scaling_factor=None, flags=0):
-        """decodes JPEG memory buffer to numpy array."""
-        handle = self.__init_decompress()
+    def decode(self, jpeg_buf, pixel_format=TJPF_BGR, scaling_factor=None, flags=0, out=None):
+        """decodes JPEG memory buffer to numpy array.
+           out can be a preallocated (height, width, channels) uint8 array,
+           rows may be padded, or a FrameBufferRing to take the array from.
+        """
+        handle = self.__acquire_handle('decompress')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
             scaled_width, scaled_height, _, _ = \
-                self.__get_header_and_dimensions(handle, jpeg_array.size, src_addr, scaling_factor)
-            img_array = np.empty(
-                [scaled_height, scaled_width, tjPixelSize[pixel_format]],
-                dtype=np.uint8)
+                self.__get_header_and_dimensions(handle, jpeg_array, src_addr, scaling_factor)
+            shape = (scaled_height, scaled_width, tjPixelSize[pixel_format])
+            if out is None:
+                img_array = np.empty(shape, dtype=np.uint8)
+            elif isinstance(out, FrameBufferRing):
+                img_array = out.next(shape)
+            else:
+                img_array = out
+                self.__check_output_array(img_array, shape)
             dest_addr = self.__getaddr(img_array)
             status = self.__decompress(
                 handle, src_addr, jpeg_array.size, dest_addr, scaled_width,
-                0, scaled_height, pixel_format, flags)
+                img_array.strides[0], scaled_height, pixel_format, flags)
             if status != 0:
                 self.__report_error(handle)
             return img_array
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
+
+    def decode_batch(self, jpeg_bufs, pixel_format=TJPF_BGR, scaling_factor=None, flags=0, out=None,
+                     executor=None):
+        """Decodes JPEG memory buffers of the same dimensions in parallel.
+
+        The decoder releases the GIL, so the images are decoded concurrently
+        by a thread pool, each thread reusing its own handle, straight into
+        their slice of one stacked array.
+
+        Parameters
+        ----------
+        jpeg_bufs: Sequence[bytes]
+            Input jpeg images, all with the dimensions of the first one.
+        out: Optional[Union[numpy.ndarray, FrameBufferRing]]
+            Preallocated (N, height, width, channels) uint8 array with
+            packed images, or a FrameBufferRing to take it from.
+        executor: Optional[concurrent.futures.Executor]
+            Executor running the decodes, defaults to a pool of one thread
+            per CPU shared by the calls of this instance.
+
+        Returns
+        ----------
+        numpy.ndarray
+            The (N, height, width, channels) decoded images.
+        """
+        if not jpeg_bufs:
+            raise ValueError('Expected at least one JPEG buffer')
+        width, height, _, _ = self.decode_header(jpeg_bufs[0])
+        if scaling_factor is not None:
+            width = (width * scaling_factor[0] + scaling_factor[1] - 1) // scaling_factor[1]
+            height = (height * scaling_factor[0] + scaling_factor[1] - 1) // scaling_factor[1]
+        shape = (len(jpeg_bufs), height, width, tjPixelSize[pixel_format])
+        if out is None:
+            batch = np.empty(shape, dtype=np.uint8)
+        elif isinstance(out, FrameBufferRing):
+            batch = out.next(shape)
+        else:
+            batch = out
+            if not isinstance(batch, np.ndarray) or batch.shape != shape:
+                raise ValueError('Invalid output shape {}, expected {}'.format(
+                    getattr(batch, 'shape', None), shape))
+
+        def decode(i):
+            self.decode(jpeg_bufs[i], pixel_format, scaling_factor, flags, out=batch[i])
+
+        if len(jpeg_bufs) == 1:
+            decode(0)
+        else:
+            # list() waits for all the images and raises the first error
+            list((executor or self.__default_pool()).map(decode, range(len(jpeg_bufs))))
+        return batch
+
+    def pick_scaling_factor(self, width, height, min_width, min_height):
+        """Returns the supported scaling factor that shrinks a width x height
+        image the most while keeping it at least min_width x min_height, or
+        (1, 1) when the image is not larger than that.
+        """
+        best = (1, 1)
+        for num, denom in self.__scaling_factors:
+            if num * best[1] >= best[0] * denom:
+                continue
+            if (width * num + denom - 1) // denom >= min_width and \
+                    (height * num + denom - 1) // denom >= min_height:
+                best = (num, denom)
+        return best
+
+    def decode_for_detection(self, jpeg_buf, min_width, min_height, pixel_format=TJPF_BGR, flags=0, out=None):
+        """Decodes a JPEG image at the lowest resolution that is still at
+        least min_width x min_height.
+
+        The image is scaled down in the DCT domain (e.g. 1/2, 1/4, 1/8),
+        which skips most of the inverse DCT and color conversion work
+        instead of decoding at full size and resizing afterwards. The
+        result can be slightly larger than requested, detectors resizing
+        their input anyway.
+
+        Returns
+        ----------
+        Tuple[numpy.ndarray, Tuple[int, int]]
+            The decoded image and the scaling factor used, to map the
+            detections back to the full size image.
+        """
+        width, height, _, _ = self.decode_header(jpeg_buf)
+        scaling_factor = self.pick_scaling_factor(width, height, min_width, min_height)
+        img_array = self.decode(jpeg_buf, pixel_format,
+                                None if scaling_factor == (1, 1) else scaling_factor, flags, out=out)
+        return img_array, scaling_factor
 
     def decode_to_yuv(self, jpeg_buf, scaling_factor=None, pad=4, flags=0):
         """decodes JPEG memory buffer to yuv array."""
-        handle = self.__init_decompress()
+        handle = self.__acquire_handle('decompress')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
             scaled_width, scaled_height, jpeg_subsample, _ = \
-                self.__get_header_and_dimensions(handle, jpeg_array.size, src_addr, scaling_factor)
+                self.__get_header_and_dimensions(handle, jpeg_array, src_addr, scaling_factor)
             buffer_size = self.__buffer_size_YUV2(scaled_width, pad, scaled_height, jpeg_subsample)
             buffer_array = np.empty(buffer_size, dtype=np.uint8)
             dest_addr = self.__getaddr(buffer_array)
@@ -445,23 +669,36 @@ class TurboJPEG(object):
                         self.__plane_width(i, scaled_width, jpeg_subsample)))
             return buffer_array, plane_sizes
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
 
-    def decode_to_yuv_planes(self, jpeg_buf, scaling_factor=None, strides=(0, 0, 0), flags=0):
-        """decodes JPEG memory buffer to yuv planes."""
-        handle = self.__init_decompress()
+    def decode_to_yuv_planes(self, jpeg_buf, scaling_factor=None, strides=(0, 0, 0), flags=0, out=None):
+        """decodes JPEG memory buffer to yuv planes.
+           out can be a list of preallocated 2D uint8 planes (1 for grayscale,
+           3 otherwise), their row strides are used instead of strides.
+        """
+        handle = self.__acquire_handle('decompress')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
             scaled_width, scaled_height, jpeg_subsample, _ = \
-                self.__get_header_and_dimensions(handle, jpeg_array.size, src_addr, scaling_factor)
+                self.__get_header_and_dimensions(handle, jpeg_array, src_addr, scaling_factor)
             num_planes = 3
             if jpeg_subsample == TJSAMP_GRAY:
                 num_planes = 1
             strides_addr = (c_int * num_planes)()
             dest_addr = (POINTER(c_ubyte) * num_planes)()
             planes = list()
+            if out is not None and len(out) != num_planes:
+                raise ValueError('Expected {} output planes, got {}'.format(num_planes, len(out)))
             for i in range(num_planes):
+                if out is not None:
+                    plane_height = self.__plane_height(i, scaled_height, jpeg_subsample)
+                    plane_width = self.__plane_width(i, scaled_width, jpeg_subsample)
+                    self.__check_output_array(out[i], (plane_height, plane_width), padded_width=True)
+                    strides_addr[i] = out[i].strides[0]
+                    planes.append(out[i])
+                    dest_addr[i] = self.__getaddr(planes[i])
+                    continue
                 if strides[i] == 0:
                     strides_addr[i] = self.__plane_width(i, scaled_width, jpeg_subsample)
                 else:
@@ -475,58 +712,63 @@ class TurboJPEG(object):
                 self.__report_error(handle)
             return planes
         finally:
-            self.__destroy(handle)
-
-    def encode(self, img_array, quality=85, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_422, flags=0):
-        """encodes numpy array to JPEG memory buffer."""
-        handle = self.__init_compress()
+            self.__release_handle(handle)
+
+    def encode(self, img_array, quality=85, pixel_format=TJPF_BGR, jpeg_subsample=TJSAMP_422, flags=0, out=None):
+        """encodes numpy array to JPEG memory buffer.
+           out can be a writable buffer of at least buffer_size(width, height,
+           jpeg_subsample) bytes, or a FrameBufferRing to take it from; the
+           JPEG is then written in place and a uint8 view of it is returned
+           instead of bytes.
+        """
+        handle = self.__acquire_handle('compress')
         try:
-            jpeg_buf = c_void_p()
-            jpeg_size = c_ulong()
             height, width = img_array.shape[:2]
             channel = tjPixelSize[pixel_format]
             if channel > 1 and (len(img_array.shape) < 3 or img_array.shape[2] != channel):
                 raise ValueError('Invalid shape for image data')
+            dest_array, jpeg_buf, jpeg_size, flags = self.__encode_destination(
+                out, width, height, jpeg_subsample, flags)
             src_addr = self.__getaddr(img_array)
             status = self.__compress(
                 handle, src_addr, width, img_array.strides[0], height, pixel_format,
                 byref(jpeg_buf), byref(jpeg_size), jpeg_subsample, quality, flags)
             if status != 0:
                 self.__report_error(handle)
-            dest_buf = create_string_buffer(jpeg_size.value)
-            memmove(dest_buf, jpeg_buf.value, jpeg_size.value)
-            self.__free(jpeg_buf)
-            return dest_buf.raw
+            return self.__encode_result(dest_array, jpeg_buf, jpeg_size)
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
 
-    def encode_from_yuv(self, img_array, height, width, quality=85, jpeg_subsample=TJSAMP_420, flags=0):
-        """encodes numpy array to JPEG memory buffer."""
-        handle = self.__init_compress()
+    def encode_from_yuv(self, img_array, height, width, quality=85, jpeg_subsample=TJSAMP_420, flags=0, out=None):
+        """encodes numpy array to JPEG memory buffer.
+           out works as in encode.
+        """
+        handle = self.__acquire_handle('compress')
         try:
-            jpeg_buf = c_void_p()
-            jpeg_size = c_ulong()
+            dest_array, jpeg_buf, jpeg_size, flags = self.__encode_destination(
+                out, width, height, jpeg_subsample, flags)
             src_addr = self.__getaddr(img_array)
             status = self.__compressFromYUV(
                 handle, src_addr, width, 4, height, jpeg_subsample,
                 byref(jpeg_buf), byref(jpeg_size), quality, flags)
             if status != 0:
                 self.__report_error(handle)
-            dest_buf = create_string_buffer(jpeg_size.value)
-            memmove(dest_buf, jpeg_buf.value, jpeg_size.value)
-            self.__free(jpeg_buf)
-            return dest_buf.raw
+            return self.__encode_result(dest_array, jpeg_buf, jpeg_size)
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
+
+    def buffer_size(self, width, height, jpeg_subsample=TJSAMP_422):
+        """returns the worst case size of a JPEG image, the size needed by encode(..., out=...)"""
+        return self.__buffer_size(width, height, jpeg_subsample)
 
     def scale_with_quality(self, jpeg_buf, scaling_factor=None, quality=85, flags=0):
         """decompresstoYUV with scale factor, recompresstoYUV with quality factor"""
-        handle = self.__init_decompress()
+        handle = self.__acquire_handle('decompress')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
             scaled_width, scaled_height, jpeg_subsample, _ = self.__get_header_and_dimensions(
-                handle, jpeg_array.size, src_addr, scaling_factor)
+                handle, jpeg_array, src_addr, scaling_factor)
             buffer_YUV_size = self.__buffer_size_YUV2(
                 scaled_height, 4, scaled_width, jpeg_subsample)
             img_array = np.empty([buffer_YUV_size])
@@ -535,8 +777,8 @@ class TurboJPEG(object):
                 handle, src_addr, jpeg_array.size, dest_addr, scaled_width, 4, scaled_height, flags)
             if status != 0:
                 self.__report_error(handle)
-            self.__destroy(handle)
-            handle = self.__init_compress()
+            self.__release_handle(handle)
+            handle = self.__acquire_handle('compress')
             jpeg_buf = c_void_p()
             jpeg_size = c_ulong()
             status = self.__compressFromYUV(
@@ -544,32 +786,21 @@ class TurboJPEG(object):
                 byref(jpeg_size), quality, flags)
             if status != 0:
                 self.__report_error(handle)
-            dest_buf = create_string_buffer(jpeg_size.value)
-            memmove(dest_buf, jpeg_buf.value, jpeg_size.value)
-            self.__free(jpeg_buf)
-            return dest_buf.raw
+            return self.__encode_result(None, jpeg_buf, jpeg_size)
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
 
     def crop(self, jpeg_buf, x, y, w, h, preserve=False, gray=False):
         """losslessly crop a jpeg image with optional grayscale"""
-        handle = self.__init_transform()
+        handle = self.__acquire_handle('transform')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
-            width = c_int()
-            height = c_int()
-            jpeg_colorspace = c_int()
-            jpeg_subsample = c_int()
-            status = self.__decompress_header(
-                handle, src_addr, jpeg_array.size, byref(width), byref(height),
-                byref(jpeg_subsample), byref(jpeg_colorspace))
-            if status != 0:
-                self.__report_error(handle)
+            width, height, jpeg_subsample, _ = self.__read_header(handle, jpeg_array)
             x, w = self.__axis_to_image_boundaries(
-                x, w, width.value, preserve, tjMCUWidth[jpeg_subsample.value])
+                x, w, width, preserve, tjMCUWidth[jpeg_subsample])
             y, h = self.__axis_to_image_boundaries(
-                y, h, height.value, preserve, tjMCUHeight[jpeg_subsample.value])
+                y, h, height, preserve, tjMCUHeight[jpeg_subsample])
             dest_array = c_void_p()
             dest_size = c_ulong()
             region = CroppingRegion(x, y, w, h)
@@ -585,7 +816,7 @@ class TurboJPEG(object):
                 self.__report_error(handle)
             return dest_buf.raw
         finally:
-            self.__destroy(handle)
+            self.__release_handle(handle)
 
     def crop_multiple(self, jpeg_buf, crop_parameters, background_luminance=1.0, gray=False):
         """Lossless crop and/or extension operations on jpeg image.
@@ -610,28 +841,13 @@ class TurboJPEG(object):
         List[bytes]
             Cropped and/or extended jpeg images.
         """
-        handle = self.__init_transform()
+        handle = self.__acquire_handle('transform')
         try:
             jpeg_array = np.frombuffer(jpeg_buf, dtype=np.uint8)
             src_addr = self.__getaddr(jpeg_array)
-            image_width = c_int()
-            image_height = c_int()
-            jpeg_subsample = c_int()
-            jpeg_colorspace = c_int()
 
-            # Decompress header to get input image size and subsample value
-            decompress_header_status = self.__decompress_header(
-                handle,
-                src_addr,
-                jpeg_array.size,
-                byref(image_width),
-                byref(image_height),
-                byref(jpeg_subsample),
-                byref(jpeg_colorspace)
-            )
-
-            if decompress_header_status != 0:
-                self.__report_error(handle)
+            # Decompress header to get input image size
+            image_width, image_height, _, _ = self.__read_header(handle, jpeg_array)
 
             # Define cropping regions from input parameters and image size
             crop_regions = self.__define_cropping_regions(crop_parameters)
@@ -639,29 +855,31 @@ class TurboJPEG(object):
 
             # Define crop transforms from cropping_regions
             crop_transforms = (TransformStruct * number_of_operations)()
+            callback_data = None
             for i, crop_region in enumerate(crop_regions):
-                # The fill_background callback is slow, only use it if needed
+                # The fill_background callback is slower, only use it if needed
                 if self.__need_fill_background(
                     crop_region,
-                    (image_width.value, image_height.value),
+                    (image_width, image_height),
                     background_luminance
                 ):
-                    # Use callback to fill in background post-transform
-                    callback_data = BackgroundStruct(
-                        image_width,
-                        image_height,
-                        self.__map_luminance_to_dc_dct_coefficient(
-                            bytearray(jpeg_buf),
-                            background_luminance
+                    # Use callback to fill in background post-transform, the
+                    # background is the same for all the regions
+                    if callback_data is None:
+                        callback_data = BackgroundStruct(
+                            image_width,
+                            image_height,
+                            self.__background_dc_coefficient(
+                                jpeg_array,
+                                background_luminance
+                            )
                         )
-                    )
-                    callback = CUSTOMFILTER(fill_background)
                     crop_transforms[i] = TransformStruct(
                         crop_region,
                         TJXOP_NONE,
                         TJXOPT_PERFECT | TJXOPT_CROP | (gray and TJXOPT_GRAY),
                         pointer(callback_data),
-                        callback
+                        FILL_BACKGROUND_FILTER
                     )
                 else:
                     crop_transforms[i] = TransformStruct(
@@ -703,25 +921,137 @@ class TurboJPEG(object):
             return results
 
         finally:
+            self.__release_handle(handle)
+
+    def __acquire_handle(self, kind):
+        """returns a compress, decompress or transform handle, reused per thread if enabled"""
+        if not self.__reuse_handles:
+            return self.__init_functions[kind]()
+        handles = getattr(self.__thread_handles, 'handles', None)
+        if handles is None:
+            handles = self.__thread_handles.handles = _ThreadHandles(
+                self.__init_functions, self.__destroy)
+        return handles.get(kind)
+
+    def __default_pool(self):
+        """returns the thread pool of decode_batch, created on first use"""
+        with self.__pool_lock:
+            if self.__pool is None:
+                self.__pool = ThreadPoolExecutor(
+                    max_workers=os.cpu_count() or 1, thread_name_prefix='turbojpeg')
+            return self.__pool
+
+    def __release_handle(self, handle):
+        """destroys the handle unless it is kept for reuse"""
+        if not self.__reuse_handles:
             self.__destroy(handle)
 
-    def __get_header_and_dimensions(self, handle, jpeg_array_size, src_addr, scaling_factor):
-        """returns scaled image dimensions and header data"""
-        if scaling_factor is not None and \
-            scaling_factor not in self.__scaling_factors:
-            raise ValueError('supported scaling factors are ' +
-                str(self.__scaling_factors))
+    def __encode_destination(self, out, width, height, jpeg_subsample, flags):
+        """returns the output array, JPEG pointer, size and flags of an encode call.
+           Without out, libjpeg-turbo allocates the JPEG buffer itself.
+        """
+        if out is None:
+            return None, c_void_p(), c_ulong(), flags
+        size = self.__buffer_size(width, height, jpeg_subsample)
+        if isinstance(out, FrameBufferRing):
+            dest_array = out.next((size,))
+        elif isinstance(out, np.ndarray):
+            dest_array = out
+        else:
+            dest_array = np.frombuffer(out, dtype=np.uint8)
+        if dest_array.dtype != np.uint8 or not dest_array.flags.writeable or not dest_array.flags.c_contiguous:
+            raise ValueError('Output must be a writable, contiguous uint8 buffer')
+        if dest_array.nbytes < size:
+            raise ValueError('Output buffer of {} bytes is too small, {} bytes are needed'.format(
+                dest_array.nbytes, size))
+        dest_array = dest_array.reshape(-1)
+        # the JPEG is written in place, libjpeg-turbo must not reallocate it
+        return dest_array, c_void_p(dest_array.ctypes.data), c_ulong(dest_array.size), flags | TJFLAG_NOREALLOC
+
+    def __encode_result(self, dest_array, jpeg_buf, jpeg_size):
+        """returns the encoded JPEG: a view of the output array, or bytes
+           copied once out of the buffer allocated by libjpeg-turbo.
+        """
+        if dest_array is not None:
+            return dest_array[:jpeg_size.value]
+        try:
+            return string_at(jpeg_buf.value, jpeg_size.value)
+        finally:
+            self.__free(jpeg_buf)
+
+    @staticmethod
+    def __check_output_array(array, shape, padded_width=False):
+        """validates a caller provided output array: uint8, writable, the
+           expected shape (with a channel axis of 1 optional) and packed
+           pixels, only the rows can be padded.
+        """
+        if not isinstance(array, np.ndarray) or array.dtype != np.uint8:
+            raise ValueError('Output must be a uint8 numpy array')
+        if not array.flags.writeable:
+            raise ValueError('Output array is not writable')
+        if len(shape) == 3 and shape[2] == 1 and array.ndim == 2:
+            shape = shape[:2]
+        if padded_width:
+            valid_shape = array.ndim == 2 and array.shape[0] == shape[0] and array.shape[1] >= shape[1]
+        else:
+            valid_shape = array.shape == tuple(shape)
+        if not valid_shape:
+            raise ValueError('Invalid output shape {}, expected {}'.format(array.shape, tuple(shape)))
+        item_strides = [1] if array.ndim == 2 else [shape[2], 1]
+        if list(array.strides[1:]) != item_strides or array.strides[0] < array.shape[1] * item_strides[0]:
+            raise ValueError('Invalid output strides {}, pixels must be packed and rows '
+                             'at least {} bytes apart'.format(array.strides, array.shape[1] * item_strides[0]))
+
+    def __read_header(self, handle, jpeg_array):
+        """returns (width, height, jpeg_subsample, jpeg_colorspace) of a JPEG
+           image, from the header cache when its header segment was seen.
+        """
+        key = None
+        if self.__header_cache is not None:
+            key = self.__header_cache.header_segment(jpeg_array)
+            if key is not None:
+                header = self.__header_cache.get(key, 'header')
+                if header is not None:
+                    return header
         width = c_int()
         height = c_int()
         jpeg_colorspace = c_int()
         jpeg_subsample = c_int()
         status = self.__decompress_header(
-            handle, src_addr, jpeg_array_size, byref(width), byref(height),
+            handle, self.__getaddr(jpeg_array), jpeg_array.size, byref(width), byref(height),
             byref(jpeg_subsample), byref(jpeg_colorspace))
         if status != 0:
             self.__report_error(handle)
-        scaled_width = width.value
-        scaled_height = height.value
+        header = (width.value, height.value, jpeg_subsample.value, jpeg_colorspace.value)
+        if key is not None:
+            self.__header_cache.put(key, 'header', header)
+        return header
+
+    def __background_dc_coefficient(self, jpeg_array, luminance):
+        """returns the quantized dc coefficient of a background luminance,
+           with the luminance DQT lookup cached per header segment.
+        """
+        key = None
+        if self.__header_cache is not None:
+            key = self.__header_cache.header_segment(jpeg_array)
+        if key is None:
+            return self.__map_luminance_to_dc_dct_coefficient(jpeg_array.tobytes(), luminance)
+        dc_dqt_coefficient = self.__header_cache.get(key, 'dc_dqt')
+        if dc_dqt_coefficient is None:
+            # the DQT markers are part of the header segment
+            dc_dqt_coefficient = self.__get_dc_dqt_element(key, 0)
+            self.__header_cache.put(key, 'dc_dqt', dc_dqt_coefficient)
+        luminance = min(max(luminance, 0), 1)
+        return int(round((luminance * 2047 - 1024) / dc_dqt_coefficient))
+
+    def __get_header_and_dimensions(self, handle, jpeg_array, src_addr, scaling_factor):
+        """returns scaled image dimensions and header data"""
+        if scaling_factor is not None and \
+            scaling_factor not in self.__scaling_factors:
+            raise ValueError('supported scaling factors are ' +
+                str(self.__scaling_factors))
+        scaled_width, scaled_height, jpeg_subsample, jpeg_colorspace = \
+            self.__read_header(handle, jpeg_array)
         if scaling_factor is not None:
             def get_scaled_value(dim, num, denom):
                 return (dim * num + denom - 1) // denom
@@ -936,6 +1266,11 @@ class TurboJPEG(object):
     def scaling_factors(self):
         return self.__scaling_factors
 
+    @property
+    def header_cache(self):
+        """the HeaderCache of the instance (hits, misses), None if disabled"""
+        return self.__header_cache
+
 if __name__ == '__main__':
     jpeg = TurboJPEG()
     in_file = open('input.jpg', 'rb')
@@ -1,9 +1,9 @@
 import logging
-import re
 
+from sir_code.choice_parser import ChoiceParser
 from sir_code.lib import Agent
 from sir_code.loggers import MAIN_LOGGER
-from sir_code.utils import multiline_strip
+from sir_code.prompt_template import PromptTemplate
 
 _ = MAIN_LOGGER # ensure logging setup is complete
 
@@ -22,39 +22,33 @@ class Action:
         "G": "Gently tap your lips or temple to suggest secrecy or whispering",
     }
 
-    _resp_regex = re.compile(r"^\s*([A-H])(?:\s*,\s*([A-H]))*\s*$")
     _logger = logging.getLogger("Demo.Action")
     _logger.setLevel(logging.CRITICAL)
+    _prompt = PromptTemplate(
+        """
+        The following text is a reply from you to a traveller in a tavern:
+        you: "{nao_text}"
+        
+        Which of the following actions apply while speaking the text(can be multiple or none)? 
+        Please answer with comma separated letters (e.g 'A,B'), or simply 'None' if none apply:
+        {options}
+        """
+    )
 
 
     def __init__(self, agent: Agent):
         self._agent = agent
+        self.parser = ChoiceParser(self.descriptions)
         self.current_actions = ""
 
 
     def generate_prompt(self, nao_text: str):
-        options_text = "\n".join(f"{k}) {v}" for k, v in self.descriptions.items())
-        return multiline_strip(
-            f"""
-            The following text is a reply from you to a traveller in a tavern:
-            you: "{nao_text}"
-            
-            Which of the following actions apply while speaking the text(can be multiple or none)? 
-            Please answer with comma separated letters (e.g 'A,B'), or simply 'None' if none apply:
-            {options_text}
-            """
-        )
+        return self._prompt.render(self.descriptions, nao_text=nao_text)
 
     def detect(self, nao_text: str):
         prompt = self.generate_prompt(nao_text)
-        resp = self._agent.ask([{"role": "user", "content": prompt}], max_output_tokens=16).strip().strip(".")
-
-        if resp.lower() == "none":
-            actions = ""
-        else:
-            assert self._resp_regex.match(resp), f"agent answer does not match regex: '{resp}'"
-            actions = "".join(sorted(re.findall(r"[A-H]", resp)))
-            assert len(actions) == len(set(actions)), f"agent answer has duplicate letters: '{resp}'"
+        resp = self._agent.ask_choice([{"role": "user", "content": prompt}], choices=self.parser.choices)
+        actions = "".join(self.parser.parse(resp))
 
         self.current_actions = actions
 
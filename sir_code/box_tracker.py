@@ -0,0 +1,131 @@
+import copy
+import itertools
+import logging
+import threading
+from typing import Any, List, Optional, Sequence
+
+from sir_code.boxes import Box, box_tuple, iou
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+
+def moved(detection: Any, box: Box) -> Any:
+    """The detection (a sic BoundingBox or a tuple) at the given box."""
+    if not hasattr(detection, "x"):
+        return tuple(box) + tuple(detection[4:])
+    detection = copy.copy(detection)
+    detection.x, detection.y, detection.w, detection.h = box
+    return detection
+
+
+class _Track:
+    _ids = itertools.count()
+
+    def __init__(self, detection: Any, stamp: float):
+        self.id = next(self._ids)
+        self.detection = detection
+        self.box = [float(v) for v in box_tuple(detection)]
+        self.velocity = [0.0, 0.0, 0.0, 0.0]
+        self.stamp = stamp
+        self.hits = 1
+        self.misses = 0
+
+    def predict(self, stamp: float) -> Box:
+        dt = max(stamp - self.stamp, 0.0)
+        x, y, w, h = (v + dv * dt for v, dv in zip(self.box, self.velocity))
+        return int(round(x)), int(round(y)), max(int(round(w)), 1), max(int(round(h)), 1)
+
+    def update(self, detection: Any, stamp: float, smoothing: float):
+        box = [float(v) for v in box_tuple(detection)]
+        dt = stamp - self.stamp
+        if dt > 0:
+            self.velocity = [smoothing * (new - old) / dt + (1 - smoothing) * dv
+                             for new, old, dv in zip(box, self.box, self.velocity)]
+        self.detection, self.box, self.stamp = detection, box, stamp
+        self.hits += 1
+        self.misses = 0
+
+
+class BoxTracker:
+    """
+    Propagates the boxes of the last detection to the frames in between detector runs, with a constant velocity
+    model per box. Detections are matched to the tracks greedily by IoU with the predicted boxes.
+    Stamps are in seconds, the same clock for `update` and `predict` (e.g. sic message timestamps).
+    """
+    _logger = logging.getLogger("Demo.BoxTracker")
+
+    def __init__(self, min_iou: float = 0.3, max_misses: int = 2, smoothing: float = 0.5):
+        assert 0 < min_iou <= 1 and 0 < smoothing <= 1
+        self.min_iou = min_iou
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+        self._tracks: List[_Track] = []
+        self._lock = threading.Lock()
+
+    def update(self, detections: Sequence[Any], stamp: float) -> float:
+        """
+        Corrects the tracks with a detector result and returns its stability, from 0 to 1: the mean IoU between the
+        predicted and the detected boxes, new and lost boxes counting as 0.
+        """
+        with self._lock:
+            boxes = [box_tuple(detection) for detection in detections]
+            predicted = [track.predict(stamp) for track in self._tracks]
+            pairs = sorted(((iou(p, b), t, d) for t, p in enumerate(predicted) for d, b in enumerate(boxes)),
+                           reverse=True)
+            matched_tracks, matched_detections, overlaps = set(), set(), []
+            for overlap, t, d in pairs:
+                if overlap < self.min_iou:
+                    break
+                if t in matched_tracks or d in matched_detections:
+                    continue
+                matched_tracks.add(t)
+                matched_detections.add(d)
+                overlaps.append(overlap)
+                self._tracks[t].update(detections[d], stamp, self.smoothing)
+
+            for t, track in enumerate(self._tracks):
+                if t not in matched_tracks:
+                    track.misses += 1
+            self._tracks = [track for track in self._tracks if track.misses <= self.max_misses]
+            self._tracks += [_Track(detections[d], stamp) for d in range(len(boxes)) if d not in matched_detections]
+
+            total = max(len(predicted), len(boxes))
+            return sum(overlaps) / total if total else 1.0
+
+    def predict(self, stamp: float) -> List[Any]:
+        """The tracked detections moved to `stamp`, tracks missed by the last detection are kept a few runs."""
+        with self._lock:
+            return [moved(track.detection, track.predict(stamp)) for track in self._tracks]
+
+
+if __name__ == '__main__':
+    import random
+
+    from sir_code.detection_governor import DetectionGovernor
+
+    # a face drifting right and a face moving fast, the detector running at the rate of the stability on a 30fps
+    # stream
+    def truth(t: float) -> List[Box]:
+        return [(int(100 + 20 * t), 120, 80, 100), (int(400 + 150 * t) % 560, int(200 + 40 * t) % 380, 70, 90)]
+
+    random.seed(0)
+    fps, seconds = 30, 20
+    for name, policy, track in [("every frame", None, True),
+                                ("adaptive, boxes held", DetectionGovernor(min_rate=2, max_rate=15), False),
+                                ("adaptive, tracked", DetectionGovernor(min_rate=2, max_rate=15), True)]:
+        tracker = BoxTracker()
+        runs, overlaps, last_run = 0, [], 0.0
+        for i in range(fps * seconds):
+            t = i / fps
+            if policy is None or policy.frame(None, t):
+                detections = [(x + random.randint(-2, 2), y + random.randint(-2, 2), w, h) for x, y, w, h in truth(t)]
+                stability = tracker.update(detections, t)
+                if policy is not None:
+                    policy.observe(stability)
+                runs += 1
+                last_run = t
+            shown = tracker.predict(t if track else last_run)
+            overlaps += [max((iou(box_tuple(s), b) for s in shown), default=0.0) for b in truth(t)]
+        print(f"{name:<21} detector runs: {runs:>4} ({runs / seconds:.1f}/s)  "
+              f"mean overlay IoU: {sum(overlaps) / len(overlaps):.3f}")
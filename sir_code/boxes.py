@@ -0,0 +1,20 @@
+from typing import Tuple
+
+Box = Tuple[int, int, int, int]
+
+
+def box_tuple(box) -> Box:
+    """(x, y, w, h) of a sic BoundingBox or of a tuple."""
+    if hasattr(box, "x"):
+        return int(box.x), int(box.y), int(box.w), int(box.h)
+    x, y, w, h = box[:4]
+    return int(x), int(y), int(w), int(h)
+
+
+def iou(a: Box, b: Box) -> float:
+    ix = min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0])
+    iy = min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1])
+    if ix <= 0 or iy <= 0:
+        return 0.0
+    inter = ix * iy
+    return inter / (a[2] * a[3] + b[2] * b[3] - inter)
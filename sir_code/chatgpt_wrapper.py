@@ -1,5 +1,6 @@
+import json
 from pathlib import Path
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Sequence
 
 from openai import OpenAI
 
@@ -7,10 +8,10 @@ from sir_code.lib import Agent
 
 
 class ChatGPTWrapper(Agent):
-    def __init__(self, model: str = "gpt-4o-mini"):
+    def __init__(self, model: str = "gpt-4o-mini", base_url: Optional[str] = None):
         key_file = Path(__file__).parent / "conf" / ".openai-key"
         assert key_file.exists(), f"OpenAI key not found, file '{key_file}' does not exist"
-        self._client = OpenAI(api_key=key_file.read_text())
+        self._client = OpenAI(api_key=key_file.read_text(), base_url=base_url)
         self._model = model
 
     def ask(self, __input: List[Dict[str, str]], /, max_output_tokens: Optional[int] = None):
@@ -31,4 +32,24 @@ class ChatGPTWrapper(Agent):
             if event.type == 'response.output_text.delta':
                 yield event.delta
 
-
+    def ask_choice(self, __input: List[Dict[str, str]], /, choices: Sequence[str]):
+        # structured output restricts the answer to the allowed choices, the short key keeps output tokens minimal
+        schema = {
+            "type": "object",
+            "properties": {"a": {"type": "array", "items": {"type": "string", "enum": list(choices)}}},
+            "required": ["a"],
+            "additionalProperties": False,
+        }
+        kw = dict(model=self._model, input=__input, store=False, max_output_tokens=max(16, 8 + 4 * len(choices)),
+                  text={"format": {"type": "json_schema", "name": "choice", "schema": schema, "strict": True}})
+        text = self._client.responses.create(**kw).output_text
+        try:
+            answer = json.loads(text)["a"]
+        except (ValueError, KeyError, TypeError):
+            return text  # truncated or refused, leave it to the caller's parser
+        return ",".join(answer) if answer else "None"
+
+    def embed(self, texts: Sequence[str], model: str = "text-embedding-3-small") -> List[List[float]]:
+        # one request for all the texts, each vector carries the index of its text
+        data = self._client.embeddings.create(model=model, input=list(texts)).data
+        return [item.embedding for item in sorted(data, key=lambda item: item.index)]
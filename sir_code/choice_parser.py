@@ -0,0 +1,46 @@
+import logging
+import re
+from typing import Sequence, List
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+
+class ChoiceParser:
+    """
+    Parser for the comma separated answers of the classifiers (e.g 'A,B' or 'None').
+    Off-format answers do not fail: the choices marked as such in the answer (quoted, in parentheses, followed by
+    a parenthesis or after 'option' or 'answer') are kept and the fallback is counted. A bare letter in prose is not
+    a choice, e.g. 'I think...' is not choice I.
+    """
+    _logger = logging.getLogger("Demo.ChoiceParser")
+
+    fallbacks: int
+
+    def __init__(self, choices: Sequence[str]):
+        self.choices = list(choices)
+        alternatives = "|".join(map(re.escape, sorted(self.choices, key=len, reverse=True)))
+        self._resp_regex = re.compile(rf"^\s*({alternatives})(?:\s*,\s*({alternatives}))*\s*$")
+        self._list_regex = re.compile(rf"\b({alternatives})\b")
+        self._choice_regex = re.compile(
+            rf"[\"'*(]\s*({alternatives})\s*[\"'*)]"
+            rf"|(?<![\w'])({alternatives})\)"
+            rf"|\b(?:[Oo]ptions?|[Cc]hoices?|[Aa]nswer|[Ll]etters?)\s*(?:is\s*)?:?\s*({alternatives})\b")
+        self.fallbacks = 0
+
+    def parse(self, resp: str) -> List[str]:
+        resp = resp.strip().strip(".")
+        if resp.lower() == "none":
+            return []
+
+        if self._resp_regex.match(resp):
+            found = self._list_regex.findall(resp)
+            if len(found) == len(set(found)):
+                return sorted(found)
+        else:
+            found = [choice for groups in self._choice_regex.findall(resp) for choice in groups if choice]
+        self.fallbacks += 1
+        self._logger.warning(f"agent answer is off-format, kept {sorted(set(found))} "
+                             f"(fallback #{self.fallbacks}): '{resp}'")
+        return sorted(set(found))
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+
+def motion_energy(previous: np.ndarray, current: np.ndarray, threshold: int = 16) -> float:
+    """Fraction of the pixels of two small frames that changed by more than `threshold`, ignoring sensor noise."""
+    return float(np.count_nonzero(np.abs(current - previous) > threshold)) / current.size
+
+
+def small_gray(frame: np.ndarray, step: int = 8) -> np.ndarray:
+    """Every `step` pixel of one channel (green, or the luma of a gray frame) as int16."""
+    small = frame[::step, ::step]
+    if small.ndim == 3:
+        small = small[..., 1]
+    return small.astype(np.int16)
+
+
+class DetectionGovernor:
+    """
+    Detection rate driven by the scene and the machine instead of a fixed frequency, between `min_rate` and
+    `max_rate` following the activity, the larger of:
+    - motion: the frame-difference energy of downsampled frames, the fraction of changed pixels, from 0 below
+      `motion_low` to 1 above `motion_high`,
+    - instability: 1 after a detection whose stability (see `BoxTracker.update`) is below `stable` (motion, objects
+      entering or leaving), then `decay` times less after every stable one, the tracker filling the frames in
+      between.
+    The rate above `min_rate` is scaled by the consumer demand, from 0 (nobody uses the detections) to 1, and
+    scaled down above `load_high` load per CPU (os.getloadavg, where available).
+    `frame(image, stamp)` returns whether the detector should run on that frame, the frames it skips are counted
+    in `dropped`.
+    """
+    _logger = logging.getLogger("Demo.DetectionGovernor")
+
+    def __init__(self, min_rate: float = 0.5, max_rate: float = 15.0, motion_low: float = 0.002,
+                 motion_high: float = 0.05, stable: float = 0.7, decay: float = 0.7, load_high: float = 0.8,
+                 smoothing: float = 0.3, step: int = 8):
+        assert 0 < min_rate <= max_rate and 0 <= motion_low < motion_high and 0 < smoothing <= 1 and 0 < decay < 1
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.motion_low = motion_low
+        self.motion_high = motion_high
+        self.stable = stable
+        self.decay = decay
+        self.load_high = load_high
+        self.smoothing = smoothing
+        self.step = step
+        self.demand = 1.0
+        self.rate = max_rate
+        self.motion = 0.0
+        self.instability = 1.0
+        self.load: Optional[float] = None
+        self.runs = 0
+        self.dropped = 0
+        self._previous: Optional[np.ndarray] = None
+        self._last_run: Optional[float] = None
+        self._load_checked = 0.0
+        self._lock = threading.Lock()
+
+    def set_demand(self, demand: float):
+        self.demand = min(max(float(demand), 0.0), 1.0)
+
+    def _cpu_load(self, now: float) -> Optional[float]:
+        if not hasattr(os, "getloadavg"):
+            return None
+        if now - self._load_checked >= 1.0:
+            self._load_checked = now
+            self.load = os.getloadavg()[0] / (os.cpu_count() or 1)
+        return self.load
+
+    def _update_rate(self, now: float):
+        span = self.motion_high - self.motion_low
+        motion = min(max((self.motion - self.motion_low) / span, 0.0), 1.0)
+        activity = max(motion, self.instability)
+        rate = self.min_rate + (self.max_rate - self.min_rate) * activity * self.demand
+        load = self._cpu_load(now)
+        if load is not None and load > self.load_high:
+            rate *= self.load_high / load
+        rate = max(rate, self.min_rate)
+        if abs(rate - self.rate) > 0.25 * self.rate:
+            self._logger.debug(f"detection rate {self.rate:.1f} -> {rate:.1f} Hz (motion {self.motion:.3f}, "
+                               f"instability {self.instability:.2f}, "
+                               f"load {load if load is not None else float('nan'):.2f}, demand {self.demand:.2f})")
+        self.rate = rate
+
+    def observe(self, stability: float):
+        """Feeds the stability of a detector result, see `BoxTracker.update`."""
+        with self._lock:
+            self.instability = self.instability * self.decay if stability >= self.stable else 1.0
+
+    def frame(self, image: Optional[np.ndarray], stamp: Optional[float] = None) -> bool:
+        """
+        Feeds a camera frame, returns whether the detector should run on it. Without an image only the
+        stability drives the rate.
+        """
+        now = time.monotonic() if stamp is None else stamp
+        small = None if image is None else small_gray(image, self.step)
+        with self._lock:
+            if small is not None:
+                if self._previous is not None and self._previous.shape == small.shape:
+                    energy = motion_energy(self._previous, small)
+                    self.motion = self.smoothing * energy + (1 - self.smoothing) * self.motion
+                self._previous = small
+            self._update_rate(now)
+            if self._last_run is not None and now - self._last_run < 1 / self.rate:
+                self.dropped += 1
+                return False
+            self._last_run = now
+            self.runs += 1
+            return True
+
+    def report(self) -> str:
+        with self._lock:
+            frames = self.runs + self.dropped
+            return (f"rate {self.rate:.1f} Hz, {self.runs} detector runs, {self.dropped} frames skipped "
+                    f"({self.dropped / max(frames, 1):.0%}), motion {self.motion:.3f}, "
+                    f"instability {self.instability:.2f}")
+
+
+if __name__ == '__main__':
+    # 30fps scene: still for 10s, a person sized block moving for 5s, still again, and the governor cost per frame,
+    # the detections are stable while the scene is still
+    rng = np.random.default_rng(0)
+    background = rng.integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    governor = DetectionGovernor()
+    fps = 30
+    phases = [("still", 10, False), ("motion", 5, True), ("still", 10, False)]
+    t = 0.0
+    cost = 0.0
+    for name, seconds, moving in phases:
+        runs = governor.runs
+        for i in range(seconds * fps):
+            frame = background.copy()
+            frame += rng.integers(0, 3, frame.shape, dtype=np.uint8)  # sensor noise
+            if moving:
+                x = (i * 12) % 440
+                frame[100:400, x:x + 200] = 255
+            start = time.perf_counter()
+            if governor.frame(frame, t):
+                governor.observe(0.3 if moving else 1.0)
+            cost += time.perf_counter() - start
+            t += 1 / fps
+        print(f"{name:<7} {seconds:>3}s: {governor.runs - runs:>4} detector runs "
+              f"({(governor.runs - runs) / seconds:.1f}/s), rate at the end {governor.rate:.1f} Hz")
+    print(governor.report())
+    print(f"governor cost: {cost / (t * fps) * 1e6:.0f}us per frame")
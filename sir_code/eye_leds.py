@@ -0,0 +1,267 @@
+import abc
+import logging
+import math
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, List, Optional, Sequence, Tuple
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+RGB = Tuple[float, float, float]
+
+
+def rgb_hex(rgb: RGB) -> int:
+    """0x00RRGGBB, the format of NaoFadeListRGBRequest."""
+    r, g, b = (max(0, min(255, int(round(c * 255)))) for c in rgb)
+    return (r << 16) | (g << 8) | b
+
+
+class Effect(abc.ABC):
+    """A color over time, `color(t)` for `t` seconds since the effect started, endless if `duration` is None."""
+    duration: Optional[float] = None
+
+    @abc.abstractmethod
+    def color(self, t: float) -> RGB:
+        ...
+
+
+class Hold(Effect):
+    def __init__(self, rgb: RGB, duration: Optional[float] = None):
+        self.rgb = tuple(rgb)
+        self.duration = duration
+
+    def color(self, t: float) -> RGB:
+        return self.rgb
+
+
+class Ramp(Effect):
+    def __init__(self, start: RGB, end: RGB, duration: float):
+        self.start = tuple(start)
+        self.end = tuple(end)
+        self.duration = duration
+
+    def color(self, t: float) -> RGB:
+        w = min(max(t / self.duration, 0.0), 1.0) if self.duration > 0 else 1.0
+        return tuple(a + (b - a) * w for a, b in zip(self.start, self.end))
+
+
+class Pulse(Effect):
+    """Brightness of `rgb` dipping by `depth` and back every `period` seconds, e.g. while speaking."""
+
+    def __init__(self, rgb: RGB, period: float = 0.6, depth: float = 0.6, duration: Optional[float] = None):
+        self.rgb = tuple(rgb)
+        self.period = period
+        self.depth = depth
+        self.duration = duration
+
+    def color(self, t: float) -> RGB:
+        level = 1 - self.depth * (0.5 - 0.5 * math.cos(2 * math.pi * t / self.period))
+        return tuple(c * level for c in self.rgb)
+
+
+class Breathe(Pulse):
+    """Slow deep pulse of an idle robot."""
+
+    def __init__(self, rgb: RGB, period: float = 4.0, depth: float = 0.7, duration: Optional[float] = None):
+        super().__init__(rgb, period, depth, duration)
+
+
+def compile_keyframes(colors: Sequence[RGB], step: float, tolerance: float = 2 / 255) -> List[Tuple[int, float]]:
+    """
+    (0x00RRGGBB, fade duration) keyframes of colors sampled every `step` seconds, leaving out the samples that a
+    linear fade between their neighbours reproduces within `tolerance`, so ramps and holds become one keyframe.
+    """
+    if not colors:
+        return []
+    kept = [0]
+    for i in range(1, len(colors) - 1):
+        # the fade from the last kept sample to the next one must reproduce every sample in between
+        a, b = colors[kept[-1]], colors[i + 1]
+        span = i + 1 - kept[-1]
+        if any(abs(a[c] + (b[c] - a[c]) * (j - kept[-1]) / span - colors[j][c]) > tolerance
+               for j in range(kept[-1] + 1, i + 1) for c in range(3)):
+            kept.append(i)
+    if len(colors) > 1:
+        kept.append(len(colors) - 1)
+    keyframes = [(rgb_hex(colors[0]), step)]
+    for previous, i in zip(kept, kept[1:]):
+        rgb, duration = rgb_hex(colors[i]), (i - previous) * step
+        if rgb == keyframes[-1][0]:
+            keyframes[-1] = (rgb, keyframes[-1][1] + duration)
+        else:
+            keyframes.append((rgb, duration))
+    return keyframes
+
+
+class EyeAnimator:
+    """
+    Animates an LED group (the face LEDs) on its own timer thread: the effects (ramps, pulses, breathing) are
+    sampled over the next `batch` seconds at `rate` Hz, compiled into a few keyframes and sent as one fade list
+    command (e.g. a NaoFadeListRGBRequest, through `send`), instead of one blocking request per color change.
+    The robot plays the fade lists one after the other, so the animator tracks where the queued ones end (the
+    playhead) and sends the next batch `lead` seconds before, starting there: a new effect starts at the next batch
+    boundary, or right away when nothing is queued, at most `batch` seconds late instead of behind a growing queue.
+    Batches that only hold the current color are not sent.
+    """
+    _logger = logging.getLogger("Demo.EyeAnimator")
+
+    def __init__(self, send: Callable[[str, List[int], List[float]], Any], group: str = "FaceLeds",
+                 rate: float = 20.0, batch: float = 0.5, lead: float = 0.05):
+        assert rate > 0 and batch > 0 and 0 <= lead < batch
+        self._send = send
+        self.group = group
+        self.rate = rate
+        self.batch = batch
+        self.lead = lead
+        self._timeline: List[Tuple[float, Effect]] = [(time.monotonic(), Hold((1.0, 1.0, 1.0)))]
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._last_hex: Optional[int] = None
+        self._played: Optional[float] = None  # when the newest effects were played, until they are sent
+        self._playhead = time.monotonic()  # end of the fade lists queued on the robot
+        self.commands = 0
+        self.keyframes = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self.jitter_ms: Deque[float] = deque(maxlen=300)
+        self.lag_ms: Deque[float] = deque(maxlen=300)
+
+    def start(self) -> "EyeAnimator":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="EyeAnimator", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._changed.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def color(self, now: Optional[float] = None) -> RGB:
+        """The color shown at `now` (time.monotonic())."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._color(now)
+
+    def _color(self, now: float) -> RGB:
+        for start, effect in reversed(self._timeline):
+            if now >= start:
+                if effect.duration is not None and now - start > effect.duration:
+                    return effect.color(effect.duration)  # the sequence ended, hold its last color
+                return effect.color(now - start)
+        return self._timeline[0][1].color(0.0)
+
+    def _boundary(self) -> float:
+        """When a new effect starts: the end of the queued fade lists, now if none are queued."""
+        with self._lock:
+            return max(time.monotonic(), self._playhead)
+
+    def play(self, *effects: Effect):
+        """
+        Plays the effects one after the other from the next batch boundary on, the last one goes on until the next
+        `play`.
+        """
+        now = time.monotonic()
+        with self._lock:
+            timeline, start = [], max(now, self._playhead)
+            for effect in effects:
+                timeline.append((start, effect))
+                start += effect.duration or 0.0
+            self._timeline = timeline
+            if self._played is None:
+                self._played = now
+        self._changed.set()
+
+    def ramp_to(self, rgb: RGB, duration: float = 1.0, then: Optional[Effect] = None):
+        self.play(Ramp(self.color(self._boundary()), rgb, duration), then or Hold(rgb))
+
+    def speak(self, rgb: RGB, seconds: float, ramp: float = 0.5):
+        """Ramps to `rgb`, pulses while speaking for `seconds`, then breathes in that color."""
+        self.play(Ramp(self.color(self._boundary()), rgb, ramp), Pulse(rgb, duration=seconds), Breathe(rgb))
+
+    def idle(self, rgb: Optional[RGB] = None):
+        self.play(Breathe(rgb or self.color(self._boundary())))
+
+    def _compile(self, start: float) -> List[Tuple[int, float]]:
+        step = 1 / self.rate
+        with self._lock:
+            colors = [self._color(start + i * step) for i in range(1, int(round(self.batch * self.rate)) + 1)]
+        return compile_keyframes(colors, step)
+
+    def _run(self):
+        due = time.monotonic()
+        while not self._stop.is_set():
+            changed = self._changed.wait(max(due - time.monotonic(), 0.0))
+            if self._stop.is_set():
+                break
+            now = time.monotonic()
+            if changed:
+                self._changed.clear()
+                if now < self._playhead - self.lead:
+                    continue  # the queued batch plays out first, the change starts at its end
+            else:
+                self.jitter_ms.append((now - due) * 1000)
+            start = max(self._playhead, now)
+            keyframes = self._compile(start)
+            with self._lock:
+                played, self._played = self._played, None
+            if all(rgb == self._last_hex for rgb, _ in keyframes):
+                self.skipped += 1
+            else:
+                rgbs, durations = [rgb for rgb, _ in keyframes], [duration for _, duration in keyframes]
+                try:
+                    self._send(self.group, rgbs, durations)
+                    self.commands += 1
+                    self.keyframes += len(keyframes)
+                    self._last_hex = rgbs[-1]
+                    with self._lock:
+                        self._playhead = start + sum(durations)
+                except Exception:
+                    self._logger.exception("sending the LED animation failed")
+            if played is not None:
+                self.lag_ms.append((start - played) * 1000)
+            due = start + self.batch - self.lead
+
+    def report(self) -> str:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        jitter = (f", timer jitter {statistics.median(self.jitter_ms):.1f}ms (median), {max(self.jitter_ms):.1f}ms "
+                  f"(max)" if self.jitter_ms else "")
+        lag = (f", effects start {statistics.median(self.lag_ms):.0f}ms (median), {max(self.lag_ms):.0f}ms (max) "
+               f"after they are played" if self.lag_ms else "")
+        return (f"{self.commands} LED commands ({self.commands / elapsed:.2f}/s), "
+                f"{self.keyframes / max(self.commands, 1):.1f} keyframes per command, "
+                f"{self.skipped} unchanged batches skipped{jitter}{lag}")
+
+
+if __name__ == '__main__':
+    # 20s session: idle breathing, then turns of 3s speech in a new color every 4s, sent to a fake robot; the
+    # color is sampled at the animation rate meanwhile, to count the requests of one request per color change
+    sent = []
+    animator = EyeAnimator(lambda group, rgbs, durations: sent.append((rgbs, durations)), rate=20).start()
+    changes, shown = 0, None
+
+    def watch(seconds: float):
+        global changes, shown
+        end = time.monotonic() + seconds
+        while time.monotonic() < end:
+            color = rgb_hex(animator.color())
+            changes += color != shown
+            shown = color
+            time.sleep(1 / animator.rate)
+
+    animator.idle((1.0, 1.0, 1.0))
+    watch(4)
+    for rgb in [(1.0, 0.75, 0.0), (0.0, 0.5, 0.0), (0.2, 0.8, 0.2), (1.0, 0.0, 0.0)]:
+        animator.speak(rgb, 3.0)
+        watch(4)
+    animator.stop()
+    print(animator.report())
+    print(f"one request per color change: {changes} requests ({changes / 20:.1f}/s)")
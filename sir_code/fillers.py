@@ -0,0 +1,177 @@
+import hashlib
+import io
+import logging
+import math
+import threading
+import wave
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+FILLERS = ["Hmm…", "Ah, I see.", "Let me think.", "Well…", "Mm-hm.", "Interesting…"]
+
+Audio = Tuple[bytes, int]  # 16-bit mono PCM and its sample rate, as in a sic AudioRequest
+
+
+Renderer = Callable[[str, str, int, int], Audio]  # (text, voice, speed, pitch) -> audio
+
+
+def google_renderer(keyfile_json: Dict[str, Any], language_code: str = "en-US") -> Renderer:
+    """
+    Renders fillers with Google text-to-speech (pip install google-cloud-texttospeech, part of the google-tts extra
+    of social-interaction-cloud). `speed` and `pitch` are NAOqi values, 100 is normal: the speed becomes the speaking
+    rate and the pitch a shift of 12 * log2(pitch / 100) semitones.
+    """
+    from google.cloud import texttospeech as tts
+    from google.oauth2.service_account import Credentials
+
+    client = tts.TextToSpeechClient(credentials=Credentials.from_service_account_info(keyfile_json))
+
+    def render(text: str, voice: str, speed: int, pitch: int) -> Audio:
+        response = client.synthesize_speech(
+            input=tts.SynthesisInput(text=text),
+            voice=tts.VoiceSelectionParams(language_code=language_code, name=voice),
+            audio_config=tts.AudioConfig(audio_encoding=tts.AudioEncoding.LINEAR16, speaking_rate=speed / 100,
+                                         pitch=12 * math.log2(pitch / 100)),
+        )
+        with wave.open(io.BytesIO(response.audio_content)) as audio:
+            return audio.readframes(audio.getnframes()), audio.getframerate()
+
+    return render
+
+
+class FillerCache:
+    """
+    Library of short fillers rendered ahead of time, keyed by voice, speed and pitch, and kept as .wav files in
+    `directory` so a restart does not synthesize them again. `render(text, voice, speed, pitch)` returns the audio
+    (see `google_renderer`), it is only called when warming the cache so playing a filler never waits for synthesis.
+    """
+    _logger = logging.getLogger("Demo.FillerCache")
+
+    def __init__(self, render: Renderer, directory: Path = Path(__file__).parent / "fillers",
+                 texts: Sequence[str] = FILLERS):
+        self._render = render
+        self.directory = Path(directory)
+        self.texts = list(texts)
+        self._cache: Dict[Tuple[str, int, int], List[Audio]] = {}
+        self._next: Dict[Tuple[str, int, int], int] = {}
+        self._lock = threading.Lock()
+        self.rendered = 0
+        self.loaded = 0
+
+    def _path(self, text: str, voice: str, speed: int, pitch: int) -> Path:
+        name = hashlib.sha1(text.encode()).hexdigest()[:12]
+        return self.directory / f"{voice or 'default'}_{speed}_{pitch}" / f"{name}.wav"
+
+    def _audio(self, text: str, voice: str, speed: int, pitch: int) -> Audio:
+        path = self._path(text, voice, speed, pitch)
+        if path.exists():
+            with wave.open(str(path), "rb") as audio:
+                self.loaded += 1
+                return audio.readframes(audio.getnframes()), audio.getframerate()
+        waveform, sample_rate = self._render(text, voice, speed, pitch)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with wave.open(str(path), "wb") as audio:
+            audio.setnchannels(1)
+            audio.setsampwidth(2)
+            audio.setframerate(sample_rate)
+            audio.writeframes(waveform)
+        self.rendered += 1
+        return waveform, sample_rate
+
+    def warm(self, voice: str, speed: int, pitch: int):
+        key = (voice, speed, pitch)
+        if key in self._cache:
+            return
+        try:
+            rendered = [self._audio(text, voice, speed, pitch) for text in self.texts]
+        except Exception:
+            self._logger.exception(f"rendering the fillers for voice={voice}, speed={speed}, pitch={pitch} failed")
+            return
+        with self._lock:
+            self._cache[key] = rendered
+            self._next[key] = 0
+        self._logger.debug(f"{len(rendered)} fillers ready for voice={voice}, speed={speed}, pitch={pitch}")
+
+    def warm_async(self, voice: str, speed: int, pitch: int) -> threading.Thread:
+        thread = threading.Thread(target=self.warm, args=(voice, speed, pitch), daemon=True)
+        thread.start()
+        return thread
+
+    def get(self, voice: str, speed: int, pitch: int) -> Optional[Audio]:
+        """Returns the next filler for this voice in rotation, or None if it has not been rendered yet."""
+        key = (voice, speed, pitch)
+        with self._lock:
+            rendered = self._cache.get(key)
+            if not rendered:
+                return None
+            i = self._next[key]
+            self._next[key] = (i + 1) % len(rendered)
+            return rendered[i]
+
+
+class FillerPolicy:
+    """
+    Plays a filler when the projected response latency, the smoothed latency of the previous turns, exceeds
+    `threshold` seconds, so the silence between the user and the first Nao word is shorter.
+    """
+    _logger = logging.getLogger("Demo.FillerPolicy")
+
+    def __init__(self, cache: FillerCache, play: Callable[[Audio], None], threshold: float = 1.5,
+                 smoothing: float = 0.5):
+        assert threshold > 0 and 0 < smoothing <= 1
+        self.cache = cache
+        self._play = play
+        self.threshold = threshold
+        self.smoothing = smoothing
+        self.projected: Optional[float] = None
+        self.played = 0
+        self.skipped = 0
+
+    def observe(self, latency: float):
+        """Records the latency between the end of the user turn and the start of the Nao response."""
+        self.projected = latency if self.projected is None else \
+            self.smoothing * latency + (1 - self.smoothing) * self.projected
+
+    def maybe_play(self, voice: str, speed: int, pitch: int) -> bool:
+        if self.projected is None or self.projected < self.threshold:
+            return False
+        filler = self.cache.get(voice, speed, pitch)
+        if filler is None:
+            self.skipped += 1
+            return False
+        self._play(filler)
+        self.played += 1
+        self._logger.debug(f"projected latency {self.projected:.2f}s > {self.threshold:.2f}s, played filler")
+        return True
+
+
+if __name__ == '__main__':
+    import tempfile
+    import time
+
+    # time to the first filler audio: synthesized on demand (a 300ms stand-in for a text-to-speech call), from the
+    # cache in memory, and from the cache files after a restart
+    def render(text: str, voice: str, speed: int, pitch: int) -> Audio:
+        time.sleep(0.3)
+        return bytes(2 * 16000 * len(text) // 15), 16000
+
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        render(FILLERS[0], "", 90, 85)
+        live = time.perf_counter() - start
+        cache = FillerCache(render, Path(directory))
+        cache.warm("", 90, 85)
+        start = time.perf_counter()
+        cache.get("", 90, 85)
+        cached = time.perf_counter() - start
+        restarted = FillerCache(render, Path(directory))
+        start = time.perf_counter()
+        restarted.warm("", 90, 85)
+        reloaded = time.perf_counter() - start
+        print(f"synthesized per filler: {live * 1000:.0f}ms, cached: {cached * 1e6:.1f}us, "
+              f"{len(FILLERS)} fillers reloaded from disk in {reloaded * 1000:.1f}ms "
+              f"({restarted.rendered} rendered again)")
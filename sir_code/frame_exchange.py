@@ -0,0 +1,263 @@
+import bisect
+import queue
+import statistics
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Generic, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class LatestValue(Generic[T]):
+    """
+    Single slot exchange between a producer callback (camera images, detections) and a consumer loop.
+    `put` never blocks: a value that was not taken yet is overwritten and counted as dropped, so a slow consumer
+    never holds back the capture thread and always gets the newest value. Every value is stamped on arrival, the
+    age of the last value taken is kept in `last_age`.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._value: Optional[T] = None
+        self._stamp = 0.0
+        self._seq = 0
+        self._taken = 0
+        self.puts = 0
+        self.dropped = 0
+        self.last_age = 0.0
+        self.max_age = 0.0
+
+    def put(self, value: T, stamp: Optional[float] = None):
+        """Stores the value, `stamp` is its time.monotonic() arrival time (now by default)."""
+        with self._cond:
+            if self._seq > self._taken:
+                self.dropped += 1
+            self._value = value
+            self._stamp = time.monotonic() if stamp is None else stamp
+            self._seq += 1
+            self.puts += 1
+            self._cond.notify_all()
+
+    def get(self, timeout: Optional[float] = None) -> T:
+        """Returns a value newer than the last one taken, waiting up to `timeout` seconds, or raises queue.Empty."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._seq > self._taken, timeout):
+                raise queue.Empty
+            return self._take()
+
+    def get_nowait(self) -> T:
+        return self.get(timeout=0)
+
+    def latest(self, default: Optional[T] = None) -> Optional[T]:
+        """Returns the newest value without taking it, e.g. the detections drawn on every frame."""
+        with self._cond:
+            return default if self._seq == 0 else self._value
+
+    def age(self) -> float:
+        """Seconds since the newest value arrived."""
+        with self._cond:
+            return time.monotonic() - self._stamp if self._seq else 0.0
+
+    def _take(self) -> T:
+        self._taken = self._seq
+        self.last_age = time.monotonic() - self._stamp
+        self.max_age = max(self.max_age, self.last_age)
+        return self._value
+
+    def report(self) -> str:
+        with self._cond:
+            return (f"{self.puts} received, {self.dropped} dropped ({self.dropped / max(self.puts, 1):.0%}), "
+                    f"last age {self.last_age * 1000:.1f}ms, max age {self.max_age * 1000:.1f}ms")
+
+
+class RedisClock:
+    """
+    The clock of the redis server, the one sic stamps its messages with (`SICRedisConnection.time()`), read as the
+    local time.time() plus the offset measured once, so stamping a message costs no round trip to the server.
+    """
+
+    def __init__(self, redis: Any, samples: int = 5):
+        offsets = []
+        for _ in range(samples):
+            before = time.time()
+            server = redis_seconds(redis.time())
+            after = time.time()
+            offsets.append((after - before, server - (before + after) / 2))
+        # the offset of the fastest round trip is the most accurate
+        self.offset = min(offsets)[1]
+
+    def __call__(self) -> float:
+        return time.time() + self.offset
+
+
+def redis_seconds(stamp: Any) -> float:
+    """Seconds of a redis TIME reply, a (seconds, microseconds) pair."""
+    seconds, microseconds = stamp
+    return int(seconds) + int(microseconds) / 1e6
+
+
+def message_stamp(message: Any, clock: Callable[[], float] = time.time) -> float:
+    """
+    Stamp a sic message was created with, in seconds of the redis server (sensors stamp their output with
+    `redis.time()`), `clock()` if it has none, e.g. a `RedisClock` so both can be compared. The detection services
+    do not stamp their results, see `InFlight`.
+    """
+    stamp = getattr(message, "_timestamp", None)
+    if isinstance(stamp, (tuple, list)) and len(stamp) == 2:
+        return redis_seconds(stamp)
+    return float(stamp) if isinstance(stamp, (int, float)) else clock()
+
+
+class InFlight:
+    """
+    Stamps of the frames sent to a service that answers every frame in order but does not stamp its results (the sic
+    face and object detection output the result of `detect` as is): `sent(stamp)` when a frame is sent, and
+    `received()` pops the stamp of the frame the next result was computed on. At most `limit` frames are in flight,
+    `ready()` tells whether another one can be sent, so the service never queues up frames (the object detection
+    keeps only the newest one). A result that does not come back within `timeout` seconds is given up on.
+    """
+
+    def __init__(self, limit: int = 1, timeout: float = 2.0, clock: Callable[[], float] = time.time):
+        assert limit > 0 and timeout > 0
+        self.limit = limit
+        self.timeout = timeout
+        self.clock = clock
+        self._stamps: Deque[Tuple[float, float]] = deque()  # frame stamp, send time
+        self._lock = threading.Lock()
+        self.sent_frames = 0
+        self.received_results = 0
+        self.busy = 0
+        self.expired = 0
+        self.unexpected = 0
+        self.latencies_ms: Deque[float] = deque(maxlen=300)
+
+    def ready(self) -> bool:
+        now = self.clock()
+        with self._lock:
+            while self._stamps and now - self._stamps[0][1] > self.timeout:
+                self._stamps.popleft()
+                self.expired += 1
+            if len(self._stamps) >= self.limit:
+                self.busy += 1
+                return False
+            return True
+
+    def sent(self, stamp: float):
+        with self._lock:
+            self._stamps.append((stamp, self.clock()))
+            self.sent_frames += 1
+
+    def received(self) -> Optional[float]:
+        """The stamp of the oldest frame in flight, None for a result nothing was sent for."""
+        now = self.clock()
+        with self._lock:
+            if not self._stamps:
+                self.unexpected += 1
+                return None
+            stamp, sent = self._stamps.popleft()
+            self.received_results += 1
+            self.latencies_ms.append((now - sent) * 1000)
+            return stamp
+
+    def report(self) -> str:
+        with self._lock:
+            latency = (f", service latency {statistics.median(self.latencies_ms):.1f}ms (median), "
+                       f"{max(self.latencies_ms):.1f}ms (max)" if self.latencies_ms else "")
+            return (f"{self.sent_frames} frames sent, {self.received_results} results, {self.busy} frames not sent "
+                    f"while busy, {self.expired} expired, {self.unexpected} unexpected{latency}")
+
+
+class FrameAligner:
+    """
+    Time indexed ring of the recent frames, matching each detection to the frame it was computed on instead of the
+    frame that happens to be the newest when the detection arrives. The aligned (frame, detections) pairs are
+    exchanged through `pairs`, a `LatestValue`, so drawing an overlay never blocks the capture.
+    Stamps are seconds of `clock`, e.g. a `RedisClock` for the stamps of `message_stamp`.
+    """
+
+    def __init__(self, size: int = 30, tolerance: float = 0.010, clock: Callable[[], float] = time.time):
+        assert size > 0 and tolerance >= 0
+        self.tolerance = tolerance
+        self.clock = clock
+        self.pairs: LatestValue[Tuple[Any, Any]] = LatestValue()
+        self._frames: Deque[Tuple[float, Any]] = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self.matched = 0
+        self.unmatched = 0
+        self.fallbacks = 0
+        self.delays_ms: Deque[float] = deque(maxlen=300)
+        self.delays_frames: Deque[int] = deque(maxlen=300)
+
+    def add_frame(self, frame: Any, stamp: Optional[float] = None):
+        with self._lock:
+            self._frames.append((self.clock() if stamp is None else stamp, frame))
+
+    def add_detections(self, detections: Any, stamp: Optional[float] = None) -> Optional[Any]:
+        """
+        Matches the detections to the frame with the closest stamp and returns that frame, None before the first
+        frame. `stamp` is the stamp of the frame the detections were computed on, e.g. from `InFlight.received` as
+        the sic detection services do not stamp their results. Detections without a frame within `tolerance` (e.g.
+        whose frame left the ring) fall back to the newest frame and are counted in `fallbacks`, so the overlay never
+        freezes.
+        The pipeline delay is measured from the frame stamp to now, and in frames captured meanwhile.
+        """
+        now = self.clock()
+        stamp = now if stamp is None else stamp
+        with self._lock:
+            stamps = [frame_stamp for frame_stamp, _ in self._frames]
+            i = bisect.bisect_left(stamps, stamp)
+            best = min((j for j in (i - 1, i) if 0 <= j < len(stamps)), key=lambda j: abs(stamps[j] - stamp),
+                       default=None)
+            if best is None:
+                self.unmatched += 1
+                return None
+            if abs(stamps[best] - stamp) > self.tolerance:
+                best = len(stamps) - 1
+                self.fallbacks += 1
+            frame_stamp, frame = self._frames[best]
+            self.matched += 1
+            self.delays_ms.append((now - frame_stamp) * 1000)
+            self.delays_frames.append(len(stamps) - 1 - best)
+        self.pairs.put((frame, detections))
+        return frame
+
+    def report(self) -> str:
+        with self._lock:
+            if not self.matched:
+                return f"no detection matched, {self.unmatched} unmatched"
+            return (f"{self.matched} detections matched ({self.fallbacks} to the newest frame), "
+                    f"{self.unmatched} unmatched, "
+                    f"delay {statistics.median(self.delays_ms):.1f}ms / "
+                    f"{statistics.median(self.delays_frames):.0f} frames (median), "
+                    f"{max(self.delays_ms):.1f}ms / {max(self.delays_frames)} frames (max)")
+
+
+if __name__ == '__main__':
+    import random
+
+    # a 30 fps camera and a detection service answering in order after 60-140ms without stamping its results, the
+    # detections pair with the frame they were computed on through the stamps in flight, or with the newest frame
+    # when they are stamped on arrival
+    for stamped in (False, True):
+        random.seed(0)
+        results: "queue.Queue[Tuple[float, int]]" = queue.Queue()
+        aligner, in_flight = FrameAligner(), InFlight(limit=2)
+        pairs, start = [], time.time()
+        for index in range(150):
+            now = time.time()
+            aligner.add_frame(index, now)
+            if in_flight.ready():
+                in_flight.sent(now)
+                results.put((now + random.uniform(0.06, 0.14), index))
+            while not results.empty() and results.queue[0][0] <= now:
+                _, computed_on = results.get()
+                stamp = in_flight.received()
+                pairs.append((aligner.add_detections(computed_on, stamp if stamped else None), computed_on))
+            time.sleep(max(start + (index + 1) / 30 - time.time(), 0.0))
+        wrong = sum(frame != computed_on for frame, computed_on in pairs)
+        print(f"{'stamps in flight' if stamped else 'stamped on arrival':<20} {wrong}/{len(pairs)} detections paired "
+              f"with another frame, {aligner.report()}")
+        if stamped:
+            assert pairs and not wrong, "detections paired with another frame than they were computed on"
+    print(f"in flight: {in_flight.report()}")
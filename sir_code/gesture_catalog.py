@@ -0,0 +1,235 @@
+import hashlib
+import logging
+import re
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sir_code.gestures import Gesture, GestureStore
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+_STOPWORDS = set("a an and are as at be by for from he her him himself his i in is it its me my of on or she so that "
+                 "the this to with you your yourself".split())
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower case words without stopwords, a plural or third person `s` stripped."""
+    words = re.findall(r"[a-z]+", text.lower())
+    return [w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+            for w in words if w not in _STOPWORDS]
+
+
+class _TfIdf:
+    """TF-IDF vectors of the descriptions, rows normalized so a dot product is the cosine similarity."""
+
+    def __init__(self, texts: Sequence[str]):
+        docs = [tokenize(text) for text in texts]
+        self.vocabulary: Dict[str, int] = {}
+        for doc in docs:
+            for word in doc:
+                self.vocabulary.setdefault(word, len(self.vocabulary))
+        counts = self._counts(docs)
+        self.idf = np.log((1 + len(docs)) / (1 + np.count_nonzero(counts, axis=0))) + 1
+        self.matrix = self._normalize(counts * self.idf)
+
+    def _counts(self, docs: Sequence[List[str]]) -> np.ndarray:
+        counts = np.zeros((len(docs), len(self.vocabulary)), dtype=np.float32)
+        for row, doc in enumerate(docs):
+            for word in doc:
+                column = self.vocabulary.get(word)
+                if column is not None:
+                    counts[row, column] += 1
+        return counts
+
+    @staticmethod
+    def _normalize(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1)
+
+    def __call__(self, texts: Sequence[str]) -> np.ndarray:
+        return self._normalize(self._counts([tokenize(text) for text in texts]) * self.idf)
+
+
+def motion_features(entry: Dict, joints: Sequence[str]) -> np.ndarray:
+    """Range of motion of every joint and the duration, from an index entry only (see `Gesture.summary`)."""
+    ranges = dict(zip(entry["joints"], np.subtract(entry["pose_max"], entry["pose_min"])))
+    return np.array([ranges.get(joint, 0.0) for joint in joints] + [entry["duration"] / 10], dtype=np.float32)
+
+
+class GestureCatalog:
+    """
+    Gestures of a `GestureStore` looked up by text: every gesture has a text `description` in the store index,
+    `match(text)` returns the gestures whose description is closest to the text (cosine similarity of the vectors of
+    `embed`, e.g. `ChatGPTWrapper.embed`, or of TF-IDF vectors without it), `similar(name)` the gestures moving the
+    same joints as much. TF-IDF only matches descriptions sharing words with the text, it does not understand
+    paraphrases: an embedding model is needed to look gestures up by intent.
+    Nothing is read before the first lookup, and only the index then: the gesture files are opened by `load`. The
+    description vectors of `embed` are kept next to the store in `embeddings/<embed_name>.npz`, by hash of the
+    description, so only new or changed descriptions are embedded at startup.
+    """
+    _logger = logging.getLogger("Demo.GestureCatalog")
+
+    def __init__(self, store: GestureStore, embed: Optional[Callable[[Sequence[str]], np.ndarray]] = None,
+                 embed_name: str = "embedding"):
+        self.store = store
+        self._embed = embed
+        self.embed_name = embed_name
+        self.embedded = 0
+        self._names: Optional[List[str]] = None
+        self._text: Optional[np.ndarray] = None
+        self._motion: Optional[np.ndarray] = None
+        self._encode: Optional[Callable[[Sequence[str]], np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    def add(self, gesture: Gesture, description: str):
+        self.store.save(gesture, description=description)
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._names = None
+
+    def _build(self):
+        with self._lock:
+            if self._names is not None:
+                return
+            start = time.perf_counter()
+            index = self.store.index
+            names = [name for name in sorted(index) if index[name].get("description")]
+            descriptions = [index[name]["description"] for name in names]
+            if self._embed is None:
+                self._encode = _TfIdf(descriptions)
+                self._text = self._encode.matrix
+            else:
+                self._encode = lambda texts: _TfIdf._normalize(np.asarray(self._embed(texts), dtype=np.float32))
+                self._text = self._embed_descriptions(descriptions)
+            joints = sorted({joint for name in names for joint in index[name]["joints"]})
+            self._motion = np.array([motion_features(index[name], joints) for name in names], dtype=np.float32)
+            self._names = names
+            self._logger.debug(f"catalog of {len(names)} gestures built in "
+                               f"{(time.perf_counter() - start) * 1000:.1f}ms")
+
+    @property
+    def embeddings_path(self) -> Path:
+        # a subdirectory: the store takes every .npz of its directory for a gesture
+        return self.store.directory / "embeddings" / f"{self.embed_name}.npz"
+
+    def _embed_descriptions(self, descriptions: List[str]) -> np.ndarray:
+        """The vectors of the descriptions, the ones not in the embeddings file embedded and added to it."""
+        if not descriptions:
+            return np.zeros((0, 0), np.float32)
+        keys = [hashlib.sha1(text.encode()).hexdigest() for text in descriptions]
+        vectors: Dict[str, np.ndarray] = {}
+        if self.embeddings_path.exists():
+            with np.load(self.embeddings_path) as data:
+                vectors = dict(zip(data["keys"].tolist(), data["vectors"]))
+        missing = {key: text for key, text in zip(keys, descriptions) if key not in vectors}
+        if missing:
+            vectors.update(zip(missing, self._encode(list(missing.values()))))
+            self.embedded += len(missing)
+            # the vectors of the current descriptions only, written whole so a reader never sees half a file
+            self.embeddings_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.embeddings_path.with_suffix(".tmp")
+            with open(tmp, "wb") as f:
+                np.savez(f, keys=np.array(keys), vectors=np.stack([vectors[key] for key in keys]))
+            tmp.replace(self.embeddings_path)
+        self._logger.debug(f"{len(missing)} of {len(keys)} descriptions embedded")
+        return np.stack([vectors[key] for key in keys])
+
+    def names(self) -> List[str]:
+        self._build()
+        return list(self._names)
+
+    def match(self, text: str, k: int = 1, min_score: float = 0.0) -> List[Tuple[str, float]]:
+        """The `k` gestures best matching the text, as (name, similarity), best first."""
+        self._build()
+        if not self._names:
+            return []
+        scores = self._text @ self._encode([text])[0]
+        best = np.argsort(-scores)[:k]
+        return [(self._names[i], float(scores[i])) for i in best if scores[i] > min_score]
+
+    def similar(self, name: str, k: int = 1) -> List[Tuple[str, float]]:
+        """The `k` other gestures with the closest motion features, as (name, distance), closest first."""
+        self._build()
+        i = self._names.index(name)
+        distances = np.linalg.norm(self._motion - self._motion[i], axis=1)
+        distances[i] = np.inf
+        return [(self._names[j], float(distances[j])) for j in np.argsort(distances)[:k] if j != i]
+
+    def load(self, name: str) -> Gesture:
+        return self.store.load(name)
+
+
+if __name__ == '__main__':
+    import random
+    import tempfile
+
+    from sir_code.action import Action
+
+    # a library of generated gestures and the actions of the demo, described as in Action.descriptions
+    random.seed(0)
+    verbs = "raise lift wave point open close nod shake tap place cross hold sweep reach bow".split()
+    parts = "arm arms hand hands head chest chin heart lips temple shoulder finger wrist".split()
+    manners = "slowly widely gently quickly proudly shyly firmly softly".split()
+    joints = ["HeadYaw", "HeadPitch", "LShoulderPitch", "LShoulderRoll", "LElbowRoll", "RShoulderPitch",
+              "RShoulderRoll", "RElbowRoll"]
+    # TF-IDF, and the embedding model of the OpenAI client if there is a key
+    from sir_code.chatgpt_wrapper import ChatGPTWrapper
+
+    encoders = {"tf-idf": None}
+    if (Path(__file__).parent / "conf" / ".openai-key").exists():
+        encoders["embedding"] = ChatGPTWrapper().embed
+    with tempfile.TemporaryDirectory() as directory:
+        catalog = GestureCatalog(GestureStore(Path(directory)))
+        for n in range(500):
+            text = f"{random.choice(verbs)} your {random.choice(parts)} {random.choice(manners)}"
+            times = np.linspace(0.05, random.uniform(1, 5), 40)
+            angles = np.outer(np.sin(times), np.random.default_rng(n).uniform(-1, 1, len(joints)))
+            catalog.add(Gesture(f"g{n}", joints, times, angles), text)
+        for letter, text in Action.descriptions.items():
+            catalog.add(Gesture(letter, joints, np.linspace(0.05, 3, 40), np.zeros((40, len(joints)))), text)
+
+        queries = [("He nods his head in agreement", "A"), ("She places a hand on her heart", "F"),
+                   ("Opens one arm widely to welcome you", "C"), ("Taps his lips, it is a secret", "G"),
+                   ("Lifts an arm to his chest", "B")]
+        for encoder, embed in encoders.items():
+            start = time.perf_counter()
+            catalog = GestureCatalog(GestureStore(Path(directory)), embed)
+            created = time.perf_counter() - start
+            start = time.perf_counter()
+            catalog.names()
+            built = time.perf_counter() - start
+            start = time.perf_counter()
+            results = [catalog.match(query, k=len(catalog.names())) for query, _ in queries]
+            lookup = (time.perf_counter() - start) / len(queries)
+            print(f"{encoder}, {len(catalog.names())} gestures: catalog created in {created * 1e6:.0f}us, "
+                  f"index loaded and vectors built in {built * 1000:.1f}ms, {lookup * 1e6:.0f}us per lookup")
+            for (query, expected), result in zip(queries, results):
+                rank = [name for name, _ in result].index(expected) + 1 if expected in dict(result) else None
+                print(f"{query!r:<40} -> " + ", ".join(f"{name} ({score:.2f})" for name, score in result[:3])
+                      + f", {expected} ranked {rank}")
+
+        # the description vectors persist with the store: a new catalog on it embeds only what is new (hashed
+        # words here, an embedding request would cost far more per description)
+        def hashed_words(texts):
+            vectors = np.zeros((len(texts), 256), np.float32)
+            for row, text in enumerate(texts):
+                for word in tokenize(text):
+                    vectors[row, int(hashlib.sha1(word.encode()).hexdigest(), 16) % 256] += 1
+            return vectors
+
+        for step in ("first start", "restart", "one gesture added"):
+            if step == "one gesture added":
+                catalog.add(Gesture("wave", joints, np.linspace(0.05, 2, 40), np.zeros((40, len(joints)))),
+                            "wave your hand to say goodbye")
+            catalog = GestureCatalog(GestureStore(Path(directory)), hashed_words, embed_name="hashed-words")
+            start = time.perf_counter()
+            catalog.names()
+            print(f"{step}: {catalog.embedded} descriptions embedded, built in "
+                  f"{(time.perf_counter() - start) * 1000:.1f}ms")
@@ -0,0 +1,193 @@
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+_STEP = 0.001  # angles are stored as int16 milliradians
+
+
+def trim_idle(times: np.ndarray, angles: np.ndarray, speed: float = 0.1, margin: float = 0.2) -> slice:
+    """
+    Samples between the first and the last movement, the idle lead-in and tail of a recording are dropped: a
+    movement is any joint faster than `speed` rad/s, `margin` seconds are kept around it.
+    """
+    if len(times) < 2:
+        return slice(0, len(times))
+    velocity = np.abs(np.diff(angles, axis=0)) / np.maximum(np.diff(times), 1e-6)[:, None]
+    moving = np.flatnonzero((velocity > speed).any(axis=1))
+    if not moving.size:
+        return slice(0, len(times))
+    start = np.searchsorted(times, times[moving[0]] - margin)
+    end = np.searchsorted(times, times[moving[-1] + 1] + margin, side="right")
+    return slice(int(start), int(end))
+
+
+def smooth(angles: np.ndarray, window: int = 5) -> np.ndarray:
+    """Centered moving average per joint, the edges padded with the first and last pose so they do not move."""
+    if window < 2 or len(angles) < window:
+        return angles
+    kernel = np.ones(window) / window
+    padded = np.pad(angles, ((window // 2, window - 1 - window // 2), (0, 0)), mode="edge")
+    return np.stack([np.convolve(padded[:, j], kernel, mode="valid") for j in range(angles.shape[1])], axis=1)
+
+
+def resample_recording(recording: Any) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """
+    Joint names, sample times (T,) and angles (T, joints) of a `NaoqiMotionRecording`, every joint resampled on the
+    sample times of the first one.
+    """
+    times = np.asarray(recording.recorded_times[0], dtype=np.float64)
+    angles = np.array([np.interp(times, joint_times, joint_angles) for joint_times, joint_angles
+                       in zip(recording.recorded_times, recording.recorded_angles)]).T
+    return list(recording.recorded_joints), times, angles
+
+
+class Gesture:
+    """A recorded motion on a common time base: `times` (T,) seconds, `angles` (T, joints) radians."""
+
+    def __init__(self, name: str, joints: Sequence[str], times: np.ndarray, angles: np.ndarray):
+        self.name = name
+        self.joints = list(joints)
+        self.times = np.asarray(times, dtype=np.float32)
+        self.angles = np.asarray(angles, dtype=np.float32)
+
+    @classmethod
+    def from_recording(cls, name: str, recording: Any) -> "Gesture":
+        """The `NaoqiMotionRecording` resampled on the sample times of its first joint."""
+        return cls(name, *resample_recording(recording))
+
+    def to_recording(self) -> Any:
+        from sic_framework.devices.common_naoqi.naoqi_motion_recorder import NaoqiMotionRecording
+
+        times = self.times.tolist()
+        return NaoqiMotionRecording(self.joints, self.angles.T.tolist(), [times] * len(self.joints))
+
+    @property
+    def duration(self) -> float:
+        return float(self.times[-1]) if len(self.times) else 0.0
+
+    def summary(self, min_range: float = 0.05) -> Dict[str, Any]:
+        """The index entry: duration, the joints that move more than `min_range` radians and the bounding pose."""
+        low, high = self.angles.min(axis=0), self.angles.max(axis=0)
+        return {
+            "duration": round(self.duration, 3),
+            "samples": len(self.times),
+            "joints": self.joints,
+            "moving_joints": [joint for joint, lo, hi in zip(self.joints, low, high) if hi - lo > min_range],
+            "pose_min": [round(float(v), 3) for v in low],
+            "pose_max": [round(float(v), 3) for v in high],
+        }
+
+
+def process_recording(name: str, recording: Any, speed: float = 0.1, margin: float = 0.2,
+                      window: int = 5) -> Gesture:
+    """A raw `StopRecording` result trimmed (see `trim_idle`), smoothed and restarted at one sample period."""
+    gesture = Gesture.from_recording(name, recording)
+    times, angles = gesture.times.astype(np.float64), gesture.angles.astype(np.float64)
+    kept = trim_idle(times, angles, speed, margin)
+    times, angles = times[kept], smooth(angles[kept], window)
+    if len(times) > 1:
+        # the first target time must be positive for the replay
+        times = times - times[0] + (times[1] - times[0])
+    return Gesture(name, gesture.joints, times, angles)
+
+
+class GestureStore:
+    """
+    Directory of gestures, one compressed `<name>.npz` each (int16 milliradians), and an `index.json` with the
+    `Gesture.summary` of every one, so picking a gesture does not open the files. Loaded gestures are cached.
+    """
+    _logger = logging.getLogger("Demo.GestureStore")
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self._index: Optional[Dict[str, Dict[str, Any]]] = None
+        self._cache: Dict[str, Gesture] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def index_path(self) -> Path:
+        return self.directory / "index.json"
+
+    @property
+    def index(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            if self._index is None:
+                self._index = json.loads(self.index_path.read_text()) if self.index_path.exists() else {}
+            return self._index
+
+    def names(self) -> List[str]:
+        return sorted(self.index)
+
+    def save(self, gesture: Gesture, **extra: Any) -> Path:
+        """Writes the gesture and its index entry, `extra` fields (e.g. a description) are added to the entry."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self.directory / f"{gesture.name}.npz"
+        angles = np.clip(np.round(gesture.angles / _STEP), -32768, 32767).astype(np.int16)
+        np.savez_compressed(path, joints=np.array(gesture.joints), times=gesture.times, angles=angles)
+        # cache what was written, the gesture `load` would return
+        gesture = Gesture(gesture.name, gesture.joints, gesture.times, angles * _STEP)
+        entry = dict(gesture.summary(), file=path.name, **extra)
+        index = self.index
+        with self._lock:
+            index[gesture.name] = entry
+            self._cache[gesture.name] = gesture
+            self._write_index()
+        self._logger.debug(f"saved {gesture.name}: {entry['duration']}s, {path.stat().st_size} bytes")
+        return path
+
+    def _write_index(self):
+        tmp = self.index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._index, indent=1))
+        tmp.replace(self.index_path)
+
+    def load(self, name: str) -> Gesture:
+        with self._lock:
+            gesture = self._cache.get(name)
+        if gesture is None:
+            with np.load(self.directory / f"{name}.npz") as data:
+                gesture = Gesture(name, data["joints"].tolist(), data["times"], data["angles"] * _STEP)
+            with self._lock:
+                self._cache[name] = gesture
+        return gesture
+
+    def rebuild_index(self) -> Dict[str, Dict[str, Any]]:
+        """Index of the .npz files in the directory, e.g. after copying gestures in by hand."""
+        entries = {}
+        for path in sorted(self.directory.glob("*.npz")):
+            entries[path.stem] = dict(self.index.get(path.stem, {}), **self.load(path.stem).summary(), file=path.name)
+        with self._lock:
+            self._index = entries
+            self._write_index()
+        return entries
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Trim, smooth and store .motion recordings as indexed gestures.")
+    parser.add_argument("recordings", nargs="+", type=Path)
+    parser.add_argument("--out", type=Path, default=Path(__file__).parent / "gestures")
+    args = parser.parse_args()
+
+    from sic_framework.devices.common_naoqi.naoqi_motion_recorder import NaoqiMotionRecording
+
+    from sir_code.action import Action
+
+    store = GestureStore(args.out)
+    for path in args.recordings:
+        raw = NaoqiMotionRecording.load(str(path))
+        gesture = process_recording(path.stem, raw)
+        # the recordings of the actions (actions/<letter>.motion) get their description, the one the catalog
+        # matches the robot's replies against (see GestureCatalog)
+        description = Action.descriptions.get(path.stem)
+        size = store.save(gesture, **({"description": description} if description else {})).stat().st_size
+        print(f"{path.name}: {raw.recorded_times[0][-1]:.2f}s -> {gesture.duration:.2f}s, "
+              f"{path.stat().st_size} -> {size} bytes, moving: {', '.join(store.index[path.stem]['moving_joints'])}")
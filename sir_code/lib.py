@@ -1,5 +1,5 @@
 from abc import abstractmethod, ABC
-from typing import List, Dict, Iterator, Optional
+from typing import List, Dict, Iterator, Optional, Sequence
 
 
 class Agent(ABC):
@@ -10,3 +10,10 @@ class Agent(ABC):
     @abstractmethod
     def ask_stream(self, __input: List[Dict[str, str]], /, max_output_tokens: Optional[int] = None) -> Iterator[str]:
         ...
+
+    def ask_choice(self, __input: List[Dict[str, str]], /, choices: Sequence[str]) -> str:
+        """
+        Asks for a comma separated subset of `choices`, or 'None'. Agents supporting constrained decoding override
+        this so the answer can only contain allowed choices, others fall back to a short `ask`.
+        """
+        return self.ask(__input, max_output_tokens=16)
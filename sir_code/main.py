@@ -1,3 +1,4 @@
+import bisect
 import json
 import logging
 import time
@@ -5,8 +6,9 @@ from concurrent.futures import ThreadPoolExecutor as TPool
 from math import inf
 from pathlib import Path
 
+from sic_framework.core.message_python2 import AudioRequest
 from sic_framework.devices import Nao
-from sic_framework.devices.common_naoqi.naoqi_leds import NaoLEDRequest, NaoFadeRGBRequest
+from sic_framework.devices.common_naoqi.naoqi_leds import NaoLEDRequest, NaoFadeListRGBRequest
 from sic_framework.devices.common_naoqi.naoqi_motion_recorder import NaoqiMotionRecording, PlayRecording
 from sic_framework.devices.common_naoqi.naoqi_stiffness import Stiffness
 from sic_framework.devices.common_naoqi.naoqi_text_to_speech import (
@@ -20,9 +22,15 @@ from sic_framework.services.google_stt.google_stt import (
 )
 
 from sir_code.action import Action
+from sir_code.eye_leds import EyeAnimator
 from sir_code.chatgpt_wrapper import ChatGPTWrapper
+from sir_code.fillers import FillerCache, FillerPolicy, google_renderer
+from sir_code.gesture_catalog import GestureCatalog
+from sir_code.gestures import GestureStore
 from sir_code.loggers import MAIN_LOGGER
+from sir_code.model_router import ModelRouter, DEFAULT_ROUTES
 from sir_code.stage_detection import StageDetection
+from sir_code.tts_tags import normalize_tts_tags
 from sir_code.user_friendliness import UserFriendliness
 from sir_code.utils import print_section
 from sir_code.saver import Saver
@@ -164,6 +172,15 @@ I’ll start softly \\vol=40\\like this.\\rst\\ Now I’ll slow down \\rspd=70\\
 
 COLOR_MAP = {"RED": (1.00, 0.00, 0.00), "AMBER": (1.00, 0.75, 0.00), "WHITE": (1.00, 1.00, 1.00),
                          "GREEN": (0.00, 0.50, 0.00), "BRIGHT-GREEN": (0.20, 0.80, 0.20)}
+# eye color of the friendliness score, the last color whose threshold the score reaches
+_EYE_COLORS = "RED AMBER WHITE GREEN BRIGHT-GREEN".split()
+_EYE_THRESHOLDS = [-inf, -2.5, -.5, .5, 5]
+# words per second of the robot voice at speed 100
+_WORDS_PER_SECOND = 2.5
+# Google voice the fillers are rendered with, close to the robot voice
+FILLER_VOICE = "en-US-Standard-D"
+# cosine similarity of the reply and a gesture description below which no gesture is played
+GESTURE_MIN_SCORE = 0.4
 
 RUN_ROBOT = 1
 
@@ -171,10 +188,11 @@ class Demo:
     _logger = logging.getLogger("Demo.main")
 
     def __init__(self, friendliness_threshold: int = 0):
-        self.agent = ChatGPTWrapper()
-        self.friendliness = UserFriendliness(agent=self.agent, threshold=friendliness_threshold)
-        self.stage = StageDetection(agent=self.agent)
-        self.actions = Action(agent=self.agent)
+        self.router = ModelRouter(DEFAULT_ROUTES)
+        self.agent = self.router.agent("dialogue")
+        self.friendliness = UserFriendliness(agent=self.router.agent("friendliness"), threshold=friendliness_threshold)
+        self.stage = StageDetection(agent=self.router.agent("stage"))
+        self.actions = Action(agent=self.router.agent("action"))
         self.history = []
         self.audio_speed = 90
         self.audio_pitch = 85
@@ -185,8 +203,9 @@ class Demo:
             self.nao = Nao(ip="192.168.0.231")
             # input config
             self.desktop = Desktop()
+            google_key = json.load(open(Path(__file__).parent / "conf" / "google-key.json"))
             stt_conf = GoogleSpeechToTextConf(
-                keyfile_json=json.load(open(Path(__file__).parent / "conf" / "google-key.json")),
+                keyfile_json=google_key,
                 sample_rate_hertz=44100,
                 language="en-US",
                 interim_results=False,
@@ -194,8 +213,23 @@ class Demo:
             self.stt = GoogleSpeechToText(conf=stt_conf, input_source=self.desktop.mic)
 
             self.nao.leds.request(NaoLEDRequest("FaceLeds", True))
+            # eye animations are sent in batches from their own thread, without blocking the turn
+            self.eyes = EyeAnimator(lambda group, rgbs, durations: self.nao.leds.request(
+                NaoFadeListRGBRequest(group, rgbs, durations), block=False)).start()
+            self.eyes.idle(COLOR_MAP["WHITE"])
             self.nao.stiffness.request(Stiffness(stiffness=0.3, joints="Body".split()))
 
+            # fillers are rendered once per voice, speed and pitch in the background and played as audio on the
+            # robot: the robot voice cannot be rendered to a file through sic, a Google voice is used instead
+            self.fillers = FillerPolicy(FillerCache(google_renderer(google_key)),
+                                        lambda audio: self.nao.speaker.request(AudioRequest(*audio), block=False))
+            self.fillers.cache.warm_async(FILLER_VOICE, self.audio_speed, self.audio_pitch)
+
+            # gestures of the stored library (see gestures.py) looked up by the meaning of the reply, for the replies
+            # the action classifier finds no action for
+            self.gestures = GestureCatalog(GestureStore(Path(__file__).parent / "gestures"),
+                                           ChatGPTWrapper().embed, embed_name="text-embedding-3-small")
+
 
     def prompt_user_audio(self):
         input("\nUser speak:\n")
@@ -226,29 +260,40 @@ class Demo:
             )
             self.nao.motion_record.request(PlayRecording(NaoqiMotionRecording.load(f"actions/{action}.motion")))
 
-    def _nao_action_and_eye_color(self, actions):
+    def _recordings(self, actions, speech: str = ""):
+        """
+        The (name, recording) of the detected actions, or of the gesture of the library matching the reply best when
+        none was detected.
+        """
+        if actions:
+            return [(action, NaoqiMotionRecording.load(f"actions/{action}.motion")) for action in actions]
+        if not speech:
+            return []
+        try:
+            match = self.gestures.match(speech, min_score=GESTURE_MIN_SCORE)
+        except Exception:
+            self._logger.exception("gesture lookup failed")
+            return []
+        self._logger.debug(f"\ngesture matching the reply: {match}")
+        return [(name, self.gestures.load(name).to_recording()) for name, _ in match]
+
+    def _speech_seconds(self, text: str) -> float:
+        return len(text.split()) / _WORDS_PER_SECOND * 100 / self.audio_speed
+
+    def _nao_action_and_eye_color(self, actions, speech: str = ""):
         happiness = int(self.friendliness.current_score)  # clip to -5, 5 range
 
-        # eye color
-        _colors = "RED AMBER WHITE GREEN BRIGHT-GREEN".split()
-        _thresholds = [-inf, -2.5, -.5, .5, 5]
-        eye_color = [col for col, t in zip(_colors, _thresholds) if happiness >= t][-1]
+        # eye color, pulsing while Nao speaks then breathing
+        eye_color = _EYE_COLORS[bisect.bisect_right(_EYE_THRESHOLDS, happiness) - 1]
         print(f"NAO: *eyes are {eye_color}*")
+        self.eyes.speak(COLOR_MAP[eye_color], self._speech_seconds(speech))
         with TPool(max_workers=2) as executor:
-            for action in actions:
+            for action, recording in self._recordings(actions, speech):
                 self._logger.debug(
                     f"\ncurrent_action: {action},"
                     f"\ncurrent_time: {time.perf_counter()},"
                 )
-                executor.submit(self.nao.motion_record.request, PlayRecording(NaoqiMotionRecording.load(f"actions/{action}.motion")))
-
-            self._logger.debug(
-                f"\neye_color started time: {time.perf_counter()},"
-            )
-            executor.submit(self.nao.leds.request, NaoFadeRGBRequest("FaceLeds", *COLOR_MAP[eye_color], 10))
-            self._logger.debug(
-                f"\neye_color finished time: {time.perf_counter()},"
-            )
+                executor.submit(self.nao.motion_record.request, PlayRecording(recording))
 
     def main(self):
         self.history.append({"role": "system", "content": _AGENT_INTRO_CONTEXT})
@@ -257,7 +302,7 @@ class Demo:
 
         if RUN_ROBOT:
             self.history.append({"role": "system", "content": _DYNAMIC_SPEECH})
-            nao_welcome = self.agent.ask(self.history)
+            nao_welcome = normalize_tts_tags(self.agent.ask(self.history))
             self.history.pop()
 
             self.prompt_user_audio()
@@ -266,7 +311,7 @@ class Demo:
             actions = self.actions.detect(nao_text=nao_welcome)
             self.nao.tts.request(NaoqiTextToSpeechRequest(nao_welcome, speed=self.audio_speed,
                                 pitch=self.audio_pitch), block=False)
-            self._nao_action_and_eye_color(actions)
+            self._nao_action_and_eye_color(actions, nao_welcome)
         else:
             nao_welcome = self.agent.ask(self.history)
             print(f"User: {_USER_WELCOME}")
@@ -279,10 +324,11 @@ class Demo:
         for _ in range(100):
             if RUN_ROBOT:
                 user_input = self.prompt_user_audio()
+                self.fillers.maybe_play(FILLER_VOICE, self.audio_speed, self.audio_pitch)
             else:
                 user_input = self.prompt_user()
 
-            t = time.perf_counter()
+            turn_start = t = time.perf_counter()
             self.friendliness.score(nao_text=_last_nao_text, user_text=user_input)
             last_stage = self.stage.detect(nao_text=_last_nao_text)
 
@@ -297,13 +343,14 @@ class Demo:
             t = time.perf_counter()
             if RUN_ROBOT:
                 self.history.append({"role": "system", "content": _DYNAMIC_SPEECH})
-                resp = self.agent.ask(self.history)
+                resp = normalize_tts_tags(self.agent.ask(self.history))
                 self.history.pop()
                 print(resp)
                 actions = self.actions.detect(nao_text=resp)
                 self.nao.tts.request(NaoqiTextToSpeechRequest(resp, speed=self.audio_speed,
                                     pitch=self.audio_pitch), block=False)
-                self._nao_action_and_eye_color(actions)
+                self.fillers.observe(time.perf_counter() - turn_start)
+                self._nao_action_and_eye_color(actions, resp)
             else:
                 resp_chunks = []
                 for text in self.agent.ask_stream(self.history):
@@ -321,6 +368,11 @@ class Demo:
             self.history.append({"role": "assistant", "content": resp})
             _last_nao_text = resp
 
+        self._logger.debug(f"model routes:\n{self.router.report()}")
+        if RUN_ROBOT:
+            self._logger.debug(f"eye LEDs: {self.eyes.report()}")
+            self.eyes.stop()
+
 if __name__ == '__main__':
     MAIN_LOGGER.setLevel(logging.DEBUG)
     Demo().main()
\ No newline at end of file
@@ -0,0 +1,220 @@
+import logging
+import statistics
+import threading
+import time
+from pathlib import Path
+from typing import List, Dict, Iterator, Optional, Callable, Sequence, Iterable
+
+from sir_code.lib import Agent
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+
+class Route:
+    """
+    A class of calls (e.g. a classifier or the dialogue) served by an ordered list of models.
+    The first model is preferred, the following ones are the fallbacks used when the latency budget is exceeded.
+    A downgraded route probes the model it left with one call every `probe_interval` seconds and goes back to it
+    when that call is within the budget.
+    """
+    def __init__(self, models: Sequence[str], latency_slo: float, base_url: Optional[str] = None,
+                 min_samples: int = 3, smoothing: float = 0.3, probe_interval: float = 60.0):
+        assert models, "a route needs at least one model"
+        assert latency_slo > 0 and 0 < smoothing <= 1 and probe_interval > 0
+        self.models = list(models)
+        self.latency_slo = latency_slo
+        self.base_url = base_url
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.probe_interval = probe_interval
+
+
+DEFAULT_ROUTES = {
+    "friendliness": Route(["gpt-4o-mini", "gpt-4.1-nano"], latency_slo=1.0),
+    "stage": Route(["gpt-4o-mini", "gpt-4.1-nano"], latency_slo=1.0),
+    "action": Route(["gpt-4o-mini", "gpt-4.1-nano"], latency_slo=1.0),
+    "dialogue": Route(["gpt-4o", "gpt-4o-mini"], latency_slo=3.0),
+}
+
+
+class _ModelStats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ewma: Optional[float] = None
+        self.judged = 0
+        self.correct = 0
+
+    def add(self, latency: float, smoothing: float):
+        self.latencies.append(latency)
+        self.ewma = latency if self.ewma is None else smoothing * latency + (1 - smoothing) * self.ewma
+
+
+class _RoutedAgent(Agent):
+    """Agent handed to the callers of one route, every call goes through the router."""
+    def __init__(self, router: "ModelRouter", route: str):
+        self._router = router
+        self._route = route
+
+    def ask(self, __input: List[Dict[str, str]], /, max_output_tokens: Optional[int] = None) -> str:
+        model, agent = self._router.select(self._route)
+        t = time.perf_counter()
+        resp = agent.ask(__input, max_output_tokens=max_output_tokens)
+        self._router.observe(self._route, model, time.perf_counter() - t)
+        return resp
+
+    def ask_choice(self, __input: List[Dict[str, str]], /, choices: Sequence[str]) -> str:
+        model, agent = self._router.select(self._route)
+        t = time.perf_counter()
+        resp = agent.ask_choice(__input, choices=choices)
+        self._router.observe(self._route, model, time.perf_counter() - t)
+        return resp
+
+    def ask_stream(self, __input: List[Dict[str, str]], /, max_output_tokens: Optional[int] = None) -> Iterator[str]:
+        # for streamed calls the latency that matters is the time until the first delta
+        model, agent = self._router.select(self._route)
+        t = time.perf_counter()
+        observed = False
+        for delta in agent.ask_stream(__input, max_output_tokens=max_output_tokens):
+            if not observed:
+                self._router.observe(self._route, model, time.perf_counter() - t)
+                observed = True
+            yield delta
+        if not observed:
+            self._router.observe(self._route, model, time.perf_counter() - t)
+
+
+class ModelRouter:
+    """
+    Sends each class of calls to its own model or endpoint and enforces a latency budget per class.
+    When the smoothed latency of the active model exceeds the budget of its route, the route is downgraded
+    to its next model, and upgraded again once a probe of the previous model is within the budget.
+    """
+    _logger = logging.getLogger("Demo.ModelRouter")
+
+    def __init__(self, routes: Dict[str, Route],
+                 agent_factory: Optional[Callable[[str, Optional[str]], Agent]] = None):
+        if agent_factory is None:
+            from sir_code.chatgpt_wrapper import ChatGPTWrapper
+            agent_factory = ChatGPTWrapper
+        self.routes = routes
+        self._agent_factory = agent_factory
+        self._agents: Dict[tuple, Agent] = {}
+        self._active = {name: 0 for name in routes}
+        self._downgraded_at: Dict[str, float] = {}
+        self._probing: Dict[str, str] = {}
+        self._last_model: Dict[str, str] = {}
+        self._stats: Dict[str, Dict[str, _ModelStats]] = {
+            name: {model: _ModelStats() for model in route.models} for name, route in routes.items()
+        }
+        self._lock = threading.Lock()
+
+    def agent(self, route: str) -> Agent:
+        assert route in self.routes, f"unknown route '{route}', expected one of {list(self.routes)}"
+        return _RoutedAgent(self, route)
+
+    def active_model(self, route: str) -> str:
+        with self._lock:
+            return self.routes[route].models[self._active[route]]
+
+    def select(self, route: str):
+        conf = self.routes[route]
+        with self._lock:
+            idx = self._active[route]
+            if idx > 0 and time.monotonic() - self._downgraded_at[route] >= conf.probe_interval:
+                # one call goes to the previous model, its smoothed latency starts over from that call
+                idx -= 1
+                self._probing[route] = conf.models[idx]
+                self._downgraded_at[route] = time.monotonic()
+                self._stats[route][conf.models[idx]].ewma = None
+            model = conf.models[idx]
+            key = (model, conf.base_url)
+            if key not in self._agents:
+                # clients are shared between routes using the same model and endpoint
+                self._agents[key] = self._agent_factory(*key)
+            return model, self._agents[key]
+
+    def observe(self, route: str, model: str, latency: float):
+        conf = self.routes[route]
+        with self._lock:
+            stats = self._stats[route][model]
+            stats.add(latency, conf.smoothing)
+            self._last_model[route] = model
+            idx = self._active[route]
+            if self._probing.get(route) == model:
+                del self._probing[route]
+                if latency <= conf.latency_slo:
+                    self._active[route] = idx = conf.models.index(model)
+                    self._logger.info(f"route '{route}': {model} answered in {latency:.3f}s, upgrading back to it")
+                else:
+                    return
+            if (conf.models[idx] == model and idx + 1 < len(conf.models)
+                    and len(stats.latencies) >= conf.min_samples and stats.ewma > conf.latency_slo):
+                self._active[route] = idx + 1
+                self._downgraded_at[route] = time.monotonic()
+                self._logger.warning(
+                    f"route '{route}': {model} latency {stats.ewma:.3f}s exceeds budget {conf.latency_slo:.3f}s, "
+                    f"downgrading to {conf.models[idx + 1]}"
+                )
+
+    def record_outcome(self, route: str, correct: bool):
+        """Attribute the correctness of the last answer on `route` to the model that produced it."""
+        with self._lock:
+            stats = self._stats[route][self._last_model[route]]
+            stats.judged += 1
+            stats.correct += bool(correct)
+
+    def report(self) -> str:
+        lines = [f"{'route':<14}{'model':<16}{'calls':>6}{'p50':>8}{'p95':>8}{'slo':>7}{'acc':>7}"]
+        with self._lock:
+            for name, per_model in self._stats.items():
+                for model, stats in per_model.items():
+                    if not stats.latencies:
+                        continue
+                    lat = sorted(stats.latencies)
+                    p95 = lat[min(len(lat) - 1, int(round(0.95 * (len(lat) - 1))))]
+                    acc = f"{stats.correct / stats.judged:.2f}" if stats.judged else "n/a"
+                    active = "*" if model == self.routes[name].models[self._active[name]] else " "
+                    lines.append(
+                        f"{name:<14}{active + model:<16}{len(lat):>6}{statistics.median(lat):>8.3f}"
+                        f"{p95:>8.3f}{self.routes[name].latency_slo:>7.2f}{acc:>7}"
+                    )
+        return "\n".join(lines)
+
+
+def replay(router: ModelRouter, csv_files: Iterable[Path]) -> str:
+    """
+    Replays the recorded conversations through the classifier routes and returns the per route report.
+    Friendliness answers are compared with the letters recorded during the session, the other routes
+    have no labels and only report latency.
+    """
+    import pandas as pd
+
+    from sir_code.action import Action
+    from sir_code.stage_detection import StageDetection
+    from sir_code.user_friendliness import UserFriendliness
+
+    friendliness = UserFriendliness(agent=router.agent("friendliness"))
+    stage = StageDetection(agent=router.agent("stage"))
+    actions = Action(agent=router.agent("action"))
+
+    for csv_file in csv_files:
+        df = pd.read_csv(csv_file)
+        last_nao_text = None
+        for row in df.itertuples():
+            # the letters of a row score the user text against the previous nao text, as in Demo.main
+            if last_nao_text is not None:
+                _, letters = friendliness.score(nao_text=last_nao_text, user_text=row.user_text, save=False)
+                label = "" if pd.isna(row.user_friendliness_score) else str(row.user_friendliness_score)
+                router.record_outcome("friendliness", letters == label)
+                stage.detect(nao_text=last_nao_text)
+            actions.detect(nao_text=row.nao_text)
+            last_nao_text = row.nao_text
+
+    return router.report()
+
+
+if __name__ == '__main__':
+    from sir_code.saver import CSV_FILE_PATH
+
+    print(replay(ModelRouter(DEFAULT_ROUTES), sorted(CSV_FILE_PATH.glob("*.csv"))))
@@ -0,0 +1,226 @@
+import logging
+import pickle
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+NAO_JOINTS = ["HeadYaw", "HeadPitch"] + [side + name for side in "LR" for name in (
+    "ShoulderPitch", "ShoulderRoll", "ElbowYaw", "ElbowRoll", "WristYaw", "Hand",
+    "HipYawPitch", "HipRoll", "HipPitch", "KneePitch", "AnklePitch", "AnkleRoll")]
+# NAO joints whose angle changes sign when the motion is mirrored left to right
+_MIRRORED_SIGNS = ("HeadYaw", "ShoulderRoll", "ElbowYaw", "ElbowRoll", "WristYaw", "HipRoll", "AnkleRoll")
+
+
+class JointMap:
+    """
+    Maps the joints of the master to the joints of a puppet: `mapping` is master joint -> (puppet joint, sign),
+    joints missing from it are dropped. The index of a joint list is built once and reused for every sample.
+    """
+
+    def __init__(self, mapping: Dict[str, Tuple[str, float]]):
+        self.mapping = dict(mapping)
+        self._plans: Dict[Tuple[str, ...], Tuple[List[str], List[Tuple[int, float]]]] = {}
+
+    def apply(self, joints: Sequence[str], angles: Sequence[float]) -> Tuple[List[str], List[float]]:
+        key = tuple(joints)
+        plan = self._plans.get(key)
+        if plan is None:
+            names, sources = [], []
+            for i, joint in enumerate(joints):
+                if joint in self.mapping:
+                    target, sign = self.mapping[joint]
+                    names.append(target)
+                    sources.append((i, sign))
+            plan = self._plans[key] = (names, sources)
+        names, sources = plan
+        return names, [angles[i] * sign for i, sign in sources]
+
+
+def mirror_map(joints: Sequence[str] = NAO_JOINTS) -> JointMap:
+    """The puppet mirrors the master, left and right swapped, e.g. for a puppet facing the same audience."""
+    mapping = {}
+    for joint in joints:
+        side = {"L": "R", "R": "L"}.get(joint[0])
+        target = side + joint[1:] if side else joint
+        sign = -1.0 if (joint[1:] if side else joint) in _MIRRORED_SIGNS else 1.0
+        mapping[joint] = (target, sign)
+    return JointMap(mapping)
+
+
+class _Puppet:
+    def __init__(self, name: str, send: Callable[[Any], Any], max_rate: Optional[float], joint_map: Optional[JointMap]):
+        self.name = name
+        self.send = send
+        self.period = 1 / max_rate if max_rate else 0.0
+        self.joint_map = joint_map
+        self.last: Optional[float] = None
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+
+
+def sic_payload(message_class: Callable[[List[str], List[float]], Any],
+                clock: Callable[[], float]) -> Callable[[List[str], List[float]], bytes]:
+    """
+    `serialize` of a `MotionFanout` for sic puppets: the sample as a `message_class` (e.g. `NaoJointAngles`) stamped
+    with `clock` (e.g. a `RedisClock`, the clock `SICConnector.send_message` stamps with) and serialized, once.
+    """
+    def serialize(joints: List[str], angles: List[float]) -> bytes:
+        message = message_class(joints, angles)
+        stamp = clock()
+        # as redis TIME replies, the stamps of sic messages
+        message._timestamp = (int(stamp), int(stamp % 1 * 1e6))
+        return message.serialize()
+    return serialize
+
+
+def sic_publisher(connector: Any) -> Callable[[bytes], Any]:
+    """
+    `send` of a sic puppet for the payloads of `sic_payload`: publishes them on the input channel of its connector
+    (e.g. `Nao.motion_streaming()`), what `SICConnector.send_message` does once it stamped and serialized a message.
+    """
+    redis = connector._redis._redis
+    channel = connector.get_input_channel()
+    return lambda payload: redis.publish(channel, payload)
+
+
+class MotionFanout:
+    """
+    Drives any number of puppets from one master stream. Every sample is mapped and turned into a payload once per
+    joint map, the puppets sharing a map (or none) get the same payload, and each puppet is rate limited on its own.
+    `serialize(joints, angles)` builds the payload handed to the `send` of the puppets: bytes for a raw transport
+    (the default, pickled), `sic_payload` with `sic_publisher` for sic puppets. A message such as `NaoJointAngles`
+    with `SICConnector.send_message` works too, but `send_message` stamps and serializes it again for every puppet.
+    """
+    _logger = logging.getLogger("Demo.MotionFanout")
+
+    def __init__(self, serialize: Optional[Callable[[List[str], List[float]], Any]] = None):
+        self._serialize = serialize or (lambda joints, angles: pickle.dumps((joints, angles), pickle.HIGHEST_PROTOCOL))
+        self._puppets: List[_Puppet] = []
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.serializations = 0
+        self.busy = 0.0
+
+    def add(self, name: str, send: Callable[[Any], Any], max_rate: Optional[float] = None,
+            joint_map: Optional[JointMap] = None):
+        with self._lock:
+            self._puppets.append(_Puppet(name, send, max_rate, joint_map))
+
+    def publish(self, joints: Sequence[str], angles: Sequence[float], stamp: Optional[float] = None) -> int:
+        """
+        Sends a master sample to the puppets that are due, returns how many were sent to. The payloads are built
+        under the lock and sent outside it, so a slow puppet does not hold up `add`, `report` or the next sample.
+        """
+        start = time.perf_counter()
+        stamp = time.time() if stamp is None else stamp
+        payloads: Dict[int, Any] = {}
+        due: List[Tuple[_Puppet, Any]] = []
+        with self._lock:
+            self.samples += 1
+            for puppet in self._puppets:
+                # a sample slightly early because of the sampling jitter is still due
+                if puppet.last is not None and stamp - puppet.last < 0.9 * puppet.period:
+                    puppet.skipped += 1
+                    continue
+                key = id(puppet.joint_map)
+                if key not in payloads:
+                    mapped = (puppet.joint_map.apply(joints, angles) if puppet.joint_map
+                              else (list(joints), list(angles)))
+                    payloads[key] = self._serialize(*mapped)
+                    self.serializations += 1
+                puppet.last = stamp
+                due.append((puppet, payloads[key]))
+        failed = []
+        for puppet, payload in due:
+            try:
+                puppet.send(payload)
+            except Exception:
+                failed.append(puppet)
+                self._logger.exception(f"sending to puppet {puppet.name} failed")
+        with self._lock:
+            for puppet, _ in due:
+                if puppet in failed:
+                    puppet.failed += 1
+                else:
+                    puppet.sent += 1
+            self.busy += time.perf_counter() - start
+        return len(due) - len(failed)
+
+    def report(self) -> str:
+        with self._lock:
+            puppets = ", ".join(f"{p.name}: {p.sent} sent, {p.skipped} skipped"
+                                + (f", {p.failed} failed" if p.failed else "") for p in self._puppets)
+            return (f"{self.samples} samples, {self.serializations} serializations, "
+                    f"{self.busy / max(self.samples, 1) * 1e6:.0f}us per sample ({puppets})")
+
+
+if __name__ == '__main__':
+    # per sample cost of driving N puppets from a 30Hz stream of the 14 Head and arm joints, half of the puppets
+    # mirrored and every other one at 15Hz, through the code of sic without the network (a redis client counting
+    # what is published): one stream per puppet through `SICConnector.send_message`, the fan-out handing a
+    # `NaoJointAngles` to `send_message`, and the fan-out publishing the payloads of `sic_payload`
+    from types import SimpleNamespace
+
+    from sic_framework.core.connector import SICConnector
+    from sic_framework.core.sic_redis import SICRedisConnection
+    from sic_framework.devices.common_naoqi.nao_motion_streamer import NaoJointAngles
+
+    class CountingRedis:
+        def __init__(self):
+            self.published = 0
+
+        def time(self):
+            stamp = time.time()
+            return int(stamp), int(stamp % 1 * 1e6)
+
+        def publish(self, channel, data):
+            self.published += len(data)
+            return 1
+
+    client = CountingRedis()
+    connection = SICRedisConnection.__new__(SICRedisConnection)
+    connection.stopping = False
+    connection._redis = client
+    connection.parent_logger = None
+    connection._running_callbacks = []
+
+    def connector(p):
+        return SimpleNamespace(_redis=connection, _get_timestamp=client.time, input_channel=f"puppet{p}:input",
+                               get_input_channel=lambda: f"puppet{p}:input")
+
+    def send_message(puppet):
+        return lambda message: SICConnector.send_message(puppet, message)
+
+    joints = [joint for joint in NAO_JOINTS if joint.startswith("Head") or joint[1:] in
+              ("ShoulderPitch", "ShoulderRoll", "ElbowYaw", "ElbowRoll", "WristYaw", "Hand")]
+    angles = [0.1 * i for i in range(len(joints))]
+    mirror = mirror_map()
+    samples = 1000
+    print(f"{'puppets':>7} {'per puppet':>12} {'send_message':>13} {'sic_payload':>12}")
+    for n in (1, 2, 4, 8, 16, 32):
+        puppets = [connector(p) for p in range(n)]
+        start = time.perf_counter()
+        for i in range(samples):
+            for p, puppet in enumerate(puppets):
+                if p % 2 and i % 2:
+                    continue
+                mapped = mirror.apply(joints, angles) if p % 2 else (list(joints), list(angles))
+                SICConnector.send_message(puppet, NaoJointAngles(*mapped))
+        naive = (time.perf_counter() - start) / samples
+        results = [naive]
+        variants = ((NaoJointAngles, send_message), (sic_payload(NaoJointAngles, time.time), sic_publisher))
+        for serialize, sender in variants:
+            fanout = MotionFanout(serialize)
+            for p, puppet in enumerate(puppets):
+                fanout.add(f"puppet {p}", sender(puppet), max_rate=15 if p % 2 else None,
+                           joint_map=mirror if p % 2 else None)
+            start = time.perf_counter()
+            for i in range(samples):
+                fanout.publish(joints, angles, i / 30)
+            results.append((time.perf_counter() - start) / samples)
+        print(f"{n:>7} " + " ".join(f"{seconds * 1e6:>10.1f}us" for seconds in results))
@@ -0,0 +1,130 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from sir_code.gestures import resample_recording
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+
+class JointPredictor:
+    """
+    Constant velocity extrapolation per joint from the last two samples of a motion stream, so the puppet can be
+    commanded where the master will be instead of where it was when the sample was taken.
+    Extrapolation is limited to `max_horizon` seconds past the last sample: a stream that stops does not fly off, and
+    on the recorded actions the capped extrapolation tracks better than the uncapped one at lags above it, see
+    `evaluate`.
+    """
+    _logger = logging.getLogger("Demo.JointPredictor")
+
+    def __init__(self, max_horizon: float = 0.15):
+        assert max_horizon >= 0
+        self.max_horizon = max_horizon
+        self.joints: List[str] = []
+        self._angles: Optional[np.ndarray] = None
+        self._velocity: Optional[np.ndarray] = None
+        self._stamp = 0.0
+        self._lock = threading.Lock()
+        self.samples = 0
+        self.out_of_order = 0
+        self.predictions = 0
+        self.capped = 0
+
+    def update(self, joints: Sequence[str], angles: Sequence[float], stamp: float):
+        """Takes the angles sampled at `stamp`, the velocity is the difference with the previous sample."""
+        z = np.asarray(angles, dtype=np.float64)
+        with self._lock:
+            if self._angles is None or list(joints) != self.joints:
+                self.joints = list(joints)
+                self._velocity = np.zeros_like(z)
+            elif stamp <= self._stamp:
+                self.out_of_order += 1
+                return
+            else:
+                self._velocity = (z - self._angles) / (stamp - self._stamp)
+            self._angles = z
+            self._stamp = stamp
+            self.samples += 1
+
+    def predict(self, stamp: float) -> Optional[List[float]]:
+        """The angles extrapolated to `stamp`, None before the first sample."""
+        with self._lock:
+            if self._angles is None:
+                return None
+            horizon = max(stamp - self._stamp, 0.0)
+            self.predictions += 1
+            if horizon > self.max_horizon:
+                self.capped += 1
+                horizon = self.max_horizon
+            return (self._angles + self._velocity * horizon).tolist()
+
+    def report(self) -> str:
+        with self._lock:
+            if not self.samples:
+                return "no samples"
+            capped = self.capped / self.predictions if self.predictions else 0.0
+            return (f"{len(self.joints)} joints, {self.samples} samples, {self.out_of_order} out of order, "
+                    f"{self.predictions} predictions ({capped:.0%} capped at {self.max_horizon * 1000:.0f}ms)")
+
+
+def load_recording(path: Path) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Joint names, sample times (T,) and angles (T, joints) of a recorded .motion file."""
+    from sic_framework.devices.common_naoqi.naoqi_motion_recorder import NaoqiMotionRecording
+
+    return resample_recording(NaoqiMotionRecording.load(str(path)))
+
+
+def _hold(times: np.ndarray, angles: np.ndarray, arrived: int, t: float) -> np.ndarray:
+    return angles[arrived - 1]
+
+
+def _extrapolate(times: np.ndarray, angles: np.ndarray, arrived: int, t: float) -> np.ndarray:
+    if arrived < 2:
+        return angles[arrived - 1]
+    velocity = (angles[arrived - 1] - angles[arrived - 2]) / (times[arrived - 1] - times[arrived - 2])
+    return angles[arrived - 1] + velocity * (t - times[arrived - 1])
+
+
+def evaluate(streams: Sequence[Tuple[np.ndarray, np.ndarray]], lags: Sequence[float], rate: float = 30.0,
+             predictor: Callable[[], JointPredictor] = JointPredictor) -> Dict[str, List[float]]:
+    """
+    Replays recorded (times, angles) streams to a puppet commanded at `rate` Hz whose samples arrive `lag` seconds
+    (network and actuation) after they were taken, and returns per method the RMS tracking error in radians, one
+    per lag, between the angles the puppet reaches and the master angles at that moment:
+    - hold: the last sample, what the puppet does now,
+    - extrapolate: the last two samples at constant velocity, up to the lag,
+    - predictor: a `JointPredictor`, the same extrapolation capped at its `max_horizon`.
+    """
+    errors: Dict[str, List[float]] = {"hold": [], "extrapolate": [], "predictor": []}
+    for lag in lags:
+        squared: Dict[str, List[np.ndarray]] = {name: [] for name in errors}
+        for times, angles in streams:
+            joint_predictor = predictor()
+            joints = [str(j) for j in range(angles.shape[1])]
+            arrived = 0
+            for t in np.arange(times[0] + lag, times[-1], 1 / rate):
+                while arrived < len(times) and times[arrived] + lag <= t:
+                    joint_predictor.update(joints, angles[arrived], times[arrived])
+                    arrived += 1
+                truth = np.array([np.interp(t, times, angles[:, j]) for j in range(angles.shape[1])])
+                squared["hold"].append((_hold(times, angles, arrived, t) - truth) ** 2)
+                squared["extrapolate"].append((_extrapolate(times, angles, arrived, t) - truth) ** 2)
+                squared["predictor"].append((np.asarray(joint_predictor.predict(t)) - truth) ** 2)
+        for name in errors:
+            errors[name].append(float(np.sqrt(np.mean(squared[name]))))
+    return errors
+
+
+if __name__ == '__main__':
+    # the pre-recorded actions of the demo, replayed at increasing end-to-end delays
+    paths = sorted((Path(__file__).parent / "actions").glob("*.motion"))
+    lags = [0.0, 0.05, 0.1, 0.15, 0.2, 0.3]
+    result = evaluate([load_recording(path)[1:] for path in paths], lags)
+    print(f"RMS tracking error (rad) over {len(paths)} recordings")
+    print(f"{'lag (ms)':<12}" + "".join(f"{lag * 1000:>8.0f}" for lag in lags))
+    for name, errors in result.items():
+        print(f"{name:<12}" + "".join(f"{error:>8.4f}" for error in errors))
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+ABSENT = "absent"
+ARRIVING = "arriving"
+PRESENT = "present"
+LEAVING = "leaving"
+
+
+class PresenceMonitor:
+    """
+    Presence of a user from the face detection results, with hysteresis so a single missed or spurious detection
+    does not toggle the expensive pipelines:
+    - absent -> arriving on a frame with a face, arriving -> present once faces were seen for `enter_dwell` seconds
+      (back to absent when they disappear for `gap` seconds meanwhile),
+    - present -> leaving on a frame without a face, leaving -> absent once none was seen for `leave_dwell` seconds
+      (back to present on the next face).
+    Callbacks registered with `on_arrive` (pre-warming) run on arriving, the ones of `on_present` on present, the
+    ones of `on_leave` (suspending) on absent. They run on the thread calling `observe`, so keep them short or
+    start a thread.
+    Stamps are in seconds, the same clock for every call (e.g. sic message timestamps).
+    """
+    _logger = logging.getLogger("Demo.PresenceMonitor")
+
+    def __init__(self, enter_dwell: float = 0.5, leave_dwell: float = 5.0, gap: float = 0.3):
+        assert enter_dwell >= 0 and leave_dwell >= 0 and gap >= 0
+        self.enter_dwell = enter_dwell
+        self.leave_dwell = leave_dwell
+        self.gap = gap
+        self.state = ABSENT
+        self.visits = 0
+        self.present_time = 0.0
+        self._since: Optional[float] = None
+        self._last_face: Optional[float] = None
+        self._present = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {ARRIVING: [], PRESENT: [], ABSENT: []}
+
+    def on_arrive(self, callback: Callable[[], None]):
+        self._callbacks[ARRIVING].append(callback)
+
+    def on_present(self, callback: Callable[[], None]):
+        self._callbacks[PRESENT].append(callback)
+
+    def on_leave(self, callback: Callable[[], None]):
+        self._callbacks[ABSENT].append(callback)
+
+    @property
+    def present(self) -> bool:
+        """Whether a user is there, also while leaving: the conversation goes on until `leave_dwell` expires."""
+        return self._present.is_set()
+
+    @property
+    def demand(self) -> float:
+        """
+        Demand for the face detector (see `DetectionGovernor.set_demand`): full while somebody is or might be there,
+        none while absent, the detector then runs at its minimum rate, enough to notice an arrival.
+        """
+        return 0.0 if self.state == ABSENT else 1.0
+
+    def wait_present(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until a user is present, instead of polling `present`, returns False on timeout."""
+        return self._present.wait(timeout)
+
+    def _enter(self, state: str, stamp: float) -> List[Callable[[], None]]:
+        self._logger.debug(f"presence {self.state} -> {state}")
+        if state == PRESENT and self.state == ARRIVING:
+            self.visits += 1
+        if self.state in (PRESENT, LEAVING) and state == ABSENT:
+            self.present_time += stamp - self._since
+        if state == PRESENT:
+            self._present.set()
+        elif state == ABSENT:
+            self._present.clear()
+        resumed = (state, self.state) in ((PRESENT, LEAVING), (LEAVING, PRESENT))
+        if not resumed:
+            self._since = stamp
+        self.state = state
+        return [] if resumed else self._callbacks.get(state, [])
+
+    def observe(self, faces: bool, stamp: Optional[float] = None) -> str:
+        """Feeds a detection result (whether it has any face), returns the new state."""
+        now = time.time() if stamp is None else stamp
+        callbacks: List[Callable[[], None]] = []
+        with self._lock:
+            if faces:
+                self._last_face = now
+            if self.state == ABSENT and faces:
+                callbacks = self._enter(ARRIVING, now)
+                if self.enter_dwell == 0:
+                    callbacks = callbacks + self._enter(PRESENT, now)
+            elif self.state == ARRIVING:
+                if now - self._last_face > self.gap:
+                    callbacks = self._enter(ABSENT, now)
+                elif now - self._since >= self.enter_dwell:
+                    callbacks = self._enter(PRESENT, now)
+            elif self.state == PRESENT and not faces:
+                callbacks = self._enter(LEAVING, now)
+            elif self.state == LEAVING:
+                if faces:
+                    callbacks = self._enter(PRESENT, now)
+                elif now - self._last_face >= self.leave_dwell:
+                    callbacks = self._enter(ABSENT, now)
+            state = self.state
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                self._logger.exception("presence callback failed")
+        return state
+
+    def report(self) -> str:
+        with self._lock:
+            return f"{self.state}, {self.visits} visits, present for {self.present_time:.0f}s in total"
+
+
+if __name__ == '__main__':
+    import random
+
+    # 5fps detections: nobody, a passer-by, a user with missed detections, nobody, and a single false positive
+    random.seed(0)
+    monitor = PresenceMonitor()
+    transitions = []
+    for state in (ARRIVING, PRESENT, ABSENT):
+        monitor._callbacks[state].append(lambda state=state: transitions.append((t, state)))
+    script = [(10, 0.0), (0.2, 1.0), (10, 0.0), (30, 0.8), (20, 0.0), (0.2, 1.0), (10, 0.0)]
+    t = 0.0
+    for seconds, rate in script:
+        end = t + seconds
+        while t < end:
+            monitor.observe(random.random() < rate, t)
+            t += 0.2
+    print(", ".join(f"{state} at {stamp:.1f}s" for stamp, state in transitions))
+    print(monitor.report())
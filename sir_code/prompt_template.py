@@ -0,0 +1,84 @@
+import re
+from typing import Dict, List, Optional
+
+from sir_code.utils import multiline_strip
+
+try:
+    import tiktoken
+except ImportError:  # token counts are estimated without tiktoken
+    tiktoken = None
+
+
+def count_tokens(text: str, model: str = "gpt-4o-mini") -> int:
+    """Tokens of `text` for `model`, about 4 characters per token without tiktoken."""
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.get_encoding("o200k_base")
+    return len(encoding.encode(text))
+
+
+class PromptTemplate:
+    """
+    Classifier prompt stripped once, with the "K) description" lines of the descriptions for `{options}` rendered
+    once per descriptions, so each call is a single `str.format_map` of the turn fields (e.g `{nao_text}`).
+    `fixed_tokens` counts the tokens of everything but the turn fields, sent with every call.
+    """
+
+    def __init__(self, template: str, model: str = "gpt-4o-mini"):
+        self.raw_template = template
+        self.template = multiline_strip(template)
+        self.model = model
+        self.fields: List[str] = [name for name in re.findall(r"{(\w+)}", template) if name != "options"]
+        self._descriptions: Optional[Dict[str, str]] = None
+        self._options = ""
+        self._fixed_tokens = 0
+
+    def _prepare(self, descriptions: Dict[str, str]):
+        if descriptions != self._descriptions:
+            self._options = multiline_strip("\n".join(f"{k}) {v}" for k, v in descriptions.items()))
+            fixed = self.template.format_map(dict({name: "" for name in self.fields}, options=self._options))
+            self._fixed_tokens = count_tokens(fixed, self.model)
+            self._descriptions = dict(descriptions)
+
+    def render(self, descriptions: Dict[str, str], **fields: str) -> str:
+        self._prepare(descriptions)
+        # multi-line turn text is stripped line by line, as the whole prompt is
+        fields = {name: multiline_strip(value) if "\n" in value else value for name, value in fields.items()}
+        return self.template.format_map(dict(fields, options=self._options))
+
+    def render_legacy(self, descriptions: Dict[str, str], **fields: str) -> str:
+        """Formats and strips the whole prompt, as the classifiers did on every call before."""
+        options_text = "\n".join(f"{k}) {v}" for k, v in descriptions.items())
+        return multiline_strip(self.raw_template.format(options=options_text, **fields))
+
+    def fixed_tokens(self, descriptions: Dict[str, str]) -> int:
+        """Tokens of the prompt without the turn fields: the instructions and the options."""
+        self._prepare(descriptions)
+        return self._fixed_tokens
+
+
+if __name__ == '__main__':
+    import timeit
+
+    from sir_code.action import Action
+    from sir_code.stage_detection import StageDetection
+    from sir_code.user_friendliness import UserFriendliness
+
+    nao_text = ("Ah, a seeker at heart! There’s a certain magic in pursuing the unknown. "
+                "What kind of thing are you searching for, if you don’t mind my curiosity?")
+    user_text = "Ah yes, I have been trekking the frozen peaks, looking for treasure, but have had no luck."
+    n = 20000
+    print(f"fixed tokens counted with {'tiktoken' if tiktoken else 'an estimate of 4 characters per token'}")
+    for cls in (Action, StageDetection, UserFriendliness):
+        prompt = cls._prompt
+        fields = {"nao_text": nao_text, "user_text": user_text}
+        fields = {name: fields[name] for name in prompt.fields}
+        assert prompt.render(cls.descriptions, **fields) == prompt.render_legacy(cls.descriptions, **fields)
+        legacy = timeit.timeit(lambda: prompt.render_legacy(cls.descriptions, **fields), number=n) / n
+        compiled = timeit.timeit(lambda: prompt.render(cls.descriptions, **fields), number=n) / n
+        print(f"{cls.__name__:<18} fixed tokens: {prompt.fixed_tokens(cls.descriptions):>4}  "
+              f"legacy: {legacy * 1e6:7.2f}us  precompiled: {compiled * 1e6:6.2f}us  "
+              f"saved: {(legacy - compiled) * 1e6:6.2f}us/call")
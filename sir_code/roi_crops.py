@@ -0,0 +1,167 @@
+import importlib.util
+import logging
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, List, Optional, Sequence
+
+import numpy as np
+
+from sir_code.boxes import Box, box_tuple
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+# the bundled, patched PyTurboJPEG (crop_multiple, output buffers), loaded by path so an installed upstream
+# turbojpeg package is never picked up instead
+_TURBOJPEG_PATH = Path(__file__).parent.parent / "lib" / "libtubojpeg" / "PyTurboJPEG-master" / "turbojpeg.py"
+if _TURBOJPEG_PATH.exists():
+    _spec = importlib.util.spec_from_file_location("sir_code._turbojpeg", _TURBOJPEG_PATH)
+    turbojpeg = importlib.util.module_from_spec(_spec)
+    _spec.loader.exec_module(turbojpeg)
+    TurboJPEG = turbojpeg.TurboJPEG
+else:
+    TurboJPEG = None
+
+def align_box(box: Box, width: int, height: int, mcu_width: int, mcu_height: int, margin: float = 0.0) -> Optional[Box]:
+    """
+    Grows a box by `margin` (a fraction of its size) and to the MCU grid, the origin of a lossless crop has to be on
+    the grid. The box is clipped to the image, None if nothing is left.
+    """
+    x, y, w, h = box
+    x0, y0 = x - int(w * margin), y - int(h * margin)
+    x1, y1 = x + w + int(w * margin), y + h + int(h * margin)
+    x0 = max(x0, 0) // mcu_width * mcu_width
+    y0 = max(y0, 0) // mcu_height * mcu_height
+    x1 = min(-(-x1 // mcu_width) * mcu_width, width)
+    y1 = min(-(-y1 // mcu_height) * mcu_height, height)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0, y0, x1 - x0, y1 - y0
+
+
+def subscribe_jpeg(redis: Any, channel: str, callback: Callable[[bytes, Any], None]) -> Any:
+    """
+    Calls `callback(jpeg, message)` for the `CompressedImageMessage`s on a sic channel (e.g. the camera's
+    `get_component_channel()`) with the JPEG of the image as it was sent: sic decodes the images of the messages it
+    delivers, a lossless crop needs the compressed frame. `redis` is a `SICRedisConnection`, the returned thread has
+    a `stop()`.
+    """
+    from sic_framework.core.message_python2 import SICMessage
+
+    pubsub = redis._redis.pubsub(ignore_subscribe_messages=True)
+
+    def on_message(pubsub_message):
+        # only unpickled: the image field is left the JPEG that `SICMessage.deserialize` would decode
+        message = SICMessage._pickle_load(pubsub_message["data"])
+        jpeg = getattr(message, "image", None)
+        if isinstance(jpeg, str):
+            jpeg = jpeg.encode("latin1")
+        if isinstance(jpeg, bytes):
+            callback(jpeg, message)
+
+    pubsub.subscribe(**{channel: on_message})
+    return pubsub.run_in_thread(sleep_time=0.1, daemon=True)
+
+
+class RoiCrop:
+    def __init__(self, box: Box, region: Box, jpeg: bytes):
+        self.box = box
+        self.region = region
+        self.jpeg = jpeg
+
+
+class RoiCropper:
+    """
+    Forwards the detected faces (or objects) of a frame as JPEG crops cut in the compressed domain: the boxes are
+    aligned to the MCU grid and cropped with a single lossless `TurboJPEG.crop_multiple`, without a decode/encode
+    round trip. Keeps the bytes saved compared to forwarding the whole frame per ROI and the latency per ROI.
+    """
+    _logger = logging.getLogger("Demo.RoiCropper")
+
+    def __init__(self, jpeg: Optional["TurboJPEG"] = None, margin: float = 0.1, gray: bool = False):
+        if jpeg is None:
+            if TurboJPEG is None:
+                raise ImportError(f"RoiCropper needs the bundled PyTurboJPEG at {_TURBOJPEG_PATH}")
+            jpeg = TurboJPEG()
+        self._jpeg = jpeg
+        self.margin = margin
+        self.gray = gray
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.rois = 0
+        self.frame_bytes = 0
+        self.crop_bytes = 0
+        self.seconds = 0.0
+
+    def crop(self, jpeg_buf: bytes, boxes: Sequence) -> List[RoiCrop]:
+        """Crops the boxes of one detection message (e.g. `BoundingBoxesMessage.bboxes`) out of the JPEG frame."""
+        t = time.perf_counter()
+        width, height, subsample, _ = self._jpeg.decode_header(jpeg_buf)
+        boxes = [box_tuple(box) for box in boxes]
+        aligned = [(box, align_box(box, width, height, turbojpeg.tjMCUWidth[subsample],
+                                   turbojpeg.tjMCUHeight[subsample], self.margin))
+                   for box in boxes]
+        aligned = [(box, region) for box, region in aligned if region is not None]
+        if not aligned:
+            return []
+        # regions inside the frame never need the background fill
+        jpegs = self._jpeg.crop_multiple(jpeg_buf, [region for _, region in aligned], background_luminance=0.5,
+                                         gray=self.gray)
+        elapsed = time.perf_counter() - t
+
+        crops = [RoiCrop(box, region, data) for (box, region), data in zip(aligned, jpegs)]
+        self._count(crops, len(jpeg_buf), elapsed)
+        return crops
+
+    def decode(self, jpeg_buf: bytes) -> np.ndarray:
+        """The decoded frame, writable and contiguous as the images of sic messages are."""
+        return np.array(self._jpeg.decode(jpeg_buf))
+
+    def _count(self, crops: List[RoiCrop], frame_bytes: int, elapsed: float):
+        crop_bytes = sum(len(crop.jpeg) for crop in crops)
+        with self._lock:
+            self.frames += 1
+            self.rois += len(crops)
+            self.frame_bytes += frame_bytes * len(crops)
+            self.crop_bytes += crop_bytes
+            self.seconds += elapsed
+        self._logger.debug(f"{len(crops)} ROIs, {frame_bytes * len(crops) - crop_bytes} bytes saved, "
+                           f"{elapsed / len(crops) * 1000:.2f}ms per ROI")
+
+    def report(self) -> str:
+        with self._lock:
+            if not self.rois:
+                return "no ROI cropped"
+            saved = self.frame_bytes - self.crop_bytes
+            return (f"{self.rois} ROIs in {self.frames} frames, {self.crop_bytes / self.rois:.0f} bytes per ROI, "
+                    f"{saved} bytes saved ({saved / self.frame_bytes:.0%}), "
+                    f"{self.seconds / self.rois * 1000:.2f}ms per ROI")
+
+
+if __name__ == '__main__':
+    import sys
+
+    lib_path = sys.argv[1] if len(sys.argv) > 1 else None
+    jpeg = TurboJPEG(lib_path)
+    rng = np.random.default_rng(0)
+    yy, xx = np.mgrid[0:480, 0:640]
+    frame = np.stack([xx * 255 // 639, yy * 255 // 479, (xx + yy) * 127 // 1118], axis=-1).astype(np.int16)
+    frame = np.clip(frame + rng.integers(-12, 12, frame.shape), 0, 255).astype(np.uint8)
+    jpeg_buf = jpeg.encode(frame)
+    faces = [(100, 80, 90, 110), (300, 150, 120, 140), (500, 300, 80, 100)]
+
+    n = 200
+    cropper = RoiCropper(jpeg)
+    t = time.perf_counter()
+    for _ in range(n):
+        cropper.crop(jpeg_buf, faces)
+    lossless = (time.perf_counter() - t) / n / len(faces)
+    t = time.perf_counter()
+    for _ in range(n):
+        image = jpeg.decode(jpeg_buf)
+        for x, y, w, h in faces:
+            jpeg.encode(np.ascontiguousarray(image[y:y + h, x:x + w]))
+    round_trip = (time.perf_counter() - t) / n / len(faces)
+    print(cropper.report())
+    print(f"lossless crop: {lossless * 1000:.3f}ms per ROI, decode/crop/encode: {round_trip * 1000:.3f}ms per ROI")
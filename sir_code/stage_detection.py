@@ -1,10 +1,10 @@
 import logging
-import re
 from typing import List
 
+from sir_code.choice_parser import ChoiceParser
 from sir_code.lib import Agent
 from sir_code.loggers import MAIN_LOGGER
-from sir_code.utils import multiline_strip
+from sir_code.prompt_template import PromptTemplate
 
 _ = MAIN_LOGGER # ensure logging setup is complete
 
@@ -49,6 +49,16 @@ class StageDetection:
 
     _logger = logging.getLogger("Demo.StageDetection")
     _logger.setLevel(logging.CRITICAL)
+    _prompt = PromptTemplate(
+        """
+        The following text is a reply from you to a traveller in a tavern:
+        you: "{nao_text}"
+        
+        Which of the following apply (can be multiple or none)? Please answer with comma separated words (e.g 'Stage1,Stage2'),
+        or simply 'None' if none apply:
+        {options}
+        """
+    )
 
     stage_history: List[str]
     current_stage: str
@@ -57,30 +67,16 @@ class StageDetection:
         self.stage_history = []
         self.current_stage = ""
         self._agent = agent
+        self.parser = ChoiceParser(self.descriptions)
 
     def generate_prompt(self, nao_text: str):
-        options_text = "\n".join(f"{k}) {v}" for k, v in self.descriptions.items())
-        return multiline_strip(
-            f"""
-            The following text is a reply from you to a traveller in a tavern:
-            you: "{nao_text}"
-            
-            Which of the following apply (can be multiple or none)? Please answer with comma separated words (e.g 'Stage1,Stage2'),
-            or simply 'None' if none apply:
-            {options_text}
-            """
-        )
+        return self._prompt.render(self.descriptions, nao_text=nao_text)
 
     def detect(self, nao_text: str) -> str:
         prompt = self.generate_prompt(nao_text)
-        resp = self._agent.ask([{"role": "user", "content": prompt}], max_output_tokens=16).strip().strip(".")
-
-        if resp.lower() == "none":
-            letters = ""
-            self.current_stage = ""
-        else:
-            letters = sorted(re.findall(r"Stage[1-5]", resp))
-            self.current_stage = letters[-1]
+        resp = self._agent.ask_choice([{"role": "user", "content": prompt}], choices=self.parser.choices)
+        letters = self.parser.parse(resp)
+        self.current_stage = letters[-1] if letters else ""
 
 
         given_resp = "\n".join(f"{k}) {v}" for k, v in self.descriptions.items() if k in letters)
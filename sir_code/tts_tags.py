@@ -0,0 +1,175 @@
+import logging
+from typing import Dict, Tuple
+
+from sir_code.loggers import MAIN_LOGGER
+
+_ = MAIN_LOGGER # ensure logging setup is complete
+
+# value ranges of the NAO TTS tags, as documented to the agent in _DYNAMIC_SPEECH
+TAG_RANGES: Dict[str, Tuple[int, int]] = {
+    "vct": (50, 100),
+    "rspd": (50, 400),
+    "pau": (100, 1000),
+    "vol": (80, 100),
+}
+# tags changing the voice until the next \rst\
+_SETTING_TAGS = {"vct", "rspd", "vol"}
+
+_TEXT, _BACKSLASH, _NAME, _VALUE = range(4)
+_MAX_NAME = 8
+_MAX_VALUE = 8
+
+
+class TtsTagNormalizer:
+    """
+    Single pass lexer validating the NAO TTS tags in the agent text before it is sent to the robot.
+    Values are clamped to `TAG_RANGES`, runs of backslashes are collapsed, missing closing backslashes are added,
+    unknown `\\name=value\\` tags are stripped and a `\\rst\\` is appended when a voice setting is left active.
+
+    The lexer is incremental: `feed` can be called with every `ask_stream` delta, a tag split across deltas is
+    held back until it is complete, `flush` ends the text.
+    """
+    _logger = logging.getLogger("Demo.TtsTagNormalizer")
+
+    def __init__(self):
+        self._state = _TEXT
+        self._name = ""
+        self._value = ""
+        self._active = False
+        self.clamped = 0
+        self.stripped = 0
+        self.escapes_fixed = 0
+        self.rst_added = 0
+
+    def feed(self, delta: str) -> str:
+        out = []
+        i, n = 0, len(delta)
+        while i < n:
+            state = self._state
+            if state == _TEXT:
+                j = delta.find("\\", i)
+                if j == -1:
+                    out.append(delta[i:])
+                    break
+                out.append(delta[i:j])
+                self._state = _BACKSLASH
+                i = j + 1
+            elif state == _BACKSLASH:
+                c = delta[i]
+                if c == "\\":
+                    self.escapes_fixed += 1
+                    i += 1
+                elif c.isalpha():
+                    self._state, self._name = _NAME, ""
+                else:
+                    self._state = _TEXT  # a closing or stray backslash
+            elif state == _NAME:
+                c = delta[i]
+                if c.isalpha() and len(self._name) < _MAX_NAME:
+                    self._name += c
+                    i += 1
+                elif c == "=" and len(self._name) < _MAX_NAME:
+                    self._state, self._value = _VALUE, ""
+                    i += 1
+                else:
+                    out.append(self._end_name())
+            else:
+                c = delta[i]
+                numeric = self._name in TAG_RANGES
+                if len(self._value) < _MAX_VALUE and (c.isdigit() or (numeric and c == "." and "." not in self._value)
+                                                      or (not numeric and (c.isalnum() or c == "_"))):
+                    self._value += c
+                    i += 1
+                else:
+                    out.append(self._end_value())
+        return "".join(out)
+
+    def flush(self) -> str:
+        out = []
+        if self._state == _NAME:
+            out.append(self._end_name())
+        elif self._state == _VALUE:
+            out.append(self._end_value())
+        self._state = _TEXT
+        if self._active:
+            self._active = False
+            self.rst_added += 1
+            out.append("\\rst\\")
+        return "".join(out)
+
+    def _end_name(self) -> str:
+        self._state = _TEXT
+        if self._name == "rst":
+            self._active = False
+            return "\\rst\\"
+        return self._name  # a backslash in front of a word, keep the word
+
+    def _end_value(self) -> str:
+        self._state = _TEXT
+        name, value = self._name, self._value
+        if name not in TAG_RANGES or not value.strip("."):
+            self.stripped += 1
+            self._logger.debug(f"stripped tts tag '\\{name}={value}\\'")
+            return ""
+        low, high = TAG_RANGES[name]
+        number = int(round(float(value)))
+        if not low <= number <= high:
+            self.clamped += 1
+            number = min(max(number, low), high)
+        self._active = self._active or name in _SETTING_TAGS
+        return f"\\{name}={number}\\"
+
+
+def normalize_tts_tags(text: str) -> str:
+    normalizer = TtsTagNormalizer()
+    return normalizer.feed(text) + normalizer.flush()
+
+
+if __name__ == '__main__':
+    import random
+    import re
+    import time
+
+    valid_tag = re.compile(r"\\(?:(vct|rspd|pau|vol)=(\d+)|rst)\\")
+    pieces = ["I’ll start softly ", "like this.", " Now ", "for a moment? ", "\\vol=40\\", "\\vct=150\\", "\\rst\\",
+              "\\\\rspd=70\\\\", "\\pau=600", "\\pau=\\", "\\emph=2\\", "\\readmode=sent\\", "\\", "\\\\", "\\rst",
+              "\\vct=8.5\\", "\\vol=95\\", "=", "rst", "vct=", " 42 ", "\\like\\", "\n"]
+
+    def check(text: str):
+        kinds = []
+        for m in valid_tag.finditer(text):
+            if m.group(1):
+                low, high = TAG_RANGES[m.group(1)]
+                assert low <= int(m.group(2)) <= high, text
+            kinds.append("rst" if m.group(1) is None else "set" if m.group(1) in _SETTING_TAGS else "pau")
+        assert valid_tag.sub("", text).count("\\") == 0, text
+        assert "set" not in kinds or "rst" in kinds[len(kinds) - kinds[::-1].index("set"):], text
+
+    random.seed(0)
+    for _ in range(20000):
+        text = "".join(random.choice(pieces) for _ in range(random.randint(0, 20)))
+        expected = normalize_tts_tags(text)
+        check(expected)
+        cuts = sorted(random.sample(range(len(text) + 1), min(len(text) + 1, random.randint(0, 6))))
+        normalizer = TtsTagNormalizer()
+        streamed = "".join(normalizer.feed(text[a:b]) for a, b in zip([0] + cuts, cuts + [len(text)]))
+        assert streamed + normalizer.flush() == expected, (text, cuts)
+    print("fuzz: 20000 texts ok")
+
+    reply = ("I’ll start softly \\vol=90\\like this.\\rst\\ Now I’ll slow down \\rspd=70\\for a moment.\\rst\\ "
+             "Then I’ll raise my pitch \\vct=95\\right here?\\rst\\ \\pau=600\\And now we continue. ") * 8
+    deltas = [reply[i:i + 4] for i in range(0, len(reply), 4)]  # ~ one token per delta
+    n = 200
+    t = time.perf_counter()
+    for _ in range(n):
+        normalize_tts_tags(reply)
+    one_shot = (time.perf_counter() - t) / n
+    t = time.perf_counter()
+    for _ in range(n):
+        normalizer = TtsTagNormalizer()
+        for delta in deltas:
+            normalizer.feed(delta)
+        normalizer.flush()
+    streamed = (time.perf_counter() - t) / n
+    print(f"throughput: one-shot {len(reply) / one_shot / 1e6:.2f} Mchar/s, "
+          f"streamed {len(reply) / streamed / 1e6:.2f} Mchar/s, {streamed / len(deltas) * 1e6:.2f}us per delta")
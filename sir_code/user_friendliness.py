@@ -1,10 +1,10 @@
 import logging
-import re
 from typing import List
 
+from sir_code.choice_parser import ChoiceParser
 from sir_code.lib import Agent
 from sir_code.loggers import MAIN_LOGGER
-from sir_code.utils import multiline_strip
+from sir_code.prompt_template import PromptTemplate
 
 _ = MAIN_LOGGER # ensure logging setup is complete
 
@@ -39,9 +39,19 @@ class UserFriendliness:
         "I": -1,
         "J": -2,
     }
-    _resp_regex = re.compile(r"^\s*([A-J])(?:\s*,\s*([A-J]))*\s*$")
     _logger = logging.getLogger("Demo.UserFriendliness")
     _logger.setLevel(logging.DEBUG)
+    _prompt = PromptTemplate(
+        """
+        The following text is an conversation between you and a traveller in a tavern:
+        you: "{nao_text}"
+        traveller: "{user_text}"
+        
+        Which of the following apply to what the traveller said (can be multiple or none)? 
+        Please answer with comma separated letters (e.g 'A,B'), or simply 'None' if none apply:
+        {options}
+        """
+    )
 
     scoring_history: List[str]
     current_score: int | float
@@ -52,35 +62,19 @@ class UserFriendliness:
         self.current_score = 0
         self.threshold = threshold
         self._agent = agent
+        self.parser = ChoiceParser(self.descriptions)
 
     @property
     def threshold_met(self):
         return self.current_score >= self.threshold
 
     def generate_prompt(self, nao_text: str, user_text: str):
-        options_text = "\n".join(f"{k}) {v}" for k, v in self.descriptions.items())
-        return multiline_strip(
-            f"""
-            The following text is an conversation between you and a traveller in a tavern:
-            you: "{nao_text}"
-            traveller: "{user_text}"
-            
-            Which of the following apply to what the traveller said (can be multiple or none)? 
-            Please answer with comma separated letters (e.g 'A,B'), or simply 'None' if none apply:
-            {options_text}
-            """
-        )
+        return self._prompt.render(self.descriptions, nao_text=nao_text, user_text=user_text)
 
     def score(self, nao_text: str, user_text: str, save: bool = True):
         prompt = self.generate_prompt(nao_text, user_text)
-        resp = self._agent.ask([{"role": "user", "content": prompt}], max_output_tokens=16).strip().strip(".")
-
-        if resp.lower() == "none":
-            letters = ""
-        else:
-            assert self._resp_regex.match(resp), f"agent answer does not match regex: '{resp}'"
-            letters = "".join(sorted(re.findall(r"[A-J]", resp)))
-            assert len(letters) == len(set(letters)), f"agent answer has duplicate letters: '{resp}'"
+        resp = self._agent.ask_choice([{"role": "user", "content": prompt}], choices=self.parser.choices)
+        letters = "".join(self.parser.parse(resp))
 
         score = sum(self.scores[c] for c in letters)
 